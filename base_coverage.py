@@ -1,32 +1,130 @@
+import collections
 import json
+import math
+import os
+import threading
 import time
 
+import numpy
 import pysam
+import timing
 from lookups import IntervalSet
-from utils import Xpos
+from utils import HandlePool, Xpos
+
+# shared by all CoverageFile objects; keys are (path, mtime), so handles of replaced files are never reused
+_tabix_pool = HandlePool(lambda key: pysam.TabixFile(key[0]), max_idle=32)
 
 
 class CoverageHandler(object):
     '''contains coverage (at multiple binning levels) for all chroms'''
-    def __init__(self, coverage_files):
+    def __init__(self, coverage_files, cache_max_bytes=0, mtime_check_interval=10):
+        self._coverage_files = coverage_files
+        self._mtime_check_interval = mtime_check_interval
+        self._cache = CoverageCache(cache_max_bytes)
+        self._mtimes = self._get_mtimes()
+        self._mtimes_checked = time.time()
+        self._open_coverage_files()
+    def _open_coverage_files(self):
         self._single_chrom_coverage_handlers = {}
-        for cf in coverage_files:
-            coverage_file = CoverageFile(cf['path'], cf.get('binned',False))
+        self._opened_coverage_files = []
+        for cf in self._coverage_files:
+            if cf.get('columnar', False):
+                coverage_file = ColumnarCoverageFile(cf['path'])
+            else:
+                coverage_file = CoverageFile(cf['path'], cf.get('binned',False))
+            self._opened_coverage_files.append(coverage_file)
             for chrom in coverage_file.get_chroms():
                 if chrom not in self._single_chrom_coverage_handlers:
                     self._single_chrom_coverage_handlers[chrom] = SingleChromCoverageHandler(chrom)
                 self._single_chrom_coverage_handlers[chrom].add_coverage_file(coverage_file, cf.get('bp-min-length',0))
-    def get_coverage_for_intervalset(self, intervalset):
-        st = time.time()
+    def _get_mtimes(self):
+        mtimes = []
+        for cf in self._coverage_files:
+            # columnar_coverage.py and coverage_pyramid.py write `columns.json` last
+            path = os.path.join(cf['path'], 'columns.json') if cf.get('columnar', False) else cf['path']
+            try: mtimes.append(os.path.getmtime(path))
+            except OSError: mtimes.append(None)
+        return mtimes
+    def _check_mtimes(self):
+        # stat-ing every file on every request is not free, so only look every `mtime_check_interval` seconds
+        if time.time() - self._mtimes_checked < self._mtime_check_interval: return
+        self._mtimes_checked = time.time()
+        mtimes = self._get_mtimes()
+        if mtimes != self._mtimes:
+            print('## COVERAGE: coverage files changed, reopening them and clearing the cache')
+            self._mtimes = mtimes
+            self._open_coverage_files()
+            self._cache.clear()
+    def preload(self):
+        '''memory-maps all columnar arrays now, e.g. before a server forks workers, so that they share the mappings'''
+        for coverage_file in self._opened_coverage_files:
+            coverage_file.preload()
+    def get_version(self):
+        '''modification times of the coverage files; changes whenever one of them is replaced'''
+        self._check_mtimes()
+        return self._mtimes
+    def get_coverage_json_for_intervalset(self, intervalset, width=None):
+        '''same as `get_coverage_for_intervalset`, but returns serialized JSON and keeps it in an LRU cache.
+        `<`, `>` and `&` are escaped as Flask's `tojson` does, so the JSON can also be embedded in a page's <script> as it is.'''
+        self._check_mtimes()
+        key = (intervalset.chrom, tuple(tuple(pair) for pair in intervalset.to_obj()['list_of_pairs']), width)
+        coverage_json = self._cache.get(key)
+        if coverage_json is None:
+            coverage = self.get_coverage_for_intervalset(intervalset, width=width)
+            with timing.span('serialization'):
+                coverage_json = json.dumps(coverage, separators=(',',':')).replace('<', '\\u003c').replace('>', '\\u003e').replace('&', '\\u0026').encode('utf8')
+            self._cache.put(key, coverage_json)
+        return coverage_json
+    def get_cache_stats(self):
+        return self._cache.get_stats()
+    def get_coverage_for_intervalset(self, intervalset, width=None):
+        '''if `width` (in pixels) is given, returns about one bin per pixel whenever zoom levels are available'''
         try: single_chrom_coverage_handler = self._single_chrom_coverage_handlers[intervalset.chrom]
         except KeyError: print('Warning: No coverage for chrom', intervalset.chrom); return []
         coverage = []
         intervalset_length = intervalset.get_length()
-        for pair in intervalset.to_obj()['list_of_pairs']:
-            coverage.extend(single_chrom_coverage_handler.get_coverage_for_range(pair[0], pair[1], length=intervalset_length))
-        print('## COVERAGE: spent {:.3f} seconds tabixing {} coverage bins'.format(time.time()-st, len(coverage)))
+        bp_per_bin = intervalset_length / float(width) if width else None
+        with timing.span('coverage'): # tabix or columnar reads
+            for pair in intervalset.to_obj()['list_of_pairs']:
+                coverage.extend(single_chrom_coverage_handler.get_coverage_for_range(pair[0], pair[1], length=intervalset_length, bp_per_bin=bp_per_bin))
         return coverage
 
+class CoverageCache(object):
+    '''LRU of serialized coverage, bounded by the total number of bytes'''
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._hits = self._misses = self._evictions = 0
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key, None)
+            if value is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._entries.move_to_end(key)
+            return value
+    def put(self, key, value):
+        if len(value) > self._max_bytes: return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= len(self._entries.pop(key))
+            self._entries[key] = value
+            self._bytes += len(value)
+            while self._bytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self._evictions += 1
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+    def get_stats(self):
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses, 'evictions': self._evictions, 'entries': len(self._entries), 'bytes': self._bytes, 'max_bytes': self._max_bytes}
+
 class SingleChromCoverageHandler(object):
     '''contains coverage (at multiple binning levels) for one chrom'''
     def __init__(self, chrom):
@@ -35,9 +133,15 @@ class SingleChromCoverageHandler(object):
     def add_coverage_file(self, coverage_file, min_length_in_bases):
         self._coverage_files.append({'coverage_file':coverage_file, 'bp-min-length':min_length_in_bases})
         self._coverage_files.sort(key=lambda d:d['bp-min-length'])
-    def get_coverage_for_range(self, start, stop, length=None):
+    def get_coverage_for_range(self, start, stop, length=None, bp_per_bin=None):
         if length is None: length = stop - start
         assert len(self._coverage_files) >= 1, (self._chrom, start, stop, length, self._coverage_files, str(self))
+        if bp_per_bin is not None and bp_per_bin >= 2:
+            # use the coarsest zoom level with bins no wider than `bp_per_bin`
+            for cf in reversed(self._coverage_files):
+                levels = [level for level in cf['coverage_file'].get_levels() if level <= math.log(bp_per_bin, 2)]
+                if levels:
+                    return cf['coverage_file'].get_coverage(self._chrom, start, stop, level=max(levels))
         assert self._coverage_files[0]['bp-min-length'] <= length, (self._chrom, start, stop, length, self._coverage_files, str(self))
         # get the last (ie, longest `bp-min-length`) coverage_file that has a `bp-min-length` <= length
         coverage_file = next(cf['coverage_file'] for cf in reversed(self._coverage_files) if cf['bp-min-length'] <= length)
@@ -50,25 +154,82 @@ class CoverageFile(object):
     '''handles a single tabixed coverage file with any number of chroms'''
     # our coverage files don't include `chr`, so this class prepends `chr` to output and strips `chr` from input
     def __init__(self, path, binned):
-        self._tabixfile = pysam.TabixFile(path)
+        self._path = path
+        self._key = (path, os.path.getmtime(path))
+        with _tabix_pool.borrow(self._key) as tabixfile:
+            self._chroms = list(tabixfile.contigs)
         self._binned = binned
     def get_chroms(self):
-        return self._tabixfile.contigs
+        return self._chroms
+    def get_levels(self):
+        return []
+    def preload(self):
+        pass # tabix handles are opened by every process on first use (see `_tabix_pool`), since they can't be shared across forks
     def get_coverage(self, chrom, start, stop):
-        if not self._binned:
-            for row in self._tabixfile.fetch(chrom, start, stop+1, parser=pysam.asTuple()):
-                yield json.loads(row[2])
-        else:
-            # Right now we don't include the region_end column in our coverage files,
-            # so there's no way to make sure we get the bin overlapping the start of our query region.
-            # To deal with it for now, we'll just use start-50
-            # TODO: include region_end in coverage files.
-            for row in self._tabixfile.fetch(chrom, max(1, start-50), stop+1, parser=pysam.asTuple()):
-                d = json.loads(row[2])
-                if d['end'] < start or d['start'] > stop: continue
-                d['start'] = max(d['start'], start)
-                d['end'] = min(d['end'], stop)
-                yield d
+        # rows are read into a list while the handle is borrowed, so that it goes back to the pool even if the caller stops early
+        coverage = []
+        with _tabix_pool.borrow(self._key) as tabixfile:
+            if not self._binned:
+                # positions are 1-based, and `fetch` takes 0-based half-open ranges
+                for row in tabixfile.fetch(chrom, max(0, start-1), stop, parser=pysam.asTuple()):
+                    coverage.append(json.loads(row[2]))
+            else:
+                # Right now we don't include the region_end column in our coverage files,
+                # so there's no way to make sure we get the bin overlapping the start of our query region.
+                # To deal with it for now, we'll just use start-50
+                # TODO: include region_end in coverage files.
+                for row in tabixfile.fetch(chrom, max(1, start-50), stop+1, parser=pysam.asTuple()):
+                    d = json.loads(row[2])
+                    if d['end'] < start or d['start'] > stop: continue
+                    d['start'] = max(d['start'], start)
+                    d['end'] = min(d['end'], stop)
+                    coverage.append(d)
+        return coverage
+    def __str__(self):
+        return '<CoverageFile chroms={} path={}>'.format(','.join(self.get_chroms()), self._path)
+    __repr__ = __str__
+
+class ColumnarCoverageFile(object):
+    '''handles a directory written by `data/base_coverage/columnar_coverage.py`, full or binned, with any number of chroms'''
+    # for every chrom: `[chrom].start.npy` and `[chrom].end.npy` (int32, ascending) and `[chrom].values.npy` (float32, one column per field in `columns.json`)
+    # zoom levels written by `data/base_coverage/coverage_pyramid.py` are stored the same way, as `[chrom].L[level].*.npy`, with `level_columns`
+    # arrays are memory-mapped, so a request only touches the pages of its own range and nothing is parsed
+    def __init__(self, path):
+        self._path = path
+        with open(os.path.join(path, 'columns.json')) as f:
+            meta = json.load(f)
+        self._columns = meta['columns']
+        self._chrom_names = meta['chroms']
+        self._levels = meta.get('levels', [])
+        self._level_columns = meta.get('level_columns', [])
+        self._arrays = {}
+    def get_chroms(self):
+        return list(self._chrom_names.keys())
+    def get_levels(self):
+        return self._levels
+    def preload(self):
+        for chrom in self._chrom_names:
+            for level in [0] + self._levels:
+                self._get_arrays(chrom, level)
+    def _get_arrays(self, chrom, level):
+        if (chrom, level) not in self._arrays:
+            prefix = '{}.L{}'.format(chrom, level) if level else chrom
+            self._arrays[(chrom, level)] = tuple(numpy.load(os.path.join(self._path, '{}.{}.npy'.format(prefix, name)), mmap_mode='r') for name in ('start', 'end', 'values'))
+        return self._arrays[(chrom, level)]
+    def get_coverage(self, chrom, start, stop, level=0):
+        starts, ends, values = self._get_arrays(chrom, level)
+        column_names = self._level_columns if level else self._columns
+        # rows are sorted and don't overlap, so both `start` and `end` columns are ascending
+        lo = numpy.searchsorted(ends, start, side='left')
+        hi = numpy.searchsorted(starts, stop, side='right')
+        if lo >= hi: return []
+        # float32 -> float64 and rounding keep the JSON short (0.1 instead of 0.10000000149011612)
+        columns = [numpy.around(values[lo:hi, i].astype(numpy.float64), 4).tolist() for i in range(len(column_names))]
+        chrom_name = self._chrom_names.get(chrom, chrom)
+        return [
+            dict(zip(column_names, row), chrom=chrom_name, start=s, end=e)
+            for s, e, row in zip(numpy.maximum(starts[lo:hi], start).tolist(), numpy.minimum(ends[lo:hi], stop).tolist(), zip(*columns))
+        ]
     def __str__(self):
-        return '<CoverageFile chroms={} path={}>'.format(','.join(self.get_chroms()), self._tabixfile.filename)
+        return '<ColumnarCoverageFile chroms={} path={}>'.format(','.join(self.get_chroms()), self._path)
     __repr__ = __str__
@@ -0,0 +1,4 @@
+"""Load test for the browser and the API: synthetic fixtures, loading through `manage.py`, and a weighted request replay.
+
+Run `python -m benchmarks.loadtest -h` from the repository root.
+"""
@@ -0,0 +1,189 @@
+"""Load test for the browser (`exac.py`) and the API (`server-api.py`) on a synthetic dataset.
+
+1. Writes the fixtures (see `fixtures.py`) and a configuration file into the work directory.
+2. Loads them into a local mongod with `manage.py`, exactly as a real deployment would.
+3. Starts both servers with gunicorn, replays the weighted request mix (see `replay.py`), and stops them.
+4. Prints throughput and p50/p95/p99 latency per route as JSON, and compares them with an earlier run if asked.
+
+Examples (from the repository root):
+    python -m benchmarks.loadtest -w /tmp/bravo-loadtest --start-mongod -o before.json
+    python -m benchmarks.loadtest -w /tmp/bravo-loadtest --skip-load -o after.json --compare before.json
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+import pymongo
+
+from benchmarks.loadtest import fixtures
+from benchmarks.loadtest.replay import Targets, compare, replay
+
+REPO_DIRECTORY = fixtures.REPO_DIRECTORY
+
+argparser = argparse.ArgumentParser(description = 'Loads a synthetic dataset and measures throughput and latency of the browser and the API under a weighted request mix.')
+argparser.add_argument('-w', '--work-dir', metavar = 'directory', required = True, type = str, dest = 'work_directory', help = 'Directory for fixtures, configuration, server logs and (with --start-mongod) the database.')
+argparser.add_argument('-o', '--output', metavar = 'file', required = False, type = str, default = None, dest = 'output_file', help = 'Write results to this JSON file. Default: standard output only.')
+argparser.add_argument('--compare', metavar = 'file', required = False, type = str, default = None, dest = 'baseline_file', help = 'Results of an earlier run to compare with.')
+argparser.add_argument('--skip-load', action = 'store_true', dest = 'skip_load', help = 'Reuse fixtures and the database loaded by an earlier run with the same work directory.')
+argparser.add_argument('--start-mongod', action = 'store_true', dest = 'start_mongod', help = 'Start a throwaway mongod with its data in the work directory.')
+argparser.add_argument('--mongo-port', metavar = 'number', required = False, type = int, default = 27017, dest = 'mongo_port', help = 'Port of the local mongod. Default: 27017.')
+argparser.add_argument('--mongo-db', metavar = 'name', required = False, type = str, default = 'bravo_loadtest', dest = 'mongo_db', help = 'Database name. Default: bravo_loadtest.')
+argparser.add_argument('--genes', metavar = 'number', required = False, type = int, default = 40, dest = 'n_genes', help = 'Number of synthetic genes. Default: 40.')
+argparser.add_argument('--variants-per-gene', metavar = 'number', required = False, type = int, default = 300, dest = 'variants_per_gene', help = 'Number of variants per gene. Default: 300.')
+argparser.add_argument('--json-coverage', action = 'store_true', dest = 'json_coverage', help = 'Serve coverage from tabix-indexed JSON instead of the columnar store.')
+argparser.add_argument('--seed', metavar = 'number', required = False, type = int, default = 1, dest = 'seed', help = 'Seed for fixtures and for the request mix. Default: 1.')
+argparser.add_argument('--workers', metavar = 'number', required = False, type = int, default = 2, dest = 'workers', help = 'gunicorn worker processes per server. Default: 2.')
+argparser.add_argument('--threads', metavar = 'number', required = False, type = int, default = 4, dest = 'threads', help = 'Threads per worker. Default: 4.')
+argparser.add_argument('-c', '--clients', metavar = 'number', required = False, type = int, default = 16, dest = 'clients', help = 'Concurrent client threads. Default: 16.')
+argparser.add_argument('-t', '--time', metavar = 'seconds', required = False, type = int, default = 60, dest = 'seconds', help = 'Duration of the measured run. Default: 60.')
+argparser.add_argument('--warmup', metavar = 'seconds', required = False, type = int, default = 10, dest = 'warmup_seconds', help = 'Duration of the unmeasured warm-up run. Default: 10.')
+argparser.add_argument('--skip-api', action = 'store_true', dest = 'skip_api', help = 'Only start and benchmark the browser.')
+argparser.add_argument('--web-port', metavar = 'number', required = False, type = int, default = 8771, dest = 'web_port', help = 'Port for exac.py. Default: 8771.')
+argparser.add_argument('--api-port', metavar = 'number', required = False, type = int, default = 8772, dest = 'api_port', help = 'Port for server-api.py. Default: 8772.')
+
+API_URL_PREFIX = '/api/v1'
+
+CONFIG_TEMPLATE = '''# written by benchmarks/loadtest
+MONGO = {{'host': '127.0.0.1', 'port': {mongo_port}, 'name': '{mongo_db}'}}
+BASE_COVERAGE_DIRECTORY = '{coverage_directory}'
+IGV_REFERENCE_PATH = '{reference}'
+IGV_CRAM_DIRECTORY = '{cram_directory}'
+IGV_CACHE_DIRECTORY = '{igv_cache_directory}'
+IGV_CACHE_COLLECTION = 'igv_cache'
+GOOGLE_AUTH = False
+API_GOOGLE_AUTH = False
+API_IP_WHITELIST = ['127.0.0.1']
+API_VERSION = 'v1'
+API_URL_PREFIX = '{api_url_prefix}'
+API_DATASET_NAME = 'loadtest'
+API_REQUESTS_RATE_LIMIT = ['1000000/minute']
+RESPONSE_CACHE_DIRECTORY = '' # measure the views, not the compressed response cache
+'''
+
+
+def start_mongod(work_directory, port):
+    db_directory = os.path.join(work_directory, 'mongo')
+    if not os.path.isdir(db_directory):
+        os.makedirs(db_directory)
+    log = open(os.path.join(work_directory, 'mongod.log'), 'w')
+    mongod = subprocess.Popen(['mongod', '--dbpath', db_directory, '--port', str(port), '--bind_ip', '127.0.0.1'], stdout = log, stderr = subprocess.STDOUT)
+    client = pymongo.MongoClient('127.0.0.1', port, serverSelectionTimeoutMS = 1000)
+    for _ in range(60):
+        try:
+            client.admin.command('ping')
+            return mongod
+        except pymongo.errors.ServerSelectionTimeoutError:
+            if mongod.poll() is not None:
+                break
+    sys.exit('mongod did not start, see {}.'.format(log.name))
+
+
+def write_config(work_directory, manifest, args):
+    igv_cache_directory = os.path.join(work_directory, 'igv_cache')
+    if os.path.isdir(igv_cache_directory):
+        shutil.rmtree(igv_cache_directory)
+    os.makedirs(igv_cache_directory)
+    path = os.path.join(work_directory, 'config.py')
+    with open(path, 'w') as ofile:
+        ofile.write(CONFIG_TEMPLATE.format(
+            mongo_port = args.mongo_port, mongo_db = args.mongo_db, coverage_directory = manifest['coverage_directory'], reference = manifest['reference'],
+            cram_directory = manifest['cram_directory'], igv_cache_directory = igv_cache_directory + os.sep, api_url_prefix = API_URL_PREFIX))
+    return path
+
+
+def load(manifest, env, work_directory, first_gene_name):
+    commands = [
+        ['genes', '-t', manifest['canonical_transcripts'], '-m', manifest['omim'], '-f', manifest['genenames'], '-g', manifest['gencode']],
+        ['dbsnp', '-d', manifest['dbsnp'], '-t', '1'],
+        ['metrics', '-m', manifest['metrics']],
+        ['variants', '-v', manifest['variants'], '-t', '1'],
+        ['summaries', '-t', '2'],
+        ['search_terms'],
+        ['indexes', '-g', first_gene_name],
+        ['bam_cache'],
+    ]
+    with open(os.path.join(work_directory, 'load.log'), 'w') as log:
+        for command in commands:
+            sys.stderr.write('manage.py {}\n'.format(command[0]))
+            if subprocess.call([sys.executable, 'manage.py'] + command, cwd = REPO_DIRECTORY, env = env, stdout = log, stderr = subprocess.STDOUT) != 0:
+                sys.exit('manage.py {} failed, see {}.'.format(command[0], log.name))
+
+
+def start_server(name, command, env, work_directory, ready_url):
+    log = open(os.path.join(work_directory, '{}.log'.format(name)), 'w')
+    server = subprocess.Popen(command, cwd = REPO_DIRECTORY, env = env, stdout = log, stderr = subprocess.STDOUT)
+    while True:
+        if server.poll() is not None:
+            sys.exit('{} exited with code {}, see {}.'.format(name, server.returncode, log.name))
+        try:
+            urllib.request.urlopen(ready_url, timeout = 5).read()
+            return server
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(1)
+
+
+def get_git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = REPO_DIRECTORY, stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    args = argparser.parse_args()
+    work_directory = os.path.abspath(args.work_directory)
+    fixtures_directory = os.path.join(work_directory, 'fixtures')
+    processes = []
+    try:
+        if args.start_mongod:
+            processes.append(start_mongod(work_directory, args.mongo_port))
+        if args.skip_load:
+            with open(os.path.join(fixtures_directory, 'manifest.json')) as ifile:
+                manifest = json.load(ifile)
+        else:
+            sys.stderr.write('Writing fixtures to {}.\n'.format(fixtures_directory))
+            manifest = fixtures.write_fixtures(fixtures_directory, args.n_genes, args.variants_per_gene, columnar = not args.json_coverage, seed = args.seed)
+        env = dict(os.environ, BRAVO_CONFIG_FILE = write_config(work_directory, manifest, args))
+        db = pymongo.MongoClient('127.0.0.1', args.mongo_port)[args.mongo_db]
+        if not args.skip_load:
+            load(manifest, env, work_directory, manifest['first_gene_name'])
+
+        base_urls = {'web': 'http://127.0.0.1:{}'.format(args.web_port)}
+        web_env = dict(env, BRAVO_WORKERS = str(args.workers), BRAVO_THREADS = str(args.threads), BRAVO_BIND = '127.0.0.1:{}'.format(args.web_port), BRAVO_LOG_LEVEL = 'warning')
+        processes.append(start_server('exac', ['gunicorn', '--config', 'gunicorn.conf.py', 'exac:app'], web_env, work_directory, base_urls['web'] + '/about'))
+        if not args.skip_api:
+            base_urls['api'] = 'http://127.0.0.1:{}{}'.format(args.api_port, API_URL_PREFIX)
+            api_command = ['gunicorn', '--bind', '127.0.0.1:{}'.format(args.api_port), '--workers', str(args.workers), '--worker-class', 'gthread', '--threads', str(args.threads), '--log-level', 'warning', 'server-api:app']
+            processes.append(start_server('server-api', api_command, env, work_directory, base_urls['api'] + '/'))
+
+        targets = Targets(db, manifest['variants_with_reads'])
+        sys.stderr.write('Warming up for {}s.\n'.format(args.warmup_seconds))
+        replay(base_urls, targets, args.clients, args.warmup_seconds, args.seed + 1)
+        sys.stderr.write('Measuring for {}s with {} client(s).\n'.format(args.seconds, args.clients))
+        result = replay(base_urls, targets, args.clients, args.seconds, args.seed)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+
+    result['revision'] = get_git_revision()
+    result['settings'] = {key: getattr(args, key) for key in ['n_genes', 'variants_per_gene', 'json_coverage', 'seed', 'workers', 'threads', 'clients', 'seconds', 'skip_api']}
+    result['dataset'] = {'genes': len(targets.genes), 'variants': manifest['n_variants']}
+    output = json.dumps(result, indent = 1, sort_keys = True)
+    sys.stdout.write(output + '\n')
+    if args.output_file:
+        with open(args.output_file, 'w') as ofile:
+            ofile.write(output + '\n')
+    if args.baseline_file:
+        with open(args.baseline_file) as ifile:
+            baseline = json.load(ifile)
+        sys.stderr.write('{:<16} {:<8} {:>10} {:>10} {:>8}\n'.format('route', 'metric', 'baseline', 'current', 'change'))
+        for route, metric, before, after, change in compare(baseline, result):
+            sys.stderr.write('{:<16} {:<8} {:>10} {:>10} {:>7}%\n'.format(route, metric, before, after, change))
@@ -0,0 +1,310 @@
+"""Synthetic dataset for the load test.
+
+Writes everything `manage.py` and the servers need for one chromosome (22): a GENCODE-like GTF with canonical
+transcripts, OMIM and HGNC tables, a VEP-annotated sites VCF, dbSNP, pre-computed metrics, per-base coverage (JSON
+with tabix, and optionally the columnar store with zoom levels), a reference FASTA and a CRAM with reads for some
+variants. The data is small and random, but it has the shapes that matter for the hot queries: genes with several
+transcripts and exons, clustered variants with annotations for every transcript, rsIDs, and coverage over genes.
+The same seed always produces the same files.
+"""
+
+import gzip
+import json
+import math
+import os
+import random
+import sys
+
+import pysam
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+sys.path.insert(0, os.path.join(REPO_DIRECTORY, 'data', 'base_coverage'))
+
+import columnar_coverage
+import coverage_pyramid
+
+CHROM = '22'
+FIRST_GENE_START = 100000
+GENE_SPACING = 20000
+GENE_LENGTH = 10000
+FLANK = 1000 # variants and coverage extend this far around genes
+EXONS_PER_TRANSCRIPT = 6
+EXON_LENGTH = 300
+N_SAMPLES = 1000
+READ_LENGTH = 100
+ZOOM_LEVELS = 12
+
+VEP_FIELDS = ['Allele', 'Consequence', 'SYMBOL', 'Gene', 'Feature_type', 'Feature', 'BIOTYPE', 'HGVSc', 'HGVSp', 'Existing_variation', 'ALLELE_NUM', 'CANONICAL', 'AFR_AF', 'AMR_AF', 'EAS_AF', 'EUR_AF', 'SAS_AF', 'LoF', 'LoF_filter', 'LoF_flags', 'LoF_info']
+EXONIC_CONSEQUENCES = [('missense_variant', 45), ('synonymous_variant', 35), ('stop_gained', 5), ('frameshift_variant', 3), ('splice_region_variant', 7), ('5_prime_UTR_variant', 5)]
+LOF_CONSEQUENCES = {'stop_gained', 'frameshift_variant'}
+QUALITY_METRICS = {'DP': ('Integer', 'Total Depth'), 'QD': ('Float', 'Variant Confidence/Quality by Depth'), 'SVM': ('Float', 'SVM Score')}
+HIST_MIDS = [2.5 + 5 * i for i in range(20)]
+
+
+def _weighted_choice(rng, choices):
+    total = sum(weight for _, weight in choices)
+    x = rng.uniform(0, total)
+    for value, weight in choices:
+        x -= weight
+        if x <= 0:
+            return value
+    return choices[-1][0]
+
+
+def _make_genes(rng, n_genes):
+    genes = []
+    names = set()
+    while len(names) < n_genes:
+        names.add(''.join(rng.choice('ABCDEFGHIJKLMNOPRSTUVWZ') for _ in range(rng.randint(3, 4))) + str(rng.randint(1, 30)))
+    for i, name in enumerate(sorted(names, key = lambda _: rng.random())):
+        start = FIRST_GENE_START + i * GENE_SPACING
+        gene = {'gene_id': 'ENSG{:011d}'.format(i + 1), 'gene_name': name, 'start': start, 'stop': start + GENE_LENGTH - 1, 'strand': rng.choice('+-'), 'transcripts': []}
+        exon_starts = sorted(rng.sample(range(start, gene['stop'] - EXON_LENGTH, EXON_LENGTH * 2), EXONS_PER_TRANSCRIPT))
+        exon_starts[0], exon_starts[-1] = start, gene['stop'] - EXON_LENGTH + 1
+        for j in range(2):
+            # the first (canonical) transcript spans the gene, the second one skips some of its exons
+            exons = [(s, s + EXON_LENGTH - 1) for k, s in enumerate(exon_starts) if j == 0 or k % 2 == 0 or k == len(exon_starts) - 1]
+            gene['transcripts'].append({'transcript_id': 'ENST{:011d}'.format(2 * i + j + 1), 'protein_id': 'ENSP{:011d}'.format(2 * i + j + 1), 'exons': exons})
+        genes.append(gene)
+    return genes
+
+
+def _write_reference(path, rng, length):
+    sequence = ''.join(rng.choice('ACGT') for _ in range(length))
+    with open(path, 'w') as ofile:
+        ofile.write('>{}\n'.format(CHROM))
+        for i in range(0, length, 60):
+            ofile.write(sequence[i:i + 60] + '\n')
+    pysam.faidx(path)
+    return sequence
+
+
+def _write_gene_models(directory, genes):
+    paths = {name: os.path.join(directory, name) for name in ['gencode.gtf.gz', 'canonical_transcripts.txt.gz', 'omim.tsv.gz', 'hgnc.tsv.gz']}
+    with gzip.open(paths['gencode.gtf.gz'], 'wt') as ofile:
+        ofile.write('##description: synthetic gene models for the load test\n')
+        for gene in genes:
+            attributes = 'gene_id "{}.1"; gene_name "{}";'.format(gene['gene_id'], gene['gene_name'])
+            ofile.write('chr{}\tSYNTHETIC\tgene\t{}\t{}\t.\t{}\t.\t{}\n'.format(CHROM, gene['start'], gene['stop'], gene['strand'], attributes))
+            for transcript in gene['transcripts']:
+                exons = transcript['exons']
+                t_attributes = '{} transcript_id "{}.1";'.format(attributes, transcript['transcript_id'])
+                ofile.write('chr{}\tSYNTHETIC\ttranscript\t{}\t{}\t.\t{}\t.\t{}\n'.format(CHROM, exons[0][0], exons[-1][1], gene['strand'], t_attributes))
+                for k, (start, stop) in enumerate(exons):
+                    ofile.write('chr{}\tSYNTHETIC\texon\t{}\t{}\t.\t{}\t.\t{} exon_number {};\n'.format(CHROM, start, stop, gene['strand'], t_attributes, k + 1))
+                    feature = 'UTR' if k in (0, len(exons) - 1) else 'CDS'
+                    ofile.write('chr{}\tSYNTHETIC\t{}\t{}\t{}\t.\t{}\t.\t{} exon_number {};\n'.format(CHROM, feature, start, stop, gene['strand'], t_attributes, k + 1))
+    with gzip.open(paths['canonical_transcripts.txt.gz'], 'wt') as ofile:
+        for gene in genes:
+            ofile.write('{}\t{}\n'.format(gene['gene_id'], gene['transcripts'][0]['transcript_id']))
+    with gzip.open(paths['omim.tsv.gz'], 'wt') as ofile:
+        ofile.write('Gene stable ID\tTranscript stable ID\tMIM gene accession\tMIM gene description\n')
+        for i, gene in enumerate(genes):
+            if i % 3 == 0:
+                ofile.write('{}\t{}\t{}\t{}\n'.format(gene['gene_id'], gene['transcripts'][0]['transcript_id'], 600000 + i, 'SYNTHETIC DISORDER {}'.format(i)))
+    with gzip.open(paths['hgnc.tsv.gz'], 'wt') as ofile:
+        ofile.write('symbol\tname\talias_symbol\tprev_symbol\tensembl_gene_id\n')
+        for gene in genes:
+            ofile.write('{0}\tsynthetic gene {0}\t{0}A|{0}B\t\t{1}\n'.format(gene['gene_name'], gene['gene_id']))
+    return paths
+
+
+def _annotate(rng, gene, pos, alt, rsid):
+    # 1000 Genomes frequencies are per variant, so every annotation repeats them
+    population_afs = {population: '{:.4f}'.format(rng.random() * 0.01) if rsid else '' for population in ['AFR_AF', 'AMR_AF', 'EAS_AF', 'EUR_AF', 'SAS_AF']}
+    annotations = []
+    for j, transcript in enumerate(gene['transcripts']):
+        if pos < gene['start'] or pos > gene['stop']:
+            consequence = 'upstream_gene_variant'
+        elif any(start <= pos <= stop for start, stop in transcript['exons']):
+            consequence = _weighted_choice(rng, EXONIC_CONSEQUENCES)
+        else:
+            consequence = 'intron_variant'
+        hgvsc = '{}:c.{}N>{}'.format(transcript['transcript_id'], pos - gene['start'] + 1, alt) if consequence != 'upstream_gene_variant' else ''
+        hgvsp = '{}:p.Xaa{}Yaa'.format(transcript['protein_id'], (pos - gene['start']) // 3 + 1) if consequence == 'missense_variant' else ''
+        annotation = {
+            'Allele': alt, 'Consequence': consequence, 'SYMBOL': gene['gene_name'], 'Gene': gene['gene_id'], 'Feature_type': 'Transcript',
+            'Feature': transcript['transcript_id'], 'BIOTYPE': 'protein_coding', 'HGVSc': hgvsc, 'HGVSp': hgvsp, 'Existing_variation': rsid or '',
+            'ALLELE_NUM': '1', 'CANONICAL': 'YES' if j == 0 else '', 'LoF': 'HC' if consequence in LOF_CONSEQUENCES else '', 'LoF_filter': '', 'LoF_flags': '', 'LoF_info': ''
+        }
+        annotation.update(population_afs)
+        annotations.append('|'.join(annotation[field] for field in VEP_FIELDS))
+    return ','.join(annotations)
+
+
+def _histogram(rng, n):
+    counts = [0] * len(HIST_MIDS)
+    for _ in range(min(n, 200)):
+        counts[min(len(HIST_MIDS) - 1, max(0, int(rng.gauss(6, 2))))] += 1
+    return '|'.join(str(c) for c in counts)
+
+
+def _make_variants(rng, genes, sequence, variants_per_gene):
+    variants = []
+    next_rsid = 1000
+    for gene in genes:
+        positions = sorted(set(rng.randint(gene['start'] - FLANK, gene['stop'] + FLANK) for _ in range(variants_per_gene)))
+        for pos in positions:
+            ref = sequence[pos - 1]
+            if rng.random() < 0.1:
+                ref = sequence[pos - 1:pos + 1] # deletion of one base
+                alt = ref[0]
+            else:
+                alt = rng.choice([b for b in 'ACGT' if b != ref])
+            rsid = None
+            if rng.random() < 0.4:
+                rsid = 'rs{}'.format(next_rsid)
+                next_rsid += rng.randint(1, 5)
+            allele_count = 1 + int(rng.expovariate(0.05)) if rng.random() < 0.8 else rng.randint(1, 2 * N_SAMPLES - 1)
+            variants.append({
+                'pos': pos, 'ref': ref, 'alt': alt, 'rsid': rsid, 'gene': gene,
+                'ac': allele_count, 'hom': allele_count // 40, 'filter': 'PASS' if rng.random() < 0.9 else 'SVM',
+                'qual': round(rng.uniform(20, 255), 1), 'cadd': round(rng.uniform(0, 40), 3),
+                'metrics': {'DP': rng.randint(5000, 40000), 'QD': round(rng.uniform(0.5, 35), 2), 'SVM': round(rng.gauss(0.5, 1), 4)}
+            })
+    variants.sort(key = lambda v: v['pos'])
+    return variants
+
+
+def _write_variants(directory, rng, variants):
+    path = os.path.join(directory, 'variants.vcf')
+    with open(path, 'w') as ofile:
+        ofile.write('##fileformat=VCFv4.2\n')
+        ofile.write('##FILTER=<ID=PASS,Description="All filters passed">\n')
+        ofile.write('##FILTER=<ID=SVM,Description="Variant failed SVM filter">\n')
+        ofile.write('##contig=<ID=chr{},length=50818468>\n'.format(CHROM))
+        ofile.write('##INFO=<ID=AN,Number=1,Type=Integer,Description="Number of Alleles in Samples with Coverage">\n')
+        ofile.write('##INFO=<ID=AC,Number=A,Type=Integer,Description="Alternate Allele Counts in Samples with Coverage">\n')
+        ofile.write('##INFO=<ID=AF,Number=A,Type=Float,Description="Alternate Allele Frequencies">\n')
+        ofile.write('##INFO=<ID=Hom,Number=A,Type=Integer,Description="Homozygous Counts">\n')
+        for name in ['AVGDP', 'AVGGQ']:
+            ofile.write('##INFO=<ID={},Number=1,Type=Float,Description="Average per sample">\n'.format(name))
+            ofile.write('##INFO=<ID={}_R,Number=R,Type=Float,Description="Average per sample carrying allele">\n'.format(name))
+        for name in ['DP_HIST', 'GQ_HIST']:
+            ofile.write('##INFO=<ID={},Number=1,Type=String,Description="Histogram: {}">\n'.format(name, '|'.join(str(m) for m in HIST_MIDS)))
+            ofile.write('##INFO=<ID={}_R,Number=R,Type=String,Description="Histogram for allele carriers: {}">\n'.format(name, '|'.join(str(m) for m in HIST_MIDS)))
+        ofile.write('##INFO=<ID=CADD_RAW,Number=A,Type=Float,Description="CADD raw score">\n')
+        ofile.write('##INFO=<ID=CADD_PHRED,Number=A,Type=Float,Description="CADD phred score">\n')
+        for name, (value_type, description) in sorted(QUALITY_METRICS.items()):
+            ofile.write('##INFO=<ID={},Number=1,Type={},Description="{}">\n'.format(name, value_type, description))
+        ofile.write('##INFO=<ID=CSQ,Number=.,Type=String,Description="Consequence annotations from Ensembl VEP. Format: {}">\n'.format('|'.join(VEP_FIELDS)))
+        ofile.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        for v in variants:
+            an = 2 * N_SAMPLES
+            info = [
+                'AN={}'.format(an), 'AC={}'.format(v['ac']), 'AF={:.6g}'.format(v['ac'] / float(an)), 'Hom={}'.format(v['hom']),
+                'AVGDP={:.2f}'.format(rng.uniform(20, 40)), 'AVGDP_R={:.2f},{:.2f}'.format(rng.uniform(20, 40), rng.uniform(20, 40)),
+                'AVGGQ={:.2f}'.format(rng.uniform(60, 99)), 'AVGGQ_R={:.2f},{:.2f}'.format(rng.uniform(60, 99), rng.uniform(60, 99)),
+                'DP_HIST={}'.format(_histogram(rng, N_SAMPLES)), 'DP_HIST_R={},{}'.format(_histogram(rng, N_SAMPLES), _histogram(rng, v['ac'])),
+                'GQ_HIST={}'.format(_histogram(rng, N_SAMPLES)), 'GQ_HIST_R={},{}'.format(_histogram(rng, N_SAMPLES), _histogram(rng, v['ac'])),
+                'CADD_RAW={:.3f}'.format(v['cadd'] / 10.0), 'CADD_PHRED={}'.format(v['cadd'])
+            ]
+            info.extend('{}={}'.format(name, value) for name, value in sorted(v['metrics'].items()))
+            info.append('CSQ={}'.format(_annotate(rng, v['gene'], v['pos'], v['alt'], v['rsid'])))
+            ofile.write('chr{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format(CHROM, v['pos'], v['rsid'] or '.', v['ref'], v['alt'], v['qual'], v['filter'], ';'.join(info)))
+    pysam.tabix_index(path, preset = 'vcf', force = True)
+    return path + '.gz'
+
+
+def _write_dbsnp(directory, rng, variants):
+    path = os.path.join(directory, 'dbsnp.tsv')
+    rows = [(int(v['rsid'][2:]), v['pos'] - 1) for v in variants if v['rsid']]
+    # rsIDs of sites that are not in the variants collection, so that searches also fall back to dbSNP
+    rows.extend((10000000 + i, rng.randint(FIRST_GENE_START, variants[-1]['pos'])) for i in range(len(rows) // 4))
+    with open(path, 'w') as ofile:
+        for rsid, pos0 in sorted(rows, key = lambda row: row[1]):
+            ofile.write('{}\tchr{}\t{}\n'.format(rsid, CHROM, pos0))
+    pysam.tabix_index(path, seq_col = 1, start_col = 2, end_col = 2, zerobased = True, force = True)
+    return path + '.gz'
+
+
+def _write_metrics(directory, variants):
+    path = os.path.join(directory, 'metrics.json')
+    with open(path, 'w') as ofile:
+        for name, (value_type, description) in sorted(QUALITY_METRICS.items()):
+            values = sorted(v['metrics'][name] for v in variants)
+            n_pass = sum(1 for v in variants if v['filter'] == 'PASS')
+            percentiles = [{'probability': p / 100.0, 'value': values[min(len(values) - 1, int(p / 100.0 * len(values)))], 'n': len(values), 'n_pass': n_pass} for p in range(101)]
+            ofile.write(json.dumps({'name': name, 'metric': name, 'description': description, 'type': 'percentiles', 'n': len(values), 'n_pass': n_pass, 'min': values[0], 'max': values[-1], 'percentiles': percentiles}) + '\n')
+    return path
+
+
+def _write_coverage(directory, genes, columnar):
+    full_directory = os.path.join(directory, 'full')
+    if not os.path.isdir(full_directory):
+        os.makedirs(full_directory)
+    path = os.path.join(full_directory, '{}.json'.format(CHROM))
+    thresholds = [int(c) for c in columnar_coverage.columns[2:]]
+    with open(path, 'w') as ofile:
+        for gene in genes:
+            for pos in range(gene['start'] - FLANK, gene['stop'] + FLANK + 1):
+                mean = 30 + 8 * math.sin(pos / 700.0) + 4 * math.sin(pos / 53.0)
+                row = {'chrom': CHROM, 'start': pos, 'end': pos, 'mean': round(mean, 2), 'median': int(round(mean))}
+                for threshold in thresholds:
+                    row[str(threshold)] = round(min(1.0, max(0.0, 1.0 - (threshold - mean * 0.5) / (mean * 1.5))), 4)
+                ofile.write('{}\t{}\t{}\n'.format(CHROM, pos, json.dumps(row, separators = (',', ':'))))
+    pysam.tabix_index(path, seq_col = 0, start_col = 1, end_col = 1, force = True)
+    if columnar:
+        store_directory = os.path.join(full_directory, '{}.columnar'.format(CHROM))
+        columnar_coverage.convert(path + '.gz', store_directory)
+        coverage_pyramid.build(store_directory, ZOOM_LEVELS)
+    return full_directory
+
+
+def _write_crams(directory, rng, variants, sequence, reference_path, n_variants_with_reads, reads_per_sample):
+    cram_directory = os.path.join(directory, 'crams')
+    if not os.path.isdir(cram_directory):
+        os.makedirs(cram_directory)
+    snvs = [v for v in variants if len(v['ref']) == 1]
+    with_reads = sorted(rng.sample(snvs, min(n_variants_with_reads, len(snvs))), key = lambda v: v['pos'])
+    reads = []
+    for v in with_reads:
+        # query names encode the variant and the sample, see `SequencesClient.get_samples`
+        for sample_no in range(1, rng.randint(2, 6)):
+            sample = '{}{}'.format('0' if rng.random() < 0.2 else '', sample_no)
+            for k in range(reads_per_sample):
+                start = v['pos'] - 1 - rng.randint(5, READ_LENGTH - 5)
+                read_sequence = list(sequence[start:start + READ_LENGTH])
+                read_sequence[v['pos'] - 1 - start] = v['alt']
+                reads.append((start, '{}:{}:{}:{}:{}'.format(v['pos'], v['ref'], v['alt'], sample, k), ''.join(read_sequence)))
+    reads.sort()
+    path = os.path.join(cram_directory, '{}.cram'.format(CHROM))
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': CHROM, 'LN': len(sequence)}]}
+    with pysam.AlignmentFile(path, 'wc', header = header, reference_filename = reference_path) as ocram:
+        for start, name, read_sequence in reads:
+            read = pysam.AlignedSegment(ocram.header)
+            read.query_name = name
+            read.reference_id = 0
+            read.reference_start = start
+            read.mapping_quality = 60
+            read.cigar = [(0, READ_LENGTH)]
+            read.query_sequence = read_sequence
+            read.query_qualities = pysam.qualitystring_to_array('I' * READ_LENGTH)
+            ocram.write(read)
+    pysam.index(path)
+    return cram_directory, ['{}-{}-{}-{}'.format(CHROM, v['pos'], v['ref'], v['alt']) for v in with_reads]
+
+
+def write_fixtures(directory, n_genes = 40, variants_per_gene = 300, n_variants_with_reads = 50, reads_per_sample = 3, columnar = True, seed = 1):
+    """Writes all fixtures into `directory` and returns a manifest with their paths, which is also saved as `manifest.json`."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    rng = random.Random(seed)
+    genes = _make_genes(rng, n_genes)
+    reference_path = os.path.join(directory, 'reference.fa')
+    sequence = _write_reference(reference_path, rng, FIRST_GENE_START + n_genes * GENE_SPACING + FLANK)
+    gene_models = _write_gene_models(directory, genes)
+    variants = _make_variants(rng, genes, sequence, variants_per_gene)
+    coverage_directory = _write_coverage(os.path.join(directory, 'coverage'), genes, columnar)
+    cram_directory, variants_with_reads = _write_crams(directory, rng, variants, sequence, reference_path, n_variants_with_reads, reads_per_sample)
+    manifest = {
+        'seed': seed, 'n_genes': n_genes, 'n_variants': len(variants), 'columnar_coverage': columnar, 'first_gene_name': genes[0]['gene_name'],
+        'gencode': gene_models['gencode.gtf.gz'], 'canonical_transcripts': gene_models['canonical_transcripts.txt.gz'],
+        'omim': gene_models['omim.tsv.gz'], 'genenames': gene_models['hgnc.tsv.gz'],
+        'variants': _write_variants(directory, rng, variants), 'dbsnp': _write_dbsnp(directory, rng, variants), 'metrics': _write_metrics(directory, variants),
+        'coverage_directory': os.path.dirname(coverage_directory) + os.sep, 'reference': reference_path, 'cram_directory': cram_directory,
+        'variants_with_reads': variants_with_reads
+    }
+    with open(os.path.join(directory, 'manifest.json'), 'w') as ofile:
+        json.dump(manifest, ofile, indent = 1)
+    return manifest
@@ -0,0 +1,229 @@
+"""Weighted request mix and the replay loop.
+
+Every action in `MIX` picks random targets (genes, variants, regions) from the loaded dataset and sends one or more
+requests, each recorded under a route name. Client threads keep one HTTP/1.1 connection per server and run actions
+until the deadline, so results measure server latency rather than connection setup.
+"""
+
+import http.client
+import json
+import random
+import threading
+import time
+import urllib.parse
+
+from benchmarks.variant_subset import COLUMNS, ORDERS
+
+# `Accept-Encoding: identity` keeps responses out of the compressed response cache, so every request runs its view
+HEADERS = {'Accept-Encoding': 'identity', 'Connection': 'keep-alive'}
+FORM_HEADERS = dict(HEADERS, **{'Content-Type': 'application/x-www-form-urlencoded'})
+PAGE_LENGTH = 100
+VARIANT_TABLE_OFFSETS = [0, 0, 0, 100, 1000] # most users never leave the first page
+API_REGION_LENGTH = 40000
+API_REGION_PAGE_SIZE = 100
+API_REGION_MAX_PAGES = 5
+
+
+class Connection(object):
+    """Keep-alive connection to one server; reconnects once when the server closed it."""
+    def __init__(self, base_url):
+        parts = urllib.parse.urlsplit(base_url)
+        self._host, self._port, self.prefix = parts.hostname, parts.port, parts.path.rstrip('/')
+        self._connection = None
+
+    def request(self, method, path, body = None, headers = HEADERS):
+        for attempt in range(2):
+            if self._connection is None:
+                self._connection = http.client.HTTPConnection(self._host, self._port, timeout = 120)
+            try:
+                self._connection.request(method, path, body = body, headers = headers)
+                response = self._connection.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, ConnectionError):
+                self._connection.close()
+                self._connection = None
+                if attempt == 1:
+                    raise
+
+
+class Targets(object):
+    """Genes, variants and regions of the loaded dataset that requests are built from."""
+    def __init__(self, db, variants_with_reads):
+        self.genes = list(db.genes.find({}, projection = {'_id': False, 'gene_id': True, 'gene_name': True, 'chrom': True, 'start': True, 'stop': True, 'xstart': True, 'xstop': True}))
+        for gene in self.genes:
+            gene['n_variants'] = db.variants.count_documents({'xpos': {'$gte': gene['xstart'], '$lte': gene['xstop']}})
+        self.transcripts = [t['transcript_id'] for t in db.transcripts.find({}, projection = {'_id': False, 'transcript_id': True})]
+        self.variants = [v['variant_id'] for v in db.variants.aggregate([{'$sample': {'size': 2000}}, {'$project': {'_id': False, 'variant_id': True}}])]
+        self.variants_with_reads = variants_with_reads
+        self.chrom = self.genes[0]['chrom']
+        self.min_pos = min(gene['start'] for gene in self.genes)
+        self.max_pos = max(gene['stop'] for gene in self.genes)
+
+
+def gene_page(session, rng, targets):
+    gene = rng.choice(targets.genes)
+    session.call('gene_page', 'web', 'GET', '/gene/{}'.format(gene['gene_id']))
+
+
+def variant_page(session, rng, targets):
+    session.call('variant_page', 'web', 'GET', '/variant/{}'.format(rng.choice(targets.variants)))
+
+
+def gene_summary(session, rng, targets):
+    gene = rng.choice(targets.genes)
+    session.call('summary', 'web', 'GET', '/api/summary/gene/{}'.format(gene['gene_id']))
+
+
+def variant_table(session, rng, targets):
+    gene = rng.choice(targets.genes)
+    offset = min(rng.choice(VARIANT_TABLE_OFFSETS), max(0, gene['n_variants'] - PAGE_LENGTH))
+    filter_info = rng.choice([{}, {'filter_value': 'PASS'}, {'filter_value': 'PASS', 'category': 'LoF+Missense'}])
+    form = {'args': json.dumps({'draw': 1, 'columns': COLUMNS, 'order': rng.choice(ORDERS), 'start': offset, 'length': PAGE_LENGTH}), 'filter_info': json.dumps(filter_info)}
+    session.call('variant_table', 'web', 'POST', '/api/variants/gene/{}'.format(gene['gene_id']), urllib.parse.urlencode(form), FORM_HEADERS)
+
+
+def gene_coverage(session, rng, targets):
+    gene = rng.choice(targets.genes)
+    session.call('coverage', 'web', 'GET', '/api/coverage/gene/{}?width={}'.format(gene['gene_id'], rng.choice([600, 1000, 1400])))
+
+
+def region_coverage(session, rng, targets):
+    start = rng.randint(targets.min_pos, targets.max_pos)
+    session.call('coverage', 'web', 'GET', '/api/coverage/region/{}-{}-{}?width=1000'.format(targets.chrom, start, start + rng.choice([200, 5000, 100000])))
+
+
+def autocomplete(session, rng, targets):
+    # users type a few characters of a gene name, or an rsID prefix
+    name = rng.choice(targets.genes)['gene_name'] if rng.random() < 0.9 else 'rs10'
+    session.call('autocomplete', 'web', 'GET', '/api/autocomplete?query={}'.format(urllib.parse.quote(name[:rng.randint(1, len(name))])))
+
+
+def variant_reads(session, rng, targets):
+    if targets.variants_with_reads:
+        session.call('variant_reads', 'web', 'GET', '/variant/{}/reads'.format(rng.choice(targets.variants_with_reads)))
+
+
+def api_region(session, rng, targets):
+    # follows `next` links like `bravo query-region` does
+    start = rng.randint(targets.min_pos, max(targets.min_pos, targets.max_pos - API_REGION_LENGTH))
+    path = '/region?chrom={}&start={}&end={}&limit={}'.format(targets.chrom, start, start + API_REGION_LENGTH, API_REGION_PAGE_SIZE)
+    for _ in range(API_REGION_MAX_PAGES):
+        data = session.call('api_region', 'api', 'GET', path)
+        if data is None:
+            return
+        link_next = json.loads(data.decode('utf-8')).get('next')
+        if not link_next:
+            return
+        parts = urllib.parse.urlsplit(link_next)
+        path = parts.path[len(session.prefix('api')):] + '?' + parts.query
+
+
+def api_gene(session, rng, targets):
+    gene = rng.choice(targets.genes)
+    session.call('api_gene', 'api', 'GET', '/gene?name={}&limit={}'.format(gene['gene_id'], API_REGION_PAGE_SIZE))
+
+
+# (action, weight, server); weights roughly follow what a gene page and a typical API user request
+MIX = [
+    (gene_page, 4, 'web'),
+    (variant_page, 4, 'web'),
+    (gene_summary, 8, 'web'),
+    (variant_table, 16, 'web'),
+    (gene_coverage, 8, 'web'),
+    (region_coverage, 4, 'web'),
+    (autocomplete, 20, 'web'),
+    (variant_reads, 2, 'web'),
+    (api_region, 8, 'api'),
+    (api_gene, 2, 'api'),
+]
+
+
+class Session(object):
+    """One client thread: its connections and the timings it recorded."""
+    def __init__(self, base_urls):
+        self._connections = {server: Connection(base_url) for server, base_url in base_urls.items()}
+        self.timings = {}
+        self.errors = {}
+        self.bytes = {}
+
+    def prefix(self, server):
+        return self._connections[server].prefix
+
+    def call(self, route, server, method, path, body = None, headers = HEADERS):
+        connection = self._connections[server]
+        st = time.time()
+        try:
+            status, data = connection.request(method, connection.prefix + path, body, headers)
+        except (http.client.HTTPException, ConnectionError, OSError):
+            status, data = None, None
+        elapsed = time.time() - st
+        if status != 200:
+            self.errors[route] = self.errors.get(route, 0) + 1
+            return None
+        self.timings.setdefault(route, []).append(elapsed)
+        self.bytes[route] = self.bytes.get(route, 0) + len(data)
+        return data
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))]
+
+
+def summarize(timings, errors, n_bytes, seconds):
+    timings = sorted(timings)
+    return {
+        'requests': len(timings), 'errors': errors, 'rps': round(len(timings) / float(seconds), 2), 'bytes': n_bytes,
+        'mean_ms': round(1000 * sum(timings) / len(timings), 2) if timings else None,
+        'p50_ms': round(1000 * percentile(timings, 0.50), 2) if timings else None,
+        'p95_ms': round(1000 * percentile(timings, 0.95), 2) if timings else None,
+        'p99_ms': round(1000 * percentile(timings, 0.99), 2) if timings else None,
+    }
+
+
+def replay(base_urls, targets, n_clients, seconds, seed, mix = MIX):
+    """Runs `mix` from `n_clients` threads for `seconds` and returns throughput and latency per route and in total."""
+    mix = [(action, weight) for action, weight, server in mix if server in base_urls]
+    actions = [action for action, _ in mix]
+    cumulative_weights = []
+    for _, weight in mix:
+        cumulative_weights.append(weight + (cumulative_weights[-1] if cumulative_weights else 0))
+    sessions = [Session(base_urls) for _ in range(n_clients)]
+    deadline = time.time() + seconds
+    def client(session, rng):
+        while time.time() < deadline:
+            x = rng.uniform(0, cumulative_weights[-1])
+            action = next(a for a, w in zip(actions, cumulative_weights) if x <= w)
+            action(session, rng, targets)
+    threads = [threading.Thread(target = client, args = (session, random.Random(seed * 1000 + i))) for i, session in enumerate(sessions)]
+    st = time.time()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time.time() - st
+    routes = sorted(set(route for session in sessions for route in list(session.timings) + list(session.errors)))
+    result = {'seconds': round(elapsed, 2), 'clients': n_clients, 'routes': {}}
+    for route in routes:
+        result['routes'][route] = summarize(
+            [t for session in sessions for t in session.timings.get(route, [])],
+            sum(session.errors.get(route, 0) for session in sessions),
+            sum(session.bytes.get(route, 0) for session in sessions),
+            elapsed)
+    result['total'] = summarize(
+        [t for session in sessions for timings in session.timings.values() for t in timings],
+        sum(n for session in sessions for n in session.errors.values()),
+        sum(n for session in sessions for n in session.bytes.values()),
+        elapsed)
+    return result
+
+
+def compare(baseline, result):
+    """Rows of (route, metric, baseline, current, change in %) for the routes both runs have."""
+    rows = []
+    for route in sorted(set(baseline['routes']) & set(result['routes'])) + ['total']:
+        before = baseline['total'] if route == 'total' else baseline['routes'][route]
+        after = result['total'] if route == 'total' else result['routes'][route]
+        for metric in ['rps', 'p50_ms', 'p95_ms', 'p99_ms']:
+            if before[metric] and after[metric] is not None:
+                rows.append((route, metric, before[metric], after[metric], round(100.0 * (after[metric] - before[metric]) / before[metric], 1)))
+    return rows
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+"""Latency of the browser variant table query, before and after the single-pass rewrite.
+
+Replays the DataTables requests that `static/plot.js` sends for a gene page (default sort, then a few other
+sort orders and page offsets) against the configured Mongo database, and prints p50/p95 latency for the
+legacy id-grouping pipeline and for `lookups.get_variants_subset_for_intervalset`.
+
+Example:
+    ./benchmarks/variant_subset.py -g TTN -n 20
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import lookups
+import pymongo
+from flask import Config
+from lookups import IntervalSet
+
+argparser = argparse.ArgumentParser(description = 'Benchmarks the variant table query used by gene, transcript and region pages.')
+argparser.add_argument('-g', '--gene', metavar = 'name', required = False, type = str, default = 'TTN', dest = 'gene', help = 'Gene name or Ensembl gene ID to benchmark. Default: TTN.')
+argparser.add_argument('-n', '--repeats', metavar = 'number', required = False, type = int, default = 20, dest = 'repeats', help = 'Number of times to replay every request. Default: 20.')
+argparser.add_argument('-l', '--length', metavar = 'number', required = False, type = int, default = 100, dest = 'length', help = 'Page length. Default: 100.')
+argparser.add_argument('--skip-legacy', action = 'store_true', dest = 'skip_legacy', help = 'Only benchmark the current implementation.')
+
+# same columns (and in the same order) as `variant_table.columns` in static/plot.js
+COLUMNS = [{'name': name} for name in ['allele', 'pos', 'csq', 'cadd_phred', 'filter', 'allele_num', 'het', 'hom_count', 'allele_freq']]
+COLUMN_INDEX = {c['name']: i for i, c in enumerate(COLUMNS)}
+ORDERS = [
+    [{'column': COLUMN_INDEX['csq'], 'dir': 'asc'}, {'column': COLUMN_INDEX['cadd_phred'], 'dir': 'desc'}], # page default
+    [{'column': COLUMN_INDEX['pos'], 'dir': 'asc'}],
+    [{'column': COLUMN_INDEX['allele_freq'], 'dir': 'desc'}],
+    [{'column': COLUMN_INDEX['het'], 'dir': 'desc'}],
+]
+FILTER_INFOS = [{}, {'filter_value': 'PASS'}, {'filter_value': 'PASS', 'category': 'LoF+Missense'}]
+PAGES = [0, 10, 100]
+
+
+def legacy_get_variants_subset_for_intervalset(db, intervalset, columns_to_return, order, filter_info, skip, length):
+    """The pre-rewrite query: `$push` every matching `_id` into one document, then fetch each row separately."""
+    mongo_match, mongo_sort, mongo_projection = lookups.build_variants_subset_query(intervalset, columns_to_return, order, filter_info)
+    v_ids_result = list(db.variants.aggregate([
+        {'$match': {'$and': mongo_match}},
+        {'$project': {key: 1 for key in mongo_sort}},
+        {'$sort': mongo_sort},
+        {'$project': {'_id': 1}},
+        {'$group': {'_id':0, 'count':{'$sum':1}, 'results':{'$push':'$$ROOT'}}},
+        {'$project': {'_id':0, 'count':1, 'ids':{'$slice':['$results',skip,length]}}},
+    ]))
+    if len(v_ids_result) == 0:
+        return {'recordsFiltered': 0, 'recordsTotal': 0, 'data': []}
+    v_ids = [v['_id'] for v in v_ids_result[0]['ids']]
+    variants = [next(db.variants.aggregate([{'$match': {'_id': vid}}, {'$project': mongo_projection}])) for vid in v_ids]
+    return {'recordsFiltered': v_ids_result[0]['count'], 'recordsTotal': v_ids_result[0]['count'], 'data': variants}
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))]
+
+
+def run(db, function, intervalset, repeats, length):
+    timings = []
+    n_rows = 0
+    for _ in range(repeats):
+        for order in ORDERS:
+            for filter_info in FILTER_INFOS:
+                for page in PAGES:
+                    st = time.time()
+                    result = function(db, intervalset, COLUMNS, order, filter_info, skip = page * length, length = length)
+                    timings.append(time.time() - st)
+                    n_rows += len(result['data'])
+    timings.sort()
+    return {'requests': len(timings), 'rows': n_rows, 'p50': percentile(timings, 0.50), 'p95': percentile(timings, 0.95)}
+
+
+if __name__ == '__main__':
+    args = argparser.parse_args()
+
+    config = Config(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    config.from_object('config.default')
+    config.from_pyfile('config.py', silent = True)
+    config.from_envvar('BRAVO_CONFIG_FILE', silent = True)
+
+    db = pymongo.MongoClient(host = config['MONGO']['host'], port = config['MONGO']['port'])[config['MONGO']['name']]
+    gene = lookups.get_gene(db, args.gene) or lookups.get_gene_by_name(db, args.gene)
+    if gene is None:
+        sys.exit('Gene {} was not found.'.format(args.gene))
+    intervalset = IntervalSet.from_gene(db, gene['gene_id'])
+    n_variants = sum(db.variants.count_documents(m) for m in intervalset.to_list_of_mongos())
+    sys.stdout.write('{} ({}): {} interval(s), {:,} bp, {:,} variant(s).\n'.format(gene['gene_name'], gene['gene_id'], len(intervalset.to_obj()['list_of_pairs']), intervalset.get_length(), n_variants))
+
+    implementations = [('single-pass', lookups.get_variants_subset_for_intervalset)]
+    if not args.skip_legacy:
+        implementations.insert(0, ('legacy', legacy_get_variants_subset_for_intervalset))
+    for name, function in implementations:
+        stats = run(db, function, intervalset, args.repeats, args.length)
+        sys.stdout.write('{:<12} requests={:<6} rows={:<8} p50={:.1f}ms p95={:.1f}ms\n'.format(name, stats['requests'], stats['rows'], stats['p50'] * 1000, stats['p95'] * 1000))
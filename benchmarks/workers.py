@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+"""Throughput of the browser with 1, 2, 4, ... gunicorn workers.
+
+Starts `gunicorn --config gunicorn.conf.py exac:app` once per worker count, lets a pool of client threads request
+gene summaries, gene coverage and autocomplete suggestions for random genes for a fixed time, and prints requests
+per second and p50/p95 latency. Requests ask for `Accept-Encoding: identity`, so they are not answered from the
+compressed response cache, and carry no `If-None-Match`, so every request runs its view.
+
+Example:
+    ./benchmarks/workers.py -w 1 2 4 8 -c 32 -t 30
+"""
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import pymongo
+from flask import Config
+
+argparser = argparse.ArgumentParser(description = 'Benchmarks browser throughput for different numbers of gunicorn worker processes.')
+argparser.add_argument('-w', '--workers', metavar = 'number', required = False, type = int, nargs = '+', default = [1, 2, 4], dest = 'workers', help = 'Worker counts to benchmark. Default: 1 2 4.')
+argparser.add_argument('-T', '--threads', metavar = 'number', required = False, type = int, default = 4, dest = 'threads', help = 'Threads per worker. Default: 4.')
+argparser.add_argument('-c', '--clients', metavar = 'number', required = False, type = int, default = 32, dest = 'clients', help = 'Number of concurrent client threads. Default: 32.')
+argparser.add_argument('-t', '--time', metavar = 'seconds', required = False, type = int, default = 30, dest = 'seconds', help = 'Duration of every run. Default: 30.')
+argparser.add_argument('-g', '--genes', metavar = 'number', required = False, type = int, default = 200, dest = 'n_genes', help = 'Number of random genes to request. Default: 200.')
+argparser.add_argument('-p', '--port', metavar = 'number', required = False, type = int, default = 8765, dest = 'port', help = 'Port to start gunicorn on. Default: 8765.')
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))]
+
+
+def get_urls(db, url_prefix, n_genes):
+    genes = list(db.genes.aggregate([{'$sample': {'size': n_genes}}, {'$project': {'_id': False, 'gene_id': True, 'gene_name': True}}]))
+    urls = []
+    for gene in genes:
+        urls.append('{}/api/summary/gene/{}'.format(url_prefix, gene['gene_id']))
+        urls.append('{}/api/coverage/gene/{}?width=1000'.format(url_prefix, gene['gene_id']))
+        urls.append('{}/api/autocomplete?query={}'.format(url_prefix, gene['gene_name'][:3]))
+    return urls
+
+
+def start_server(n_workers, n_threads, port, base_url):
+    env = dict(os.environ, BRAVO_WORKERS = str(n_workers), BRAVO_THREADS = str(n_threads), BRAVO_BIND = '127.0.0.1:{}'.format(port), BRAVO_LOG_LEVEL = 'warning')
+    server = subprocess.Popen(['gunicorn', '--config', 'gunicorn.conf.py', 'exac:app'], cwd = REPO_DIRECTORY, env = env)
+    # the master preloads gene models etc. before forking, which may take a while
+    while True:
+        if server.poll() is not None:
+            sys.exit('gunicorn exited with code {}.'.format(server.returncode))
+        try:
+            urllib.request.urlopen(base_url + '/', timeout = 5).read()
+            return server
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(1)
+
+
+def run(base_url, urls, n_clients, seconds):
+    timings = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.time() + seconds
+    def client():
+        rng = random.Random()
+        while time.time() < deadline:
+            request = urllib.request.Request(base_url + rng.choice(urls), headers = {'Accept-Encoding': 'identity'})
+            st = time.time()
+            try:
+                urllib.request.urlopen(request, timeout = 60).read()
+            except (urllib.error.URLError, ConnectionError):
+                with lock: errors[0] += 1
+                continue
+            with lock: timings.append(time.time() - st)
+    clients = [threading.Thread(target = client) for _ in range(n_clients)]
+    for t in clients: t.start()
+    for t in clients: t.join()
+    timings.sort()
+    return {'requests': len(timings), 'errors': errors[0], 'rps': len(timings) / float(seconds), 'p50': percentile(timings, 0.50), 'p95': percentile(timings, 0.95)}
+
+
+if __name__ == '__main__':
+    args = argparser.parse_args()
+
+    config = Config(REPO_DIRECTORY)
+    config.from_object('config.default')
+    config.from_pyfile('config.py', silent = True)
+    config.from_envvar('BRAVO_CONFIG_FILE', silent = True)
+
+    db = pymongo.MongoClient(host = config['MONGO']['host'], port = config['MONGO']['port'])[config['MONGO']['name']]
+    urls = get_urls(db, config['URL_PREFIX'], args.n_genes)
+    base_url = 'http://127.0.0.1:{}'.format(args.port)
+    sys.stdout.write('{} URL(s), {} client(s), {}s per run, {} thread(s) per worker.\n'.format(len(urls), args.clients, args.seconds, args.threads))
+
+    baseline = None
+    for n_workers in args.workers:
+        server = start_server(n_workers, args.threads, args.port, base_url + config['URL_PREFIX'])
+        try:
+            run(base_url, urls, args.clients, min(5, args.seconds)) # warm up the page cache and per-worker caches
+            stats = run(base_url, urls, args.clients, args.seconds)
+        finally:
+            server.terminate()
+            server.wait()
+        baseline = baseline or stats['rps']
+        sys.stdout.write('workers={:<3} requests={:<7} errors={:<4} rps={:<8.1f} speedup={:<5.2f} p50={:.1f}ms p95={:.1f}ms\n'.format(n_workers, stats['requests'], stats['errors'], stats['rps'], stats['rps'] / baseline if baseline else float('nan'), stats['p50'] * 1000, stats['p95'] * 1000))
@@ -0,0 +1,159 @@
+import gzip
+import io
+import os
+import tempfile
+import threading
+import time
+
+import timing
+from flask import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None # brotli is optional; without it only gzip bodies are cached
+
+
+class CompressedResponseCache(object):
+    '''
+    On-disk cache of compressed JSON response bodies, shared by all worker processes on the host.
+    Keys are ETags (see `utils.make_etag`), which already cover the route, the arguments and the dataset generation, so entries never need invalidation.
+    Every body is stored as `<directory>/<key[:2]>/<key>.<encoding>`, written to a temporary file and renamed, so that workers never read partial bodies.
+    Hits touch the file; when more than a tenth of `max_bytes` was written since the last sweep, the least recently used files are removed until the directory fits into `max_bytes`.
+    An empty `directory` or `max_bytes` of 0 disables the cache.
+    '''
+    ENCODINGS = ['br', 'gzip'] if brotli is not None else ['gzip'] # in the order of preference
+    GZIP_LEVEL = 6 # bodies are compressed once, so higher levels than Flask-Compress uses on the fly are affordable
+    BROTLI_QUALITY = 6
+    STALE_TMP_SECONDS = 3600 # temporary files this old were left by a worker that died while writing them
+
+    def __init__(self, directory, max_bytes, min_size=500):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._min_size = min_size # smaller bodies are not worth a file
+        self._enabled = bool(directory) and max_bytes > 0
+        self._lock = threading.Lock()
+        self._written_since_sweep = max_bytes # sweep after the first write, since other processes may have filled the directory
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        if self._enabled and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _get_path(self, key, encoding):
+        return os.path.join(self._directory, key[:2], '{}.{}'.format(key, encoding))
+
+    def choose_encoding(self, accept_encodings):
+        '''`accept_encodings` is `request.accept_encodings`'''
+        for encoding in self.ENCODINGS:
+            if accept_encodings[encoding] > 0:
+                return encoding
+        return None
+
+    def compress(self, data, encoding):
+        if encoding == 'br':
+            return brotli.compress(data, quality=self.BROTLI_QUALITY)
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=self.GZIP_LEVEL, mtime=0) as gz:
+            gz.write(data)
+        return buf.getvalue()
+
+    def get(self, key, encoding):
+        path = self._get_path(key, encoding)
+        try:
+            with open(path, 'rb') as ifile:
+                body = ifile.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            with self._lock: self._misses += 1
+            return None
+        with self._lock: self._hits += 1
+        return body
+
+    def put(self, key, encoding, data):
+        '''compresses and stores `data`, and returns the compressed body, or None if it could not be stored (e.g. the disk is full)'''
+        with timing.span('compress'):
+            body = self.compress(data, encoding)
+        path = self._get_path(key, encoding)
+        tmp_path = None
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    if not os.path.isdir(os.path.dirname(path)): raise # else another worker created it
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+            with os.fdopen(fd, 'wb') as ofile:
+                ofile.write(body)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            print('## RESPONSE CACHE: could not write {}: {}'.format(path, e)) # never fail a request over the cache
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            return None
+        with self._lock:
+            self._written_since_sweep += len(body)
+            sweep = self._written_since_sweep > self._max_bytes // 10
+            if sweep: self._written_since_sweep = 0
+        if sweep:
+            self._sweep()
+        return body
+
+    def _sweep(self):
+        entries = []
+        now = time.time()
+        for dirpath, dirnames, filenames in os.walk(self._directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                    if filename.startswith('.tmp'):
+                        # other workers are still writing these, unless they are stale
+                        if now - st.st_mtime > self.STALE_TMP_SECONDS: os.remove(path)
+                        continue
+                except OSError:
+                    continue # removed or renamed by another worker
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for mtime, size, path in entries)
+        entries.sort()
+        evictions = 0
+        for mtime, size, path in entries:
+            if total <= self._max_bytes: break
+            try:
+                os.remove(path)
+                evictions += 1
+            except OSError:
+                pass
+            total -= size
+        with self._lock: self._evictions += evictions
+
+    def respond(self, key, accept_encodings, view):
+        '''
+        Returns the response for `key` with a cached compressed body, or calls `view()` (which must return a Response) and caches its body.
+        Only successful JSON responses are cached; everything else is returned as is.
+        '''
+        encoding = self.choose_encoding(accept_encodings) if self._enabled else None
+        if encoding is None:
+            return view()
+        body = self.get(key, encoding)
+        if body is None:
+            response = view()
+            if response.status_code != 200 or response.mimetype != 'application/json' or response.is_streamed:
+                return response
+            data = response.get_data()
+            if len(data) < self._min_size:
+                return response
+            body = self.put(key, encoding, data)
+            if body is None:
+                return response
+        response = Response(body, mimetype='application/json')
+        response.headers['Content-Encoding'] = encoding # Flask-Compress leaves responses with Content-Encoding alone
+        response.vary.add('Accept-Encoding')
+        return response
+
+    def get_stats(self):
+        with self._lock:
+            return {'enabled': self._enabled, 'encodings': self.ENCODINGS if self._enabled else [], 'hits': self._hits, 'misses': self._misses, 'evictions': self._evictions}
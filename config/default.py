@@ -39,6 +39,8 @@ API_COLLECTION_NAME = 'variants'
 API_URL_PREFIX = '/api/' + API_VERSION
 API_PAGE_SIZE = 1000
 API_MAX_REGION = 250000
+API_MAX_BATCH_VARIANTS = 1000       # Maximal number of variant identifiers or rsIDs in one /variants/batch request.
+API_MAX_ANNOTATE_SITES = 100000     # Maximal number of sites in one /annotate request.
 API_REQUESTS_RATE_LIMIT = ['1800/15 minute']
 
 # BRAVO Settings
@@ -53,6 +55,25 @@ IGV_CACHE_COLLECTION = '/igv_cache'
 IGV_CACHE_DIRECTORY = '/data/cache/igv_cache/'
 IGV_CACHE_LIMIT = 1000
 BASE_COVERAGE_DIRECTORY = '/data/coverage/'
+COVERAGE_CACHE_MAX_BYTES = 256 * 1024 * 1024  # Maximal size of serialized coverage kept in memory (per process). 0 disables the cache.
+
+# Cache-Control of read-only JSON responses, which are also served with an ETag (revalidated with `304 Not Modified`).
+# They are `private`, because the browser and the API require login; use 'public, max-age=300' if access is open and a shared cache (e.g. the reverse proxy) should store them.
+CACHE_CONTROL = 'private, max-age=300'
+# Compressed bodies of those responses, stored on disk and shared by all workers of a host. An empty directory disables the cache.
+# Bodies are gzip-compressed, and also brotli-compressed if the `brotli` package is installed.
+RESPONSE_CACHE_DIRECTORY = '/data/cache/response_cache/'
+RESPONSE_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# Per-request timing spans (mongo, coverage, cram, serialization, template, compress), sent in a `Server-Timing` header and aggregated
+# into histograms that `/metrics` (under URL_PREFIX, or API_URL_PREFIX for the API) serves in the Prometheus text format to METRICS_ALLOWED_IP.
+TIMING = False
+METRICS_ALLOWED_IP = ['127.0.0.1']
+# Every worker process writes its histograms here, so that `/metrics` answered by any of them covers all. An empty directory keeps them per process.
+METRICS_DIRECTORY = '/data/cache/metrics/'
+# With TIMING, requests that send more mongo commands than this (often one query per row of a loop) are logged with their most frequent query shapes. 0 disables the log.
+# The slowest query shapes per route, with their query plans, are listed at `/administration/mongo` (in admin mode).
+MONGO_QUERY_BUDGET = 50
 
 # FASTA Data URL Settings.
 FASTA_URL = 'https://<your-bravo-domain>/genomes/hs38DH.fa' # Edit to reflect your URL for your BRAVO application
@@ -5,3 +5,12 @@ docker exec bravo_web_1 /bin/bash -c /deploy/INSTALL.sh -v hg38 -t 8
 
 # Create variants collection in MongoDB.
 docker exec bravo_web_1 python manage.py variants -t 8 -v /data/import_vcf/chr22.TOPMed_freeze5_62784.vcf.gz
+
+# Create per-gene and per-transcript summary counts in MongoDB. Must run after genes and variants are loaded.
+docker exec bravo_web_1 python manage.py summaries -t 8
+
+# Create search terms for the awesomebar (gene symbols, aliases, Ensembl IDs, rsIDs). Must run after genes and variants are loaded.
+docker exec bravo_web_1 python manage.py search_terms
+
+# Create compound indexes for browser and API queries, and check their query plans.
+docker exec bravo_web_1 python manage.py indexes
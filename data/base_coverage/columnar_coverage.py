@@ -0,0 +1,65 @@
+import os
+import gzip
+import json
+import argparse
+import numpy
+from numpy.lib.format import open_memmap
+
+argparser = argparse.ArgumentParser(description = 'Converts JSON coverage (compressed with bgzip/gzip) files, full or pruned, to the columnar coverage store: fixed-width NumPy arrays for every chromosome, which the browser memory-maps and slices without parsing. Rows of every chromosome must be in ascending order.')
+argparser.add_argument('-i', '--in', metavar = 'file', dest = 'in_coverage_file', required = True, help = 'Input JSON coverage (compressed with bgzip/gzip) file.')
+argparser.add_argument('-o', '--out', metavar = 'directory', dest = 'out_directory', required = True, help = 'Output directory, e.g. `full/22.columnar`. Created if it does not exist.')
+
+# value columns, in the order they are stored in `[chrom].values.npy`
+columns = ['mean', 'median', '1', '5', '10', '15', '20', '25', '30', '50', '100']
+
+
+def read_rows(in_coverage_file):
+   with gzip.open(in_coverage_file, 'rt') as iz:
+      for line in iz:
+         fields = line.rstrip('\n').split('\t', 2)
+         yield fields[0], json.loads(fields[2])
+
+
+def count_rows(in_coverage_file):
+   counts = dict()
+   with gzip.open(in_coverage_file, 'rt') as iz:
+      for line in iz:
+         chrom = line.split('\t', 1)[0]
+         counts[chrom] = counts.get(chrom, 0) + 1
+   return counts
+
+
+def convert(in_coverage_file, out_directory):
+   if not os.path.isdir(out_directory):
+      os.makedirs(out_directory)
+   counts = count_rows(in_coverage_file)
+   arrays = dict()
+   for chrom, n in counts.items():
+      arrays[chrom] = {
+         'start': open_memmap(os.path.join(out_directory, '{}.start.npy'.format(chrom)), mode = 'w+', dtype = numpy.int32, shape = (n,)),
+         'end': open_memmap(os.path.join(out_directory, '{}.end.npy'.format(chrom)), mode = 'w+', dtype = numpy.int32, shape = (n,)),
+         'values': open_memmap(os.path.join(out_directory, '{}.values.npy'.format(chrom)), mode = 'w+', dtype = numpy.float32, shape = (n, len(columns))),
+         'chrom': None,
+         'n': 0
+      }
+   for chrom, data in read_rows(in_coverage_file):
+      a = arrays[chrom]
+      i = a['n']
+      if i > 0 and data['start'] <= a['end'][i - 1]:
+         raise Exception('Positions on chromosome {} are not in ascending order at {}!'.format(chrom, data['start']))
+      a['start'][i] = data['start']
+      a['end'][i] = data.get('end', data['start'])
+      a['values'][i] = [data[column] for column in columns]
+      a['chrom'] = data['chrom']
+      a['n'] = i + 1
+   for a in arrays.values():
+      for name in ['start', 'end', 'values']:
+         a[name].flush()
+   with open(os.path.join(out_directory, 'columns.json'), 'w') as ofile:
+      # `chrom` is the value of the JSON field, which may differ from the tabix contig name used for file names
+      json.dump({'columns': columns, 'chroms': {chrom: a['chrom'] for chrom, a in arrays.items()}}, ofile)
+
+
+if __name__ == "__main__":
+   args = argparser.parse_args()
+   convert(args.in_coverage_file, args.out_directory)
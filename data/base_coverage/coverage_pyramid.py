@@ -0,0 +1,87 @@
+import os
+import json
+import argparse
+import numpy
+from numpy.lib.format import open_memmap
+
+argparser = argparse.ArgumentParser(description = 'Adds zoom levels to a columnar coverage store with full (per base-pair) coverage, created by `columnar_coverage.py`. Level K groups bases into bins of 2^K base-pairs and stores mean of every value per bin (bases without coverage count as 0), and min/max of mean and median depths. The other columns keep only their mean per bin. The browser picks the level that gives about one bin per pixel.')
+argparser.add_argument('-d', '--dir', metavar = 'directory', dest = 'store_directory', required = True, help = 'Columnar coverage store with full coverage, e.g. `full/22.columnar`. Zoom levels are written to the same directory.')
+argparser.add_argument('-l', '--levels', metavar = 'number', dest = 'n_levels', type = int, default = 16, help = 'Number of zoom levels, i.e. bins of 2, 4, ..., 2^N base-pairs. Default: 16.')
+
+# min/max per bin are stored for these columns only, as `[column]_min` and `[column]_max`;
+# the fractions of samples above depth thresholds only keep their mean per bin, so zoomed out they don't show single poorly covered bases
+min_max_columns = ['mean', 'median']
+
+
+def get_chunks(starts, n_levels):
+   # splits rows into chunks that never cut a bin of any level, so that every chunk can be aggregated on its own
+   chunk_bp = 1 << max(n_levels, 22)
+   if len(starts) == 0:
+      return
+   for c in range(int(starts[0]) // chunk_bp, int(starts[-1]) // chunk_bp + 1):
+      lo = numpy.searchsorted(starts, c * chunk_bp, side = 'left')
+      hi = numpy.searchsorted(starts, (c + 1) * chunk_bp, side = 'left')
+      if lo < hi:
+         yield lo, hi
+
+
+def get_bins(starts, level):
+   keys = starts >> level
+   first = numpy.flatnonzero(numpy.r_[True, keys[1:] != keys[:-1]])
+   last = numpy.r_[first[1:], len(keys)] - 1
+   return first, last
+
+
+def aggregate(starts, ends, values, level, columns):
+   first, last = get_bins(starts, level)
+   # bases between the first and the last row of a bin that have no row of their own are not covered, so they count as 0, as at full resolution
+   n_bases = (ends[last] - starts[first] + 1).astype(numpy.float64)
+   has_gaps = n_bases > last - first + 1
+   bin_values = numpy.empty((len(first), len(columns) + 2 * len(min_max_columns)), dtype = numpy.float32)
+   bin_values[:, :len(columns)] = numpy.add.reduceat(values.astype(numpy.float64), first, axis = 0) / n_bases[:, None]
+   for i, column in enumerate(min_max_columns):
+      j = columns.index(column)
+      bin_values[:, len(columns) + 2 * i] = numpy.where(has_gaps, 0, numpy.minimum.reduceat(values[:, j], first))
+      bin_values[:, len(columns) + 2 * i + 1] = numpy.maximum.reduceat(values[:, j], first)
+   return starts[first], ends[last], bin_values
+
+
+def build(store_directory, n_levels):
+   with open(os.path.join(store_directory, 'columns.json'), 'r') as ifile:
+      meta = json.load(ifile)
+   columns = meta['columns']
+   level_columns = columns + ['{}_{}'.format(column, suffix) for column in min_max_columns for suffix in ('min', 'max')]
+   levels = list(range(1, n_levels + 1))
+   for chrom in meta['chroms']:
+      starts = numpy.load(os.path.join(store_directory, '{}.start.npy'.format(chrom)), mmap_mode = 'r')
+      ends = numpy.load(os.path.join(store_directory, '{}.end.npy'.format(chrom)), mmap_mode = 'r')
+      values = numpy.load(os.path.join(store_directory, '{}.values.npy'.format(chrom)), mmap_mode = 'r')
+      chunks = list(get_chunks(starts, n_levels))
+      for lo, hi in chunks:
+         if numpy.any(starts[lo:hi] != ends[lo:hi]):
+            raise Exception('Zoom levels can only be built from full coverage, but {} has binned rows!'.format(store_directory))
+      n_bins = {level: sum(len(get_bins(numpy.asarray(starts[lo:hi]), level)[0]) for lo, hi in chunks) for level in levels}
+      for level in levels:
+         out = {
+            'start': open_memmap(os.path.join(store_directory, '{}.L{}.start.npy'.format(chrom, level)), mode = 'w+', dtype = numpy.int32, shape = (n_bins[level],)),
+            'end': open_memmap(os.path.join(store_directory, '{}.L{}.end.npy'.format(chrom, level)), mode = 'w+', dtype = numpy.int32, shape = (n_bins[level],)),
+            'values': open_memmap(os.path.join(store_directory, '{}.L{}.values.npy'.format(chrom, level)), mode = 'w+', dtype = numpy.float32, shape = (n_bins[level], len(level_columns)))
+         }
+         i = 0
+         for lo, hi in chunks:
+            bin_starts, bin_ends, bin_values = aggregate(numpy.asarray(starts[lo:hi]), numpy.asarray(ends[lo:hi]), numpy.asarray(values[lo:hi]), level, columns)
+            out['start'][i:i + len(bin_starts)] = bin_starts
+            out['end'][i:i + len(bin_starts)] = bin_ends
+            out['values'][i:i + len(bin_starts)] = bin_values
+            i += len(bin_starts)
+         for a in out.values():
+            a.flush()
+   meta['levels'] = levels
+   meta['level_columns'] = level_columns
+   with open(os.path.join(store_directory, 'columns.json'), 'w') as ofile:
+      json.dump(meta, ofile)
+
+
+if __name__ == "__main__":
+   args = argparser.parse_args()
+   build(args.store_directory, args.n_levels)
@@ -13,7 +13,6 @@ import random
 import re
 import socket
 import sys
-import time
 import traceback
 from collections import Counter, defaultdict
 from datetime import timedelta
@@ -21,15 +20,17 @@ from ipaddress import AddressValueError, ip_network
 from multiprocessing import Process
 
 import auth
-import boltons.cacheutils
+import bson.json_util
 import lookups
 import pymongo
 import pysam
 import sequences
+import timing
 from base_coverage import CoverageHandler
+from compressed_cache import CompressedResponseCache
 from flask import (Blueprint, Flask, Response, abort, flash, g, jsonify,
                    make_response, redirect, render_template, request,
-                   send_file, session, url_for)
+                   send_file, session, stream_with_context, url_for)
 from flask_compress import Compress
 from flask_errormail import mail_on_500
 from flask_login import (LoginManager, UserMixin, current_user, login_user,
@@ -56,18 +57,26 @@ if app.config['PROXY']: app.wsgi_app = ProxyFix(app.wsgi_app)
 if 'GVS_URL_PREFIX' in os.environ: app.config['URL_PREFIX'] = os.environ['GVS_URL_PREFIX']
 if 'BRAVO_ADMIN_MODE' in os.environ: app.config['ADMIN'] = True if os.environ['BRAVO_ADMIN_MODE'].lower() == 'true' else False
 mail_on_500(app, app.config['ADMINS'])
-app.config['COMPRESS_LEVEL'] = 2 # Since we don't cache, faster=better
+app.config['COMPRESS_LEVEL'] = 2 # Only responses that are not in response_cache get here, so faster=better
 Compress(app)
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 5 # 5 second browser cache timeout
 app.config['TEMPLATES_AUTO_RELOAD'] = True
+timing.init_app(app) # before any MongoClient is created
 
 BASE_COVERAGE = []
 BASE_COVERAGE.extend({'bp-min-length':0,                  'path':path} for path in glob.glob(app.config['BASE_COVERAGE_DIRECTORY'] + 'full/*.json.gz'))
 BASE_COVERAGE.extend({'bp-min-length':300, 'binned':True, 'path':path} for path in glob.glob(app.config['BASE_COVERAGE_DIRECTORY'] + 'bin_25e-2/*.json.gz'))
 BASE_COVERAGE.extend({'bp-min-length':1000,'binned':True, 'path':path} for path in glob.glob(app.config['BASE_COVERAGE_DIRECTORY'] + 'bin_50e-2/*.json.gz'))
 BASE_COVERAGE.extend({'bp-min-length':3000,'binned':True, 'path':path} for path in glob.glob(app.config['BASE_COVERAGE_DIRECTORY'] + 'bin_75e-2/*.json.gz'))
+# Columnar stores built by `data/base_coverage/columnar_coverage.py`. They are listed after the JSON files, so that for the same
+# `bp-min-length` and chrom they are the ones used (SingleChromCoverageHandler takes the last matching file).
+BASE_COVERAGE.extend({'bp-min-length':0,    'columnar':True, 'path':path} for path in glob.glob(app.config['BASE_COVERAGE_DIRECTORY'] + 'full/*.columnar'))
+BASE_COVERAGE.extend({'bp-min-length':300,  'columnar':True, 'path':path} for path in glob.glob(app.config['BASE_COVERAGE_DIRECTORY'] + 'bin_25e-2/*.columnar'))
+BASE_COVERAGE.extend({'bp-min-length':1000, 'columnar':True, 'path':path} for path in glob.glob(app.config['BASE_COVERAGE_DIRECTORY'] + 'bin_50e-2/*.columnar'))
+BASE_COVERAGE.extend({'bp-min-length':3000, 'columnar':True, 'path':path} for path in glob.glob(app.config['BASE_COVERAGE_DIRECTORY'] + 'bin_75e-2/*.columnar'))
 
 MAX_REGION_LENGTH = int(350e3) # Longer than TTN (305kb), short enough to perform okay.
+MAX_COVERAGE_WIDTH = 10000 # pixels
 
 def get_db(new_connection=False):
     # Only use the database within a request context! Something about threads/forks.
@@ -81,16 +90,39 @@ def get_db(new_connection=False):
 
 get_db._mongo_client = pymongo.MongoClient(host=app.config['MONGO']['host'], port=app.config['MONGO']['port'], connect=False)
 sequencesClient = sequences.SequencesClient(app.config['IGV_CRAM_DIRECTORY'], app.config['IGV_REFERENCE_PATH'], app.config['IGV_CACHE_DIRECTORY'], app.config['IGV_CACHE_COLLECTION'], 100)
+response_cache = CompressedResponseCache(app.config['RESPONSE_CACHE_DIRECTORY'], app.config['RESPONSE_CACHE_MAX_BYTES'])
 
-@boltons.cacheutils.cached({})
-def get_autocomplete_strings():
-    autocomplete_strings = get_db().genes.distinct('gene_name')
-    autocomplete_strings.extend(get_db().genes.distinct('other_names', {'other_names': {'$ne': None}}))
-    return sorted(set(autocomplete_strings))
+def get_autocomplete_index():
+    def build():
+        autocomplete_strings = get_db().genes.distinct('gene_name')
+        autocomplete_strings.extend(get_db().genes.distinct('other_names', {'other_names': {'$ne': None}}))
+        return lookups.PrefixIndex(autocomplete_strings)
+    return lookups.dataset_cache.get(get_db(), 'autocomplete_index', build, ['genes'])
 
-@boltons.cacheutils.cached({})
 def get_coverage_handler():
-    return CoverageHandler(BASE_COVERAGE)
+    # built from files only, which it watches itself, so it is never rebuilt (and its cache and mappings are kept) when collections are reloaded
+    return lookups.dataset_cache.get(get_db(), 'coverage_handler', lambda: CoverageHandler(BASE_COVERAGE, cache_max_bytes=app.config['COVERAGE_CACHE_MAX_BYTES']), [])
+
+
+def preload():
+    '''
+    Builds the read-only data that every request needs (gene models, autocomplete index, coverage mappings, ...).
+    gunicorn calls it once before forking workers (see gunicorn.conf.py), so that workers share all of it copy-on-write instead of each building its own.
+    '''
+    db = get_db()
+    lookups.GeneModelIndex.get(db)
+    lookups.get_metrics(db)
+    lookups.has_search_terms(db)
+    get_autocomplete_index()
+    get_coverage_handler().preload()
+
+def init_worker():
+    '''
+    Called in every worker right after the fork (see gunicorn.conf.py).
+    MongoClient is not fork-safe and `preload()` connected the parent's one, so every worker gets its own.
+    pysam handles (tabix and CRAM) need nothing here: `HandlePool` notices the new pid and opens its own.
+    '''
+    get_db._mongo_client = pymongo.MongoClient(host=app.config['MONGO']['host'], port=app.config['MONGO']['port'], connect=False)
 
 
 def require_agreement_to_terms_and_store_destination(func):
@@ -114,6 +146,34 @@ def require_agreement_to_terms_and_store_destination(func):
     return decorated_view
 
 
+def conditional_get(*get_versions):
+    '''
+    Sets a weak ETag, Cache-Control and `Vary: Accept-Encoding` on the response, and answers `304 Not Modified` without calling the view when the client already has it.
+    Other requests are served from `response_cache` (compressed bodies keyed by the ETag) when possible.
+    Responses only change when `manage.py` loads data (which bumps the dataset generation) or when something returned by `get_versions` changes.
+    Place it AFTER @require_agreement_to_terms_and_store_destination, so that a cached response is never a way around the terms.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def decorated_view(*args, **kwargs):
+            etag = make_etag(lookups.dataset_cache.get_generation(get_db()), [get_version() for get_version in get_versions], request.path, sorted(request.args.items(multi=True)))
+            if request.if_none_match.contains_weak(etag): # weak comparison, because a proxy that compresses responses weakens their ETags
+                response = Response(status=304)
+            else:
+                response = response_cache.respond(etag, request.accept_encodings, lambda: make_response(func(*args, **kwargs)))
+                if response.status_code != 200: return response
+            # the body is br, gzip or identity depending on Accept-Encoding, so the ETag is weak and shared caches must key on the encoding
+            response.set_etag(etag, weak=True)
+            response.vary.add('Accept-Encoding')
+            response.headers['Cache-Control'] = app.config['CACHE_CONTROL']
+            return response
+        return decorated_view
+    return decorator
+
+def get_coverage_version():
+    return get_coverage_handler().get_version()
+
+
 def _log(message = ''):
     url = request.full_path.rstrip('?')
     if url.startswith(app.config['URL_PREFIX']): url = url[len(app.config['URL_PREFIX']):]
@@ -134,12 +194,13 @@ def homepage():
 
 
 @bp.route('/api/autocomplete')
+@conditional_get()
 def autocomplete():
     db = get_db()
     query = request.args.get('query', '')
-    suggestions = lookups.get_awesomebar_suggestions(get_autocomplete_strings(), query, db)
+    suggestions = lookups.get_awesomebar_suggestions(get_autocomplete_index(), query, db)
     _log('  =>  {} results'.format(len(suggestions)))
-    return jsonify([{'value': s} for s in sorted(suggestions)])
+    return jsonify([{'value': s} for s in suggestions]) # already ranked: exact and shorter matches first
 
 
 @bp.route('/awesome')
@@ -184,6 +245,36 @@ def administration_page():
         return render_template('administration.html', error = error, success = success)
     except: _err(); abort(500)
 
+@bp.route('/administration/coverage_cache')
+@require_agreement_to_terms_and_store_destination
+def administration_coverage_cache_api():
+    if not current_user.admin:
+        abort(404)
+    return jsonify(get_coverage_handler().get_cache_stats())
+
+@bp.route('/administration/response_cache')
+@require_agreement_to_terms_and_store_destination
+def administration_response_cache_api():
+    if not current_user.admin:
+        abort(404)
+    return jsonify(response_cache.get_stats())
+
+@bp.route('/administration/mongo')
+@require_agreement_to_terms_and_store_destination
+def administration_mongo_api():
+    '''slowest mongo query shapes per route in this worker, with query plans; `?n=20&order=seconds|max_seconds|count&explain=false`'''
+    if not current_user.admin:
+        abort(404)
+    if timing.query_stats is None:
+        return jsonify({'error': 'set TIMING = True to collect mongo query stats'})
+    order = request.args.get('order', 'seconds')
+    if order not in ('seconds', 'max_seconds', 'count'): abort(400)
+    entries = timing.query_stats.get_slowest(request.args.get('n', 20, type=int), order)
+    if request.args.get('explain', 'true') != 'false':
+        for entry in entries:
+            entry['explain'] = timing.explain(get_db().client, entry['database'], entry['command'])
+    return Response(bson.json_util.dumps(entries), mimetype='application/json')
+
 @bp.route('/administration/users', methods = ['POST'])
 @require_agreement_to_terms_and_store_destination
 def administration_users_api():
@@ -221,6 +312,11 @@ def administration_users_api():
     except: _err(); abort(500)
 
 
+@bp.route('/metrics')
+def metrics_page():
+    return timing.metrics_response(app.config['METRICS_ALLOWED_IP'], request.remote_addr)
+
+
 @bp.route('/variant/<variant_id>')
 @require_agreement_to_terms_and_store_destination
 def variant_page(variant_id):
@@ -241,7 +337,8 @@ def variant_page(variant_id):
         gene_for_top_csq, top_HGVSs = ConsequenceDrilldown.get_top_gene_and_HGVSs(consequence_drilldown)
         consequence_drilldown_columns = ConsequenceDrilldown.split_into_two_columns(consequence_drilldown)
 
-        base_coverage = get_coverage_handler().get_coverage_for_intervalset(
+        # embedded in the page as cached, without parsing it back
+        base_coverage_json = get_coverage_handler().get_coverage_json_for_intervalset(
             IntervalSet.from_xstart_xstop(variant['xpos'], variant['xpos']+len(variant['ref'])-1))
 
         metrics = lookups.get_metrics(db)
@@ -252,10 +349,10 @@ def variant_page(variant_id):
         return render_template(
             'variant.html',
             variant=variant,
-            base_coverage=base_coverage,
+            base_coverage_json=base_coverage_json.decode('utf8'),
             consequences=consequence_drilldown,
             consequence_columns=consequence_drilldown_columns,
-            any_covered=bool(base_coverage),
+            any_covered=base_coverage_json != b'[]',
             metrics=metrics,
             top_HGVSs=top_HGVSs,
             gene_for_top_csq=gene_for_top_csq,
@@ -357,30 +454,30 @@ def download_region_variants(chrom, start, stop):
 
 def _get_variants_csv_for_intervalset(intervalset, filename):
     _log()
-    resp = make_response(lookups.get_variants_csv_str_for_intervalset(get_db(), intervalset))
+    resp = Response(stream_with_context(lookups.get_variants_csv_for_intervalset(get_db(), intervalset)), mimetype='text/csv')
     resp.headers['Content-Disposition'] = 'attachment; filename={}'.format(filename)
-    resp.mimetype='text/csv'
     return resp
 
 
 @bp.route('/api/summary/gene/<gene_id>')
 @require_agreement_to_terms_and_store_destination
+@conditional_get()
 def gene_summary_api(gene_id):
     try:
-        intervalset = IntervalSet.from_gene(get_db(), gene_id)
-        return jsonify(lookups.get_summary_for_intervalset(get_db(), intervalset))
+        return jsonify(lookups.get_summary_for_gene(get_db(), gene_id))
     except:_err(); abort(500)
 
 @bp.route('/api/summary/transcript/<transcript_id>')
 @require_agreement_to_terms_and_store_destination
+@conditional_get()
 def transcript_summary_api(transcript_id):
     try:
-        intervalset = IntervalSet.from_transcript(get_db(), transcript_id)
-        return jsonify(lookups.get_summary_for_intervalset(get_db(), intervalset))
+        return jsonify(lookups.get_summary_for_transcript(get_db(), transcript_id))
     except:_err(); abort(500)
 
 @bp.route('/api/summary/region/<chrom>-<start>-<stop>')
 @require_agreement_to_terms_and_store_destination
+@conditional_get()
 def region_summary_api(chrom, start, stop):
     try:
         start,stop = int(start),int(stop); assert stop-start <= MAX_REGION_LENGTH
@@ -420,34 +517,44 @@ def _get_variants_subset_response_for_intervalset(intervalset):
     filter_info = json.loads(request.form['filter_info'])
     _log('   '+str(filter_info))
     ret = lookups.get_variants_subset_for_intervalset(
-        db, intervalset, args['columns'], args['order'], filter_info, skip=args['start'], length=args['length']
+        db, intervalset, args['columns'], args['order'], filter_info, skip=args['start'], length=args['length'],
+        cursor=request.form.get('cursor') or None # continuation token from the previous page; falls back to skipping if unusable
     )
     ret['draw'] = args['draw']
     return jsonify(ret)
 
+def get_coverage_width():
+    # `?width=` is the plot width in pixels; without it, the coverage file is chosen by region length alone
+    width = request.args.get('width', type=int)
+    if width is None or width <= 0: return None
+    return min(width, MAX_COVERAGE_WIDTH)
+
 @bp.route('/api/coverage/gene/<gene_id>')
 @require_agreement_to_terms_and_store_destination
+@conditional_get(get_coverage_version)
 def gene_coverage_api(gene_id):
     try:
         intervalset = IntervalSet.from_gene(get_db(), gene_id)
-        return jsonify(get_coverage_handler().get_coverage_for_intervalset(intervalset))
+        return Response(get_coverage_handler().get_coverage_json_for_intervalset(intervalset, width=get_coverage_width()), mimetype='application/json')
     except:_err(); abort(500)
 
 @bp.route('/api/coverage/transcript/<transcript_id>')
 @require_agreement_to_terms_and_store_destination
+@conditional_get(get_coverage_version)
 def transcript_coverage_api(transcript_id):
     try:
         intervalset = IntervalSet.from_transcript(get_db(), transcript_id)
-        return jsonify(get_coverage_handler().get_coverage_for_intervalset(intervalset))
+        return Response(get_coverage_handler().get_coverage_json_for_intervalset(intervalset, width=get_coverage_width()), mimetype='application/json')
     except:_err(); abort(500)
 
 @bp.route('/api/coverage/region/<chrom>-<start>-<stop>')
 @require_agreement_to_terms_and_store_destination
+@conditional_get(get_coverage_version)
 def region_coverage_api(chrom, start, stop):
     try:
         start,stop = int(start),int(stop); assert stop-start <= MAX_REGION_LENGTH
         intervalset = IntervalSet.from_chrom_start_stop(chrom, start, stop)
-        return jsonify(get_coverage_handler().get_coverage_for_intervalset(intervalset))
+        return Response(get_coverage_handler().get_coverage_json_for_intervalset(intervalset, width=get_coverage_width()), mimetype='application/json')
     except:_err(); abort(500)
 
 @bp.route('/multi_variant_rsid/<rsid>')
@@ -515,9 +622,7 @@ def variant_bams(variant_id):
     db = get_db()
     try:
         _log()
-        start_time = time.time()
         response = sequencesClient.get_samples(db, variant_id)
-        print('Done preparing samples. Took %s seconds' % (time.time() - start_time))
         if response is None:
             response = { 'names': [] }
         return jsonify(response)
@@ -530,10 +635,8 @@ def test_bai(variant_id, sample_id):
     db = get_db()
     try:
         _log()
-        start_time = time.time()
         file_path = sequencesClient.get_bai(db, variant_id, sample_id)
         if file_path is None: _err(); abort(500)
-        print('Done preparing BAM and BAI. Took %s seconds' % (time.time() - start_time))
         return make_response(send_file(file_path, as_attachment = False))
     except: _err(); abort(500)
 
@@ -543,14 +646,12 @@ def test_bai(variant_id, sample_id):
 def test_bam(variant_id, sample_id):
     db = get_db()
     try:
-        start_time = time.time()
         range_header = request.headers.get('Range', None)
         m = re.search('(\d+)-(\d*)', range_header)
         result = sequencesClient.get_bam(db, variant_id, sample_id, m.group(1), m.group(2))
         if result is None: _err(); abort(500)
         response = Response(result['data'], 206, mimetype = "application/octet-stream .bam", direct_passthrough = True)
         response.headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(result['start'], result['end'], result['size'])
-        print('Prepared BAM for sending. Took %s seconds' % (time.time() - start_time))
         return response
     except: _err(); abort(500)
 
@@ -0,0 +1,28 @@
+# gunicorn settings for serving `exac:app` with several worker processes: `gunicorn --config gunicorn.conf.py exac:app`.
+# The app is imported and its read-only data (gene models, autocomplete index, coverage mappings) is built once in the master, before the fork,
+# so that workers share it copy-on-write. Every worker then opens its own Mongo client and pysam handles.
+# pymongo and pysam calls block, so workers are processes with a few threads each rather than gevent greenlets.
+import gc
+import multiprocessing
+import os
+
+bind = os.environ.get('BRAVO_BIND', '0.0.0.0:80')
+workers = int(os.environ.get('BRAVO_WORKERS', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('BRAVO_THREADS', 4))
+timeout = 3000
+loglevel = os.environ.get('BRAVO_LOG_LEVEL', 'debug')
+preload_app = True
+
+
+def when_ready(server):
+    # runs in the master after `exac` was imported (preload_app) and before any worker is forked
+    import exac
+    exac.preload()
+    # objects allocated so far are never collected, so the collector doesn't touch (and copy) their pages in the workers
+    if hasattr(gc, 'freeze'): gc.freeze()
+
+
+def post_fork(server, worker):
+    import exac
+    exac.init_worker()
@@ -1,15 +1,75 @@
-import itertools
+import base64
+import bisect
+import hashlib
 import json
 import re
+import threading
 import time
 
 import boltons.iterutils
+import bson.json_util
+import numpy
 import pymongo
 import pysam
 from utils import *  # TODO: explicitly list
 
 SEARCH_LIMIT = 10000
 
+
+def get_dataset_generations(db):
+    '''returns (generation, {collection: generation}); the first changes with every load, the others only when their collection is reloaded'''
+    meta = db.dataset_meta.find_one({'_id': 'generation'}, projection={'_id': False, 'generation': True, 'collections': True})
+    return (meta.get('generation', 0), meta.get('collections', {})) if meta else (0, {})
+
+def bump_dataset_generation(db, reason, collections):
+    '''called by every `manage.py` loader when it is done, with the collections it (re)wrote, so that running servers rebuild what was built from them (see DatasetCache)'''
+    increments = {'generation': 1}
+    increments.update(('collections.' + name, 1) for name in collections)
+    db.dataset_meta.update_one({'_id': 'generation'}, {'$inc': increments, '$set': {'reason': reason, 'updated': time.time()}}, upsert=True)
+
+
+class DatasetCache(object):
+    '''Per-process cache of static data (metrics, gene models, autocomplete index, ...).
+    Every value is rebuilt lazily once one of the collections it was built from is reloaded, which is checked at most every `check_interval` seconds.
+    Values are built under their own lock, so a slow build only blocks the threads that wait for that value.'''
+    def __init__(self, check_interval=5):
+        self._check_interval = check_interval
+        self._lock = threading.Lock() # guards the dicts below; never held during a query or a build
+        self._generations = {} # db name -> (checked at, generation, {collection: generation})
+        self._values = {} # (db name, name) -> (generations of its collections, value)
+        self._build_locks = {} # (db name, name) -> lock held while the value is built
+    def _get_generations(self, db):
+        with self._lock:
+            entry = self._generations.get(db.name, None)
+        if entry is None or time.time() - entry[0] > self._check_interval:
+            entry = (time.time(),) + get_dataset_generations(db)
+            with self._lock:
+                self._generations[db.name] = entry
+        return entry
+    def get_generation(self, db):
+        '''changes whenever `manage.py` loads anything into `db`'''
+        return self._get_generations(db)[1]
+    def get(self, db, name, build, collections):
+        '''`collections` are the names of the collections that `build` reads; values that read none (e.g. file handles) are built once'''
+        key = (db.name, name)
+        collection_generations = self._get_generations(db)[2]
+        generations = tuple(collection_generations.get(collection, 0) for collection in collections)
+        with self._lock:
+            entry = self._values.get(key, None)
+            if entry is not None and entry[0] == generations: return entry[1]
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+        with build_lock: # building the same value twice at once would be wasteful
+            with self._lock:
+                entry = self._values.get(key, None)
+            if entry is None or entry[0] != generations:
+                if entry is not None: print('## DATASET CACHE: rebuilding {} after {} were reloaded'.format(name, ', '.join(collections)))
+                entry = (generations, build())
+                with self._lock:
+                    self._values[key] = entry
+            return entry[1]
+
+dataset_cache = DatasetCache()
+
 def get_gene(db, gene_id):
     return db.genes.find_one({'gene_id': gene_id}, projection={'_id': False})
 
@@ -70,7 +130,7 @@ def get_variants_by_rsid(db, rsid):
 def get_variants_from_dbsnp(db, rsid):
     if not rsid.startswith('rs') or not rsid[2:].isdigit():
         return None
-    position = db.dbsnp.find_one({'rsid': rsid})
+    position = db.dbsnp.find_one({'rsid': int(rsid[2:])}) # `manage.py dbsnp` stores the number only
     if position:
         variants = list(db.variants.find({'xpos': {'$lte': position['xpos'], '$gte': position['xpos']}}, projection={'_id': False}))
         if variants:
@@ -79,29 +139,49 @@ def get_variants_from_dbsnp(db, rsid):
             return variants
     return []
 
-#@boltons.cacheutils.cached({})
-
-def get_awesomebar_suggestions(autocomplete_strings, query, db):
+class PrefixIndex(object):
+    '''Case-insensitive prefix search over a fixed set of strings (gene names and aliases), shortest matches first.'''
+    def __init__(self, strings):
+        # one sorted list of case-folded strings per length, so that the shortest matches are found without scanning longer ones
+        by_length = {}
+        for string in set(strings):
+            by_length.setdefault(len(string), []).append((string.casefold(), string))
+        self._lengths = sorted(by_length)
+        self._keys, self._strings = {}, {}
+        for length, pairs in by_length.items():
+            pairs.sort()
+            self._keys[length] = [key for key, _ in pairs]
+            self._strings[length] = [string for _, string in pairs]
+    def search(self, query, cap):
+        query = query.casefold()
+        results = []
+        for length in self._lengths[bisect.bisect_left(self._lengths, len(query)):]:
+            keys = self._keys[length]
+            i = bisect.bisect_left(keys, query)
+            while i < len(keys) and keys[i].startswith(query):
+                results.append(self._strings[length][i])
+                if len(results) >= cap: return results
+                i += 1
+        return results
+
+
+def get_awesomebar_suggestions(autocomplete_index, query, db):
     cap = 10
     rs_max_length = 9999999999
 
     # first look for genes, genes have priority over rsIds (e.g. there is a gene RS1)
-    regex = re.compile('^' + re.escape(query), re.IGNORECASE)
-    results = (r for r in autocomplete_strings if regex.match(r))
-    results = list(itertools.islice(results, 0, cap))
+    results = autocomplete_index.search(query, cap) if query else []
 
     try:
         if len(results) < cap and query.startswith('rs'): # if query starts with "rs" and there is still place for autocomplete dropdown, look for rsIds.
             rs_numeric = int(query[2:]) if len(query) > 2 else 0
-            results.extend('rs{}'.format(x['rsid']) for x  in db.dbsnp.find({ 'rsid': { '$eq': rs_numeric }}, projection = { '_id': False, 'rsid': True }).limit(cap - len(results)))
-            step = 10
-            while len(results) < cap:
-                rs_numeric_lo = rs_numeric * step
-                rs_numeric_up = rs_numeric_lo + step - 1
-                if rs_numeric_up > rs_max_length:
-                    break
-                results.extend('rs{}'.format(x['rsid']) for x  in db.dbsnp.find({ 'rsid': { '$gte': rs_numeric_lo, '$lte': rs_numeric_up }}, projection = { '_id': False, 'rsid': True }).limit(cap - len(results)))
+            # rsIds starting with these digits are rs_numeric itself, then rs_numeric*10..rs_numeric*10+9, rs_numeric*100..rs_numeric*100+99 and so on,
+            # so sorting by rsid also ranks exact and shorter rsIds first
+            ranges, step = [{'rsid': rs_numeric}], 10
+            while rs_numeric * step + step - 1 <= rs_max_length:
+                ranges.append({'rsid': {'$gte': rs_numeric * step, '$lte': rs_numeric * step + step - 1}})
                 step *= 10
+            results.extend('rs{}'.format(x['rsid']) for x in db.dbsnp.find({'$or': ranges}, projection = { '_id': False, 'rsid': True }).sort('rsid', pymongo.ASCENDING).limit(cap - len(results)))
     except ValueError:
         pass
     return results
@@ -117,11 +197,37 @@ _regex_chr = re.compile(_regex_pattern_chr+'$')
 _regex_chr_pos = re.compile(_regex_pattern_chr_pos+'$')
 _regex_chr_start_end = re.compile(_regex_pattern_chr_start_end+'$')
 _regex_chr_pos_ref_alt = re.compile(_regex_pattern_chr_pos_ref_alt+'$')
+_regex_rsid = re.compile(r'^rs\d+$', re.IGNORECASE)
+
+
+# lower wins when one term has several targets (see `manage.py search_terms`)
+SEARCH_TERM_PRIORITIES = {'rsid': 0, 'gene_name': 1, 'other_names': 2, 'gene_id': 3, 'transcript_id': 4}
+
+def has_search_terms(db):
+    '''whether `manage.py search_terms` was run'''
+    return dataset_cache.get(db, 'has_search_terms', lambda: db.search_terms.find_one({}, projection={'_id': True}) is not None, ['search_terms'])
 
 
 def get_awesomebar_result(db, query):
     query = query.strip() # TODO:check if query is not None
 
+    if has_search_terms(db):
+        # gene symbols, aliases, Ensembl IDs and rsIDs of loaded variants in one indexed lookup
+        term = db.search_terms.find_one({'term': query.upper()}, projection={'_id': False, 'type': True, 'args': True}, sort=[('priority', pymongo.ASCENDING)])
+        # an rsID resolves to its variants before any gene named like it (e.g. gene RS1), so a gene term only wins when dbSNP has nothing
+        if term and (term['type'] in ['variant', 'multi_variant_rsid'] or not _regex_rsid.match(query)):
+            return term['type'], term['args']
+        # rsIDs that are in dbSNP but not in `rsids` of any variant
+        variants = get_variants_from_dbsnp(db, query.lower())
+        if variants:
+            if len(variants) == 1:
+                return 'variant', {'variant_id': variants[0]['variant_id']}
+            else:
+                return 'multi_variant_rsid', {'rsid': query.lower()}
+        if term:
+            return term['type'], term['args']
+        return get_awesomebar_result_for_coordinates(query.upper())
+
     # rsid
     variants = get_variants_by_rsid(db, query.lower())
     if variants:
@@ -165,6 +271,10 @@ def get_awesomebar_result(db, query):
         if transcript:
             return 'transcript', {'transcript_id': transcript['transcript_id']}
 
+    return get_awesomebar_result_for_coordinates(query)
+
+
+def get_awesomebar_result_for_coordinates(query):
     # Region (chrom , chrom-pos , chrom-start-stop) or Variant (chrom-pos-ref-alt)
     match = _regex_chr.match(query) or _regex_chr_pos.match(query) or _regex_chr_start_end.match(query) or _regex_chr_pos_ref_alt.match(query)
     if match is not None:
@@ -183,6 +293,92 @@ def get_awesomebar_result(db, query):
     return 'not_found', {'message': 'The search for {} returned no results.'.format(query)}
 
 
+class GeneModelIndex(object):
+    '''Genes, transcripts and exons (CDS, UTR and exon features) of one database, held in memory by every process.
+    Built from the `genes`, `transcripts` and `exons` collections on first use, and again after `manage.py genes` (see DatasetCache).'''
+    FEATURE_TYPES = ['exon', 'CDS', 'UTR']
+    STRANDS = ['+', '-']
+
+    @classmethod
+    def get(cls, db):
+        return dataset_cache.get(db, 'gene_models', lambda: cls(db), ['genes', 'transcripts', 'exons'])
+
+    def __init__(self, db):
+        st = time.time()
+        self._genes = {gene['gene_id']: (gene['gene_name'], gene.get('canonical_transcript')) for gene in db.genes.find({}, projection={'_id': False, 'gene_id': True, 'gene_name': True, 'canonical_transcript': True})}
+        transcripts = {transcript['transcript_id']: (transcript['start'], transcript['stop']) for transcript in db.transcripts.find({}, projection={'_id': False, 'transcript_id': True, 'start': True, 'stop': True})}
+        columns = {key: [] for key in ['gene_id', 'transcript_id', 'chrom', 'start', 'stop', 'feature_type', 'strand']}
+        for exon in db.exons.find({'feature_type': {'$in': self.FEATURE_TYPES}}, projection={'_id': False, 'gene_id': True, 'transcript_id': True, 'chrom': True, 'start': True, 'stop': True, 'feature_type': True, 'strand': True}):
+            for key, values in columns.items(): values.append(exon[key])
+
+        # transcripts are numbered so that transcripts of a gene are consecutive, and exons are sorted by (transcript, start)
+        self._transcript_ids = sorted(set(zip(columns['gene_id'], columns['transcript_id'])))
+        self._gene_ids = sorted(set(gene_id for gene_id, _ in self._transcript_ids))
+        self._transcript_idx = {transcript_id: i for i, (_, transcript_id) in enumerate(self._transcript_ids)}
+        self._gene_idx = {gene_id: i for i, gene_id in enumerate(self._gene_ids)}
+        self._chroms = sorted(set(columns['chrom']))
+        chrom_idx = {chrom: i for i, chrom in enumerate(self._chroms)}
+        exon_transcript = numpy.array([self._transcript_idx[transcript_id] for transcript_id in columns['transcript_id']], dtype=numpy.int32)
+        exon_start = numpy.array(columns['start'], dtype=numpy.int32)
+        order = numpy.lexsort((exon_start, exon_transcript))
+        self._exon_transcript = exon_transcript[order]
+        self._exon_start = exon_start[order]
+        self._exon_stop = numpy.array(columns['stop'], dtype=numpy.int32)[order]
+        self._exon_chrom = numpy.array([chrom_idx[chrom] for chrom in columns['chrom']], dtype=numpy.int8)[order]
+        self._exon_feature_type = numpy.array([self.FEATURE_TYPES.index(x) for x in columns['feature_type']], dtype=numpy.int8)[order]
+        self._exon_strand = numpy.array([self.STRANDS.index(x) for x in columns['strand']], dtype=numpy.int8)[order]
+        # exons of transcript i are rows [transcript_first_exon[i], transcript_first_exon[i+1])
+        self._transcript_first_exon = numpy.searchsorted(self._exon_transcript, numpy.arange(len(self._transcript_ids) + 1))
+        # transcripts of gene i are [gene_first_transcript[i], gene_first_transcript[i+1])
+        transcript_gene = numpy.array([self._gene_idx[gene_id] for gene_id, _ in self._transcript_ids], dtype=numpy.int32)
+        self._gene_first_transcript = numpy.searchsorted(transcript_gene, numpy.arange(len(self._gene_ids) + 1))
+        # a transcript missing from the `transcripts` collection spans its own exons
+        self._transcript_start = numpy.array([transcripts[transcript_id][0] if transcript_id in transcripts else self._exon_start[self._transcript_first_exon[i]] for i, (_, transcript_id) in enumerate(self._transcript_ids)], dtype=numpy.int32)
+        self._transcript_stop = numpy.array([transcripts[transcript_id][1] if transcript_id in transcripts else self._exon_stop[self._transcript_first_exon[i]:self._transcript_first_exon[i+1]].max() for i, (_, transcript_id) in enumerate(self._transcript_ids)], dtype=numpy.int32)
+        # for overlap queries: per chrom, exon rows sorted by start, and the running maximum of their stops
+        self._by_chrom = {}
+        for i, chrom in enumerate(self._chroms):
+            rows = numpy.flatnonzero(self._exon_chrom == i)
+            rows = rows[numpy.argsort(self._exon_start[rows], kind='stable')]
+            self._by_chrom[chrom] = (rows, self._exon_start[rows], numpy.maximum.accumulate(self._exon_stop[rows]))
+
+        n_bytes = sum(a.nbytes for a in [self._exon_transcript, self._exon_start, self._exon_stop, self._exon_chrom, self._exon_feature_type, self._exon_strand, self._transcript_first_exon, self._gene_first_transcript, self._transcript_start, self._transcript_stop])
+        n_bytes += sum(a.nbytes for arrays in self._by_chrom.values() for a in arrays)
+        print('## GENE MODELS: indexed {} genes, {} transcripts and {} exons in {:.3f} seconds ({:.1f} MB of arrays)'.format(
+            len(self._gene_ids), len(self._transcript_ids), len(self._exon_start), time.time()-st, n_bytes / 1e6))
+
+    def _exon(self, row):
+        transcript_idx = self._exon_transcript[row]
+        gene_id, transcript_id = self._transcript_ids[transcript_idx]
+        return {
+            'gene_id': gene_id, 'transcript_id': transcript_id, 'chrom': self._chroms[self._exon_chrom[row]],
+            'start': int(self._exon_start[row]), 'stop': int(self._exon_stop[row]),
+            'feature_type': self.FEATURE_TYPES[self._exon_feature_type[row]], 'strand': self.STRANDS[self._exon_strand[row]],
+        }
+    def get_exons_for_gene(self, gene_id):
+        i = self._gene_idx.get(gene_id, None)
+        if i is None: return []
+        rows = range(self._transcript_first_exon[self._gene_first_transcript[i]], self._transcript_first_exon[self._gene_first_transcript[i+1]])
+        return [self._exon(row) for row in rows]
+    def get_exons_for_transcript(self, transcript_id):
+        i = self._transcript_idx.get(transcript_id, None)
+        if i is None: return []
+        return [self._exon(row) for row in range(self._transcript_first_exon[i], self._transcript_first_exon[i+1])]
+    def get_exons_overlapping(self, chrom, start, stop):
+        if chrom.startswith('chr'): chrom = chrom[3:]
+        if chrom not in self._by_chrom: return []
+        rows, starts, max_stops = self._by_chrom[chrom]
+        # rows before `lo` all stop before `start`, rows from `hi` on all start after `stop`
+        lo = numpy.searchsorted(max_stops, start, side='left')
+        hi = numpy.searchsorted(starts, stop, side='right')
+        return [self._exon(row) for row in rows[lo:hi] if self._exon_stop[row] >= start]
+    def get_transcript_start_stop(self, transcript_id):
+        i = self._transcript_idx[transcript_id]
+        return int(self._transcript_start[i]), int(self._transcript_stop[i])
+    def get_gene_name_and_canonical_transcript(self, gene_id):
+        return self._genes.get(gene_id, (None, None))
+
+
 class IntervalSet(object):
     EXON_PADDING = 20
 
@@ -203,12 +399,10 @@ class IntervalSet(object):
         return cls(chrom1, [[start, stop]])
     @classmethod
     def from_gene(cls, db, gene_id):
-        exons = db.exons.find({'gene_id': gene_id, 'feature_type': { "$in": ['CDS', 'UTR', 'exon'] }}, projection={'_id': False})
-        return cls._from_exons(exons)
+        return cls._from_exons(GeneModelIndex.get(db).get_exons_for_gene(gene_id))
     @classmethod
     def from_transcript(cls, db, transcript_id):
-        exons = db.exons.find({'transcript_id': transcript_id, 'feature_type': { "$in": ['CDS', 'UTR', 'exon'] }}, projection={'_id': False})
-        return cls._from_exons(exons)
+        return cls._from_exons(GeneModelIndex.get(db).get_exons_for_transcript(transcript_id))
     @classmethod
     def _from_exons(cls, exons):
         # note: these "exons" are not all literally exons, some are CDS or UTR features
@@ -224,7 +418,7 @@ class IntervalSet(object):
         for exon in exons:
             assert exon['start'] <= exon['stop'] # There are some exons with start==stop, which I don't understand
             start, stop = exon['start']-cls.EXON_PADDING, exon['stop']+cls.EXON_PADDING
-            if not regions or regions[-1][1] <= start:
+            if not regions or regions[-1][1] < start: # regions never share a base, so per-region counts add up
                 regions.append([start, stop])
             elif regions[-1][1] < stop:
                 regions[-1][1] = stop
@@ -253,25 +447,24 @@ class TranscriptSet(object):
         self.genes = genes
     @classmethod
     def from_gene(cls, db, gene_id):
-        all_exons = list(db.exons.find({'gene_id': gene_id}, {'_id':False}))
-        return cls._from_exons(db, all_exons)
+        index = GeneModelIndex.get(db)
+        return cls._from_exons(index, index.get_exons_for_gene(gene_id))
     @classmethod
     def from_transcript(cls, db, transcript_id):
-        all_exons = list(db.exons.find({'transcript_id': transcript_id}, {'_id':False}))
-        return cls._from_exons(db, all_exons)
+        index = GeneModelIndex.get(db)
+        return cls._from_exons(index, index.get_exons_for_transcript(transcript_id))
     @classmethod
     def from_chrom_start_stop(cls, db, chrom, start, stop):
-        xstart,xstop = Xpos.from_chrom_pos(chrom,start),Xpos.from_chrom_pos(chrom,stop)
-        all_exons = list(db.exons.find({'xstop':{'$gte':xstart},'xstart':{'$lte':xstop}}, {'_id':False}))
-        return cls._from_exons(db, all_exons)
+        index = GeneModelIndex.get(db)
+        return cls._from_exons(index, index.get_exons_overlapping(chrom, start, stop))
     @classmethod
-    def _from_exons(cls, db, all_exons):
+    def _from_exons(cls, index, all_exons):
         '''return is like [{gene_name:'PCSK9', gene_id:'ENSG123', transcripts:[{transcript_id:'ENST234',start,stop,exons:[{start,stop,strand,feature_type}]}]}]'''
         for exon in all_exons: assert exon['feature_type'] in ['exon', 'CDS', 'UTR'] and exon['strand'] in ['+','-']
         all_transcripts = []
         for transcript_id, exons in sortedgroupby(all_exons, key=lambda exon:exon['transcript_id']):
             exons = sorted(exons, key=lambda exon:exon['start'])
-            transcript = db.transcripts.find_one({'transcript_id':transcript_id})
+            transcript_start, transcript_stop = index.get_transcript_start_stop(transcript_id)
             gene_id = exons[0]['gene_id']
             exons = [{key: exon[key] for key in ['feature_type','strand','start','stop']} for exon in exons]
             weight = 0 # 10 * CDS length + UTR length + exon length + 1e10 * canonical
@@ -280,14 +473,12 @@ class TranscriptSet(object):
                 weight += length * {'CDS':10, 'UTR':1, 'exon':1}[exon['feature_type']]
             all_transcripts.append({
                 'gene_id':gene_id,'transcript_id':transcript_id,
-                'start':transcript['start'],'stop':transcript['stop'],
+                'start':transcript_start,'stop':transcript_stop,
                 'exons':exons,'weight':weight
             })
         genes = []
         for gene_id, transcripts in sortedgroupby(all_transcripts, key=lambda trans:trans['gene_id']):
-            gene = get_gene(db, gene_id)
-            gene_name = gene['gene_name'] if gene else None
-            canonical_transcript_id = gene.get('canonical_transcript') if gene else None
+            gene_name, canonical_transcript_id = index.get_gene_name_and_canonical_transcript(gene_id)
             transcripts = list(transcripts)
             for transcript in transcripts:
                 if transcript['transcript_id'] == canonical_transcript_id:
@@ -308,11 +499,7 @@ class TranscriptSet(object):
 
 
 def get_metrics(db):
-    metrics = []
-    cursor = db.metrics.find({'type': 'percentiles'}, projection = {'_id': False})
-    for document in cursor:
-        metrics.append(document)
-    return metrics
+    return dataset_cache.get(db, 'metrics', lambda: list(db.metrics.find({'type': 'percentiles'}, projection = {'_id': False})), ['metrics'])
 
 
 def remove_some_extraneous_information(variant):
@@ -321,21 +508,18 @@ def remove_some_extraneous_information(variant):
 
 
 
-def get_summary_for_intervalset(db, intervalset):
+SUMMARY_KEYS = 'lof lof_lc mis syn indel total'.split()
+
+def get_summary_counts_for_intervalset(db, intervalset):
     # Note: querying for each extent in intervalset.to_list_of_mongos() is >100X faster than using intervalset.to_mongo() and I have no idea why. Try query planner?
-    st = time.time()
     mongo_match_cond = {
         'lof': {'$lt': ['$worst_csqidx', Consequence.as_obj['n_lof']]},
-        'lof_lc': {'$and': [
-            {'$lt': ['$worst_csqidx', Consequence.as_obj['n_lof']]},
-            {'$in':[{'k':"LoF",'v':"LC"},{'$objectToArray':{'$arrayElemAt':["$vep_annotations",0]}}]} # this is gross but I couldn't find a better way.
-        ]},
+        'lof_lc': {'$and': [{'$lt': ['$worst_csqidx', Consequence.as_obj['n_lof']]}, '$worst_csq_lof_lc']},
         'mis': {'$and': [{'$gte': ['$worst_csqidx', Consequence.as_obj['n_lof']]},     {'$lt':['$worst_csqidx', Consequence.as_obj['n_lof_mis']]}]},
         'syn': {'$and': [{'$gte': ['$worst_csqidx', Consequence.as_obj['n_lof_mis']]}, {'$lt':['$worst_csqidx', Consequence.as_obj['n_lof_mis_syn']]}]},
         'indel': {'$or': [{'$ne': [1, {'$strLenBytes':'$ref'}]}, {'$ne': [1, {'$strLenBytes':'$alt'}]}]},
     }
-    keys = 'lof lof_lc mis syn indel total'.split()
-    ret = {key:0 for key in keys}
+    ret = {key:0 for key in SUMMARY_KEYS}
     for mongo_match_region in intervalset.to_list_of_mongos():
         x = db.variants.aggregate([
             {'$match': mkdict(mongo_match_region, {'filter':'PASS'})},
@@ -352,25 +536,37 @@ def get_summary_for_intervalset(db, intervalset):
         x = list(x);
         if len(x) == 0: continue # no variants in interval
         assert len(x) == 1; x = x[0]
-        for key in keys: ret[key] += x.get(key,0)
-    print('## SUMMARY: spent {:0.3f} seconds tabulating {} variants'.format(time.time() - st, ret['total']))
+        for key in SUMMARY_KEYS: ret[key] += x.get(key,0)
+    return ret
+
+def _summary_counts_to_table(counts):
     return [
-        ('All - SNPs', ret['total'] - ret['indel']),
-        ('All - Indels', ret['indel']),
-        ('Coding - LoF', ret['lof']),
-        ('Coding - LoF - Low Confidence', ret['lof_lc']),
-        ('Coding - Missense', ret['mis']),
-        ('Coding - Synonymous', ret['syn']),
+        ('All - SNPs', counts['total'] - counts['indel']),
+        ('All - Indels', counts['indel']),
+        ('Coding - LoF', counts['lof']),
+        ('Coding - LoF - Low Confidence', counts['lof_lc']),
+        ('Coding - Missense', counts['mis']),
+        ('Coding - Synonymous', counts['syn']),
     ]
 
+def get_summary_for_intervalset(db, intervalset):
+    counts = get_summary_counts_for_intervalset(db, intervalset)
+    return _summary_counts_to_table(counts)
+
+def get_summary_for_gene(db, gene_id):
+    # `summaries` is built by `manage.py summaries`; if it is missing (or stale and dropped by a reload), count live.
+    summary = db.summaries.find_one({'gene_id': gene_id}, projection={'_id': False})
+    if summary is not None: return _summary_counts_to_table(summary)
+    return get_summary_for_intervalset(db, IntervalSet.from_gene(db, gene_id))
 
-def get_variants_subset_for_intervalset(db, intervalset, columns_to_return, order, filter_info, skip, length):
-    # 1. match what the user asked for - using [intervalset, filter_info]
-    # 2. project to just keys for sorting, sort, and get `_id`s - using [order]
-    # 3. get `n_filtered` and `length`-many `_id`s - using [skip, length]
-    # 4. look up those `_id`s and project - using [columns_to_return]
-    st = time.time()
+def get_summary_for_transcript(db, transcript_id):
+    summary = db.summaries.find_one({'transcript_id': transcript_id}, projection={'_id': False})
+    if summary is not None: return _summary_counts_to_table(summary)
+    return get_summary_for_intervalset(db, IntervalSet.from_transcript(db, transcript_id))
 
+
+def build_variants_subset_query(intervalset, columns_to_return, order, filter_info):
+    '''returns (mongo_match, mongo_sort, mongo_projection) for a DataTables request'''
     mongo_match = [intervalset.to_mongo()]
     if filter_info.get('filter_value',None) is not None:
         if filter_info['filter_value'] == 'PASS': mongo_match.append({'filter': 'PASS'})
@@ -387,20 +583,19 @@ def get_variants_subset_for_intervalset(db, intervalset, columns_to_return, orde
 
     cols = {
         # after pre-processing, these will look like:
-        # <name>: {'sort': {'project': <projection>, 'sort_key': <key>}, 'return': {'project': <projection>}}
+        # <name>: {'sort': <key>, 'return': {'project': <projection>}}
         # <name>: {'sort': False, 'return': {'project': <projection>}}
         'allele': {'return': ['rsids', 'ref', 'alt']},
         'pos': {'sort': 'xpos'},
         'csq': {'sort': 'worst_csqidx', 'return':{'project': {
             'worst_csqidx':1,
             'HGVS':'$worst_csq_HGVS',
-            'low_conf': {'$in':[{'k':"LoF",'v':"LC"},{'$objectToArray':{'$arrayElemAt':["$vep_annotations",0]}}]}, # Gross, but I don't know a better way.
+            'low_conf': '$worst_csq_lof_lc',
         }}},
         'filter': {},
         'allele_count': {'sort': True},
         'allele_num': {'sort': True},
-        'het': {'sort': {'project': {'het': {'$subtract':['$allele_count',{'$multiply':[2,'$hom_count']}]}}, 'sort_key': 'het'},
-                'return': {'project': {'het': {'$subtract':['$allele_count',{'$multiply':[2,'$hom_count']}]}}}},
+        'het': {'sort': 'het_count', 'return': {'project': {'het': '$het_count'}}},
         'hom_count': {'sort': True},
         'allele_freq': {'sort': True},
         'cadd_phred': {'sort': True},
@@ -409,8 +604,7 @@ def get_variants_subset_for_intervalset(db, intervalset, columns_to_return, orde
         try:
             if 'sort' not in col: col['sort'] = False
             if col['sort'] == True: col['sort'] = name
-            if isinstance(col['sort'], str): col['sort'] = {'project': {col['sort']:1}, 'sort_key':col['sort']}
-            assert col['sort'] == False or isinstance(col['sort']['project'], dict) and isinstance(col['sort']['sort_key'], str)
+            assert col['sort'] == False or isinstance(col['sort'], str)
             if 'return' not in col: col['return'] = [name]
             if isinstance(col['return'], list): col['return'] = {'project': {k:1 for k in col['return']}}
             assert isinstance(col['return']['project'], dict)
@@ -418,60 +612,112 @@ def get_variants_subset_for_intervalset(db, intervalset, columns_to_return, orde
             print('COL = ', col)
             raise
 
-    mongo_projection_before_sort = {}
     mongo_sort = OrderedDict()
     for order_item in order:
         direction = {'asc': pymongo.ASCENDING, 'desc':pymongo.DESCENDING}[order_item['dir']]
         colidx = order_item['column']; colname = columns_to_return[colidx]['name']; col = cols[colname]
-        mongo_projection_before_sort.update(col['sort']['project'])
-        mongo_sort[col['sort']['sort_key']] = direction
+        assert col['sort'], colname
+        mongo_sort[col['sort']] = direction
 
     mongo_projection = mkdict(*[cols[ctr['name']]['return']['project'] for ctr in columns_to_return], _id=False)
+    return mongo_match, mongo_sort, mongo_projection
+
 
-    v_ids_curs = db.variants.aggregate([
-        {'$match': {'$and': mongo_match}},
-        {'$project': mongo_projection_before_sort},
-        {'$sort': mongo_sort},
-        {'$project': {'_id': 1}},
-        {'$group': {'_id':0, 'count':{'$sum':1}, 'results':{'$push':'$$ROOT'}}},
-        {'$project': {'_id':0, 'count':1, 'ids':{'$slice':['$results',skip,length]}}},
-    ])
-    print('## VARIANT_SUBSET: spent {:.3f} seconds creating cursor'.format(time.time()-st)); st = time.time()
-    v_ids_result = list(v_ids_curs)
-    if len(v_ids_result) == 0:
-        n_filtered, variants = 0, []
+def _encode_variants_cursor(signature, start, count, last_variant, mongo_sort):
+    # opaque to the browser; it only has to hand it back with the request for page `start`
+    cursor = {'sig': signature, 'start': start, 'count': count, 'last': [last_variant.get('_sort', {}).get(key) if key != '_id' else last_variant['_id'] for key in mongo_sort]}
+    return base64.urlsafe_b64encode(bson.json_util.dumps(cursor).encode()).decode()
+
+def _decode_variants_cursor(token, signature, start, mongo_sort):
+    # returns None for any cursor we can't use (malformed, different query/sort order, different page), so the caller falls back to `$skip`
+    try:
+        cursor = bson.json_util.loads(base64.urlsafe_b64decode(token.encode()).decode())
+        if cursor['sig'] != signature or cursor['start'] != start or len(cursor['last']) != len(mongo_sort): return None
+        assert isinstance(cursor['count'], int)
+        return cursor
+    except Exception:
+        return None
+
+def _get_mongo_match_after(mongo_sort, last_values):
+    # keyset condition "comes after `last_values` in `mongo_sort` order", ie: (k1 after v1) or (k1 == v1 and k2 after v2) or ...
+    # mongo sorts null/missing before everything else, but `$gt`/`$lt` never match across types, so nulls are spelled out.
+    mongo_or = []
+    equal_so_far = []
+    for (key, direction), value in zip(mongo_sort.items(), last_values):
+        if direction == pymongo.ASCENDING:
+            after = {key: {'$ne': None}} if value is None else {key: {'$gt': value}}
+        else:
+            after = None if value is None else {'$or': [{key: {'$lt': value}}, {key: None}]}
+        if after is not None: mongo_or.append({'$and': equal_so_far + [after]})
+        equal_so_far = equal_so_far + [{key: value}]
+    return {'$or': mongo_or} if mongo_or else {'_id': {'$exists': False}}
+
+def get_variants_subset_for_intervalset(db, intervalset, columns_to_return, order, filter_info, skip, length, cursor=None):
+    # 1. match what the user asked for - using [intervalset, filter_info]
+    # 2. count everything that matched (one `count` command per interval), unless `cursor` already carries the count
+    # 3. sort, skip and limit - using [order, skip, length]
+    #    with a valid `cursor`, keyset-match past the last row of the previous page instead of skipping, so page N costs the same as page 1
+    # 4. project the page - using [columns_to_return]
+    # Steps 3 and 4 are a single aggregation, so the page costs one round trip no matter how many rows it has.
+
+    mongo_match, mongo_sort, mongo_projection = build_variants_subset_query(intervalset, columns_to_return, order, filter_info)
+    mongo_sort['_id'] = pymongo.ASCENDING # tie-breaker, so that pages never overlap
+    signature = hashlib.sha1(bson.json_util.dumps([mongo_match, list(mongo_sort.items())]).encode()).hexdigest()
+    if cursor is not None: cursor = _decode_variants_cursor(cursor, signature, skip, mongo_sort)
+
+    if cursor is not None:
+        n_filtered = cursor['count']
     else:
-        assert len(v_ids_result) == 1
-        n_filtered = v_ids_result[0]['count']
-        print('## VARIANT_SUBSET: spent {:0.3f} seconds counting {} variants that match filters'.format(time.time()-st, n_filtered)); st = time.time()
-        v_ids = [v['_id'] for v in v_ids_result[0]['ids']]
-        variants = [next(db.variants.aggregate([{'$match': {'_id': vid}}, {'$project': mongo_projection}])) for vid in v_ids] # b/c fancy projections require .aggregate()
-        print('## VARIANT_SUBSET: spent {:0.3f} seconds fetching {} full variants by id'.format(time.time()-st, len(variants))); st = time.time()
+        # one count per interval, like get_summary_counts_for_intervalset: each is an index range scan, where the `$or` of all intervals is not
+        n_filtered = sum(db.variants.count_documents({'$and': [mongo_match_region] + mongo_match[1:]}) for mongo_match_region in intervalset.to_list_of_mongos())
+
+    variants = []
+    next_cursor = None
+    if n_filtered > skip:
+        if cursor is not None: mongo_match = mongo_match + [_get_mongo_match_after(mongo_sort, cursor['last'])]
+        mongo_pipeline = [{'$match': {'$and': mongo_match}}, {'$sort': mongo_sort}] # `$sort` followed by `$skip`+`$limit` is coalesced into a top-k sort by mongo
+        if cursor is None: mongo_pipeline.append({'$skip': skip})
+        mongo_projection_sort_keys = {key: '$'+key for key in mongo_sort if key != '_id'} # carried along for the next cursor
+        mongo_pipeline.extend([{'$limit': length}, {'$project': mkdict(mongo_projection, {'_id': True}, {'_sort': mongo_projection_sort_keys} if mongo_projection_sort_keys else {})}])
+        variants = list(db.variants.aggregate(mongo_pipeline, allowDiskUse=True))
+        if len(variants) == length and skip + length < n_filtered:
+            next_cursor = _encode_variants_cursor(signature, skip + length, n_filtered, variants[-1], mongo_sort)
+        for variant in variants:
+            variant.pop('_id'); variant.pop('_sort', None)
 
     return {
         'recordsFiltered': n_filtered,
         'recordsTotal': n_filtered,
-        'data': variants
+        'data': variants,
+        'next_cursor': next_cursor,
     }
 
 
-def get_variants_csv_str_for_intervalset(db, intervalset):
+CSV_FIELDS = 'chrom pos ref alt rsids filter genes allele_num allele_count allele_freq hom_count site_quality quality_metrics.DP cadd_phred'.split()
+
+def get_variants_csv_for_intervalset(db, intervalset, rows_per_chunk=1000):
+    """Yields the CSV header, then the rows in chunks of `rows_per_chunk`, so that a download starts right away and never holds the whole file in memory"""
     import io, csv
-    out = io.BytesIO()
+    out = io.StringIO()
     writer = csv.writer(out)
-    fields = 'chrom pos ref alt rsids filter genes allele_num allele_count allele_freq hom_count site_quality quality_metrics.DP cadd_phred'.split()
-    writer.writerow(fields)
-    variants = get_variants_in_intervalset(db, intervalset)
-    for v in variants:
+    writer.writerow(CSV_FIELDS)
+    yield out.getvalue() # before the query runs, so the client gets its first bytes even when the first rows are slow to come
+    out.seek(0); out.truncate()
+    projection = mkdict({field: True for field in CSV_FIELDS}, _id=False)
+    for i, v in enumerate(get_variants_in_intervalset(db, intervalset, projection=projection), 1):
         row = []
-        for field in fields:
+        for field in CSV_FIELDS:
             if '.' in field: parts = field.split('.', 1); row.append(v.get(parts[0], {}).get(parts[1], ''))
             elif field in ['rsids','genes']: row.append('|'.join(v.get(field, [])))
             else: row.append(v.get(field, ''))
         writer.writerow(row)
-    return out.getvalue()
-def get_variants_in_intervalset(db, intervalset):
+        if i % rows_per_chunk == 0:
+            yield out.getvalue()
+            out.seek(0); out.truncate()
+    if out.tell(): yield out.getvalue()
+def get_variants_in_intervalset(db, intervalset, projection=None):
     """Variants that overlap an intervalset"""
+    if projection is None: projection = {'_id': False}
     for mongo_match_region in intervalset.to_list_of_mongos():
-        for variant in db.variants.find(mongo_match_region, projection={'_id': False}):
+        for variant in db.variants.find(mongo_match_region, projection=projection):
             yield variant
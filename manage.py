@@ -7,15 +7,23 @@ import gzip
 import json
 import multiprocessing
 import os
+import queue
+import struct
 import sys
+import threading
 import time
 from itertools import chain, islice
 
+import bson
+import lookups
 import parsing
 import pymongo
 import pysam
 import sequences
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
 from flask import Config
+from utils import Xpos
 
 argparser = argparse.ArgumentParser(description = 'Tool for creating and populating Bravo database.')
 argparser_subparsers = argparser.add_subparsers(help = '', dest = 'command')
@@ -34,6 +42,7 @@ argparser_whitelist.add_argument('-w', '--whitelist', metavar = 'file', required
 argparser_dbsnp = argparser_subparsers.add_parser('dbsnp', help = 'Creates and populates MongoDB collection with dbSNP variants.')
 argparser_dbsnp.add_argument('-d', '--dbsnp', metavar = 'file', required = True, type = str, nargs = '+', dest = 'dbsnp_files', help = 'File (or multiple files split by chromosome) with variants from dbSNP, compressed using bgzip and indexed using tabix. File must have three tab-delimited columns without header: integer part of rsId, chromosome, position (0-based).')
 argparser_dbsnp.add_argument('-t', '--threads', metavar = 'number', required = False, type = int, default = 1, dest = 'threads', help = 'Number of threads to use.')
+argparser_dbsnp.add_argument('-s', '--staging-dir', metavar = 'directory', required = False, type = str, default = None, dest = 'staging_directory', help = 'Stage parsed chunks as BSON files in this directory and insert them from there. Rerunning with the same directory and unchanged input files resumes an interrupted load instead of starting over.')
 
 argparser_metrics = argparser_subparsers.add_parser('metrics', help = 'Creates and populates MongoDB collection with pre-calculated metrics across all variants.')
 argparser_metrics.add_argument('-m', '--metrics', metavar = 'file', required = True, type = str, dest = 'metrics_file', help = 'File with the pre-calculated metrics across all variants. Every metric must be stored on a separate line in JSON format.')
@@ -41,6 +50,17 @@ argparser_metrics.add_argument('-m', '--metrics', metavar = 'file', required = T
 argparser_variants = argparser_subparsers.add_parser('variants', help = 'Creates and populates MongoDB collection for variants.')
 argparser_variants.add_argument('-v', '--variants', metavar = 'file', required = True, type = str, nargs = '+', dest = 'variants_files', help = 'VCF/BCF file (or multiple files split by chromosome) with variants, compressed using bgzip and indexed using tabix.')
 argparser_variants.add_argument('-t', '--threads', metavar = 'number', required = True, type = int, default = 1, dest = 'threads', help = 'Number of thrads to use.')
+argparser_variants.add_argument('-s', '--staging-dir', metavar = 'directory', required = False, type = str, default = None, dest = 'staging_directory', help = 'Stage parsed chunks as BSON files in this directory and insert them from there. Rerunning with the same directory and unchanged input files resumes an interrupted load instead of starting over.')
+
+argparser_summaries = argparser_subparsers.add_parser('summaries', help = 'Creates and populates MongoDB collection with pre-computed PASS variant counts (LoF, LoF-LC, missense, synonymous, indels, total) for every gene and transcript. Run after loading genes and variants.')
+argparser_summaries.add_argument('-t', '--threads', metavar = 'number', required = False, type = int, default = 1, dest = 'threads', help = 'Number of threads to use.')
+
+argparser_search_terms = argparser_subparsers.add_parser('search_terms', help = 'Creates and populates MongoDB collection that maps gene symbols, aliases, Ensembl gene and transcript IDs and rsIDs to search results. Run after loading genes and variants.')
+
+argparser_indexes = argparser_subparsers.add_parser('indexes', help = 'Creates compound indexes for the query shapes used by the browser and the API, and prints query plan summaries for a set of representative queries. Run after loading genes and variants.')
+argparser_indexes.add_argument('-n', '--name', metavar = 'name', required = False, type = str, default = 'variants', dest = 'collection_name', help = 'MongoDB variants collection name. Default: variants.')
+argparser_indexes.add_argument('-g', '--gene', metavar = 'name', required = False, type = str, default = 'TTN', dest = 'gene_name', help = 'Gene used to build the representative queries. Default: TTN.')
+argparser_indexes.add_argument('--explain-only', action = 'store_true', dest = 'explain_only', help = 'Only print query plan summaries, do not create indexes.')
 
 argparser_bamcache = argparser_subparsers.add_parser('bam_cache', help = 'Creates MongoDB collection for storing paths to cached BAM\CRAM files for the IGV browser.')
 
@@ -48,6 +68,7 @@ argparser_custom_variants = argparser_subparsers.add_parser('custom_variants', h
 argparser_custom_variants.add_argument('-v', '--variants', metavar = 'file', required = True, type = str, nargs = '+', dest = 'variants_files', help = 'VCF/BCF file (or multiple files split by chromosome) with variants, compressed using bgzip and indexed using tabix.')
 argparser_custom_variants.add_argument('-n', '--name', metavar = 'name', required = True, type = str, dest = 'collection_name', help = 'MongoDB destination collection name.')
 argparser_custom_variants.add_argument('-t', '--threads', metavar = 'number', required = True, type = int, default = 1, dest = 'threads', help = 'Number of thrads to use.')
+argparser_custom_variants.add_argument('-s', '--staging-dir', metavar = 'directory', required = False, type = str, default = None, dest = 'staging_directory', help = 'Stage parsed chunks as BSON files in this directory and insert them from there. Rerunning with the same directory and unchanged input files resumes an interrupted load instead of starting over.')
 
 
 argparser_percentiles = argparser_subparsers.add_parser('percentiles', help = 'Loads percentiles for each variant from INFO field in the provided VCF. Percentiles in the INFO field must have \'_P\' suffix and store two comma separated values: lower bound and upper bound.')
@@ -78,6 +99,8 @@ def load_gene_models(canonical_transcripts_file, omim_file, genenames_file, genc
     db.genes.drop()
     db.transcripts.drop()
     db.exons.drop()
+    db.summaries.drop() # summaries are computed over the old gene models
+    db.search_terms.drop() # search terms point to the old gene models
 
     canonical_transcripts = dict()
     with gzip.GzipFile(canonical_transcripts_file, 'r') as ifile:
@@ -118,6 +141,7 @@ def load_gene_models(canonical_transcripts_file, omim_file, genenames_file, genc
         db.exons.insert_many(exon for exon in parsing.get_regions_from_gencode_gtf(ifile, {'exon', 'CDS', 'UTR'}))
     db.exons.create_indexes([pymongo.operations.IndexModel(key) for key in ['exon_id', 'transcript_id', 'gene_id']])
     sys.stdout.write('Inserted {} exon(s).\n'.format(db.exons.count_documents({})))
+    lookups.bump_dataset_generation(db, 'genes', ['genes', 'transcripts', 'exons', 'summaries', 'search_terms'])
 
 
 def create_users():
@@ -160,28 +184,277 @@ def get_file_contig_pairs(files):
     return sorted(file_contig_pairs, key = lambda x: x[1]) # stable sort to make same chromsome entries adjacent
 
 
-def _write_to_collection(args, collection, reader, histograms = True):
-    file, chrom = args
-    if chrom != 'PAR':
-        db = get_db_connection()
-        documents = reader(file, chrom, None, None, histograms)
+CHUNKS_PER_THREAD = 4 # more chunks than workers, so that small chunks fill the gaps left by large ones at the end
+MIN_CHUNK_BYTES = 8 * 1024 * 1024 # of compressed data; smaller chunks save little and every chunk re-reads the header and the index
+
+
+def get_file_contig_chunks(files, threads):
+    """Splits every (file, chrom) pair into genomic chunks with about the same amount of compressed data, using the tabix/CSI index.
+
+    Returns [(file, chrom, start, stop, size), ...], largest first, so that a pool working through them in order finishes with the small ones.
+    A chunk owns the documents at 1-based positions `start` <= pos < `stop` (None for the start/end of the chrom); `size` is its estimated number of compressed bytes.
+    Pairs without an index are one chunk. With one thread chroms are not split.
+
+    Arguments:
+    files -- list of one or more tabix'ed files.
+    threads -- number of worker processes.
+    """
+    file_contig_pairs = [(file, chrom) for file, chrom in get_file_contig_pairs(files) if chrom != 'PAR']
+    offsets = {file: parsing.get_index_offsets(file) or {} for file in files}
+    total_size = sum(end_offset - points[0][1] for file in files for points, end_offset in offsets[file].values() if points)
+    chunk_size = max(MIN_CHUNK_BYTES, total_size // (threads * CHUNKS_PER_THREAD)) if threads > 1 else float('inf')
+    chunks = []
+    for file, chrom in file_contig_pairs:
+        points, end_offset = offsets[file].get(chrom, ([], 0))
+        if not points:
+            chunks.append((file, chrom, None, None, 0))
+            continue
+        start, start_offset = None, points[0][1]
+        for position, offset in points[1:]:
+            if offset - start_offset >= chunk_size:
+                chunks.append((file, chrom, start, position + 1, offset - start_offset)) # 0-based start of the bin -> 1-based position
+                start, start_offset = position + 1, offset
+        chunks.append((file, chrom, start, None, end_offset - start_offset))
+    return sorted(chunks, key = lambda x: x[4], reverse = True)
+
+
+def _write_to_collection(chunk, collection, reader, histograms = True):
+    file, chrom, start, stop, size = chunk
+    start_time = time.time()
+    db = get_db_connection()
+    # Index bins are coarse, and files differ in how they count positions (e.g. 0-based dbSNP positions indexed as 1-based), so the fetched
+    # region is padded and only documents owned by this chunk are kept. This also keeps variants whose VCF record starts in the previous chunk but
+    # whose minimal representation starts in this one, and drops the records that start in the previous chunk but overlap this one.
+    documents = reader(file, chrom, max(0, start - 2) if start is not None else None, stop, histograms)
+    if start is not None or stop is not None:
+        documents = (d for d in documents if (start is None or Xpos.to_pos(d['xpos']) >= start) and (stop is None or Xpos.to_pos(d['xpos']) < stop))
+    n_documents = 0
+    for document in documents:
+        batch = list(chain([document], islice(documents, 99999))) # insert in chunks of 100000 documents
+        db[collection].insert_many(batch)
+        n_documents += len(batch)
+    return os.getpid(), file, chrom, start, stop, n_documents, time.time() - start_time
+
+
+def _report_workers(workers):
+    for pid, (n_chunks, n_documents, seconds) in sorted(workers.items()):
+        sys.stdout.write('Worker {}: {} chunk(s), {} document(s) in {:.1f} second(s), {:.0f} document(s) per second.\n'.format(pid, n_chunks, n_documents, seconds, n_documents / seconds if seconds > 0 else 0))
+
+
+def _write_chunks_to_collection(files, threads, collection, reader, histograms = True, drop_collections = (), staging_directory = None):
+    """Loads `files` into `collection` with `threads` worker processes, chunk by chunk (see `get_file_contig_chunks`).
+
+    Arguments:
+    drop_collections -- collections to drop before loading (usually `collection` and anything computed from it). Kept when a staged load is resumed.
+    staging_directory -- if given, loads through BSON files in this directory, and resumes a previous load into it (see `_write_staged_chunks_to_collection`).
+    """
+    if staging_directory is not None:
+        _write_staged_chunks_to_collection(files, threads, collection, reader, histograms, drop_collections, staging_directory)
+        return
+    db = get_db_connection()
+    for name in drop_collections:
+        db[name].drop()
+    chunks = get_file_contig_chunks(files, threads)
+    sys.stdout.write('Loading {} chunk(s) from {} file(s).\n'.format(len(chunks), len(files)))
+    workers = {}
+    with contextlib.closing(multiprocessing.Pool(threads)) as threads_pool:
+        # chunksize = 1 keeps the largest-first order
+        for pid, file, chrom, start, stop, n_documents, seconds in threads_pool.imap_unordered(functools.partial(_write_to_collection, collection = collection, reader = reader, histograms = histograms), chunks, 1):
+            sys.stdout.write('{} {}:{}-{}. Inserted {} document(s) in {:.1f} second(s).\n'.format(os.path.basename(file), chrom, start or 1, stop - 1 if stop else 'end', n_documents, seconds))
+            worker = workers.setdefault(pid, [0, 0, 0.0])
+            worker[0] += 1
+            worker[1] += n_documents
+            worker[2] += seconds
+    _report_workers(workers)
+
+
+STAGING_MANIFEST = 'manifest.json'
+STAGED_QUEUE_SIZE = 4 # parsed chunks that may wait for insertion; bounds the disk space used by staging
+STAGED_BATCH_SIZE = 10000 # documents per insert_many
+
+
+def _get_staged_chunk_path(staging_directory, chunk_id):
+    return os.path.join(staging_directory, 'chunk-{:06d}.bson'.format(chunk_id))
+
+
+def _get_staged_id(created, chunk_id, n):
+    # the same document gets the same _id every time its chunk is parsed, so re-inserting a partially inserted chunk only hits duplicate keys
+    return bson.ObjectId(struct.pack('>III', created, chunk_id, n))
+
+
+def _stage_chunk(args, reader, histograms):
+    chunk_id, file, chrom, start, stop, created, path = args
+    start_time = time.time()
+    documents = reader(file, chrom, max(0, start - 2) if start is not None else None, stop, histograms) # padded and filtered as in `_write_to_collection`
+    n_documents = 0
+    with open(path + '.tmp', 'wb') as ofile:
+        for document in documents:
+            pos = Xpos.to_pos(document['xpos'])
+            if (start is not None and pos < start) or (stop is not None and pos >= stop):
+                continue
+            document['_id'] = _get_staged_id(created, chunk_id, n_documents)
+            ofile.write(bson.BSON.encode(document))
+            n_documents += 1
+    os.rename(path + '.tmp', path)
+    return os.getpid(), chunk_id, n_documents, time.time() - start_time
+
+
+def _insert_staged_chunk(db, collection, path):
+    n_inserted = 0
+    with open(path, 'rb') as ifile:
+        documents = bson.decode_file_iter(ifile, CodecOptions(document_class = RawBSONDocument)) # inserted as they are, without decoding
         for document in documents:
-            db[collection].insert_many(chain([document], islice(documents, 99999))) # insert in chunks of 100000 documents
+            batch = list(chain([document], islice(documents, STAGED_BATCH_SIZE - 1)))
+            try:
+                n_inserted += len(db[collection].insert_many(batch, ordered = False).inserted_ids)
+            except pymongo.errors.BulkWriteError as e:
+                if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                    raise
+                n_inserted += e.details['nInserted'] # the rest was inserted before an interruption
+    return n_inserted
 
 
-def load_dbsnp(dbsnp_files, threads):
+def _get_file_signatures(files):
+    return [[os.path.abspath(file), os.path.getsize(file), os.path.getmtime(file)] for file in files]
+
+
+def _write_staging_manifest(staging_directory, manifest):
+    path = os.path.join(staging_directory, STAGING_MANIFEST)
+    with open(path + '.tmp', 'w') as ofile:
+        json.dump(manifest, ofile, indent = 1)
+    os.rename(path + '.tmp', path)
+
+
+def _write_staged_chunks_to_collection(files, threads, collection, reader, histograms, drop_collections, staging_directory):
+    """Staged and resumable version of `_write_chunks_to_collection`.
+
+    Worker processes parse chunks into BSON files in `staging_directory`, while a thread of this process bulk-inserts finished files (unordered) and removes them.
+    At most `threads` + STAGED_QUEUE_SIZE chunks are parsed ahead of insertion.
+    `manifest.json` records the chunks and which of them were parsed and inserted. If it describes the same database, collection and (unchanged) files,
+    and the collection still exists, the load is resumed: nothing is dropped, inserted chunks are skipped and parsed ones are only inserted.
+    Otherwise the collections are dropped and the load starts from scratch. The manifest is removed once every chunk is inserted, so that a later
+    load into the same directory starts from scratch too.
+    """
+    db = get_db_connection()
+    if not os.path.isdir(staging_directory):
+        os.makedirs(staging_directory)
+    manifest = None
+    try:
+        with open(os.path.join(staging_directory, STAGING_MANIFEST)) as ifile:
+            manifest = json.load(ifile)
+    except (IOError, ValueError):
+        pass
+    database = [mongo_host, mongo_port, mongo_db_name]
+    if manifest is not None and manifest.get('database') == database and manifest['collection'] == collection and manifest['files'] == _get_file_signatures(files) and manifest['histograms'] == histograms:
+        n_inserted = sum(1 for chunk in manifest['chunks'] if chunk['inserted'])
+        if n_inserted > 0 and collection not in db.list_collection_names():
+            sys.stdout.write('Collection {} was dropped since the load in {} was interrupted. Starting from scratch.\n'.format(collection, staging_directory))
+            manifest = None
+        else:
+            sys.stdout.write('Resuming the load in {}: {} of {} chunk(s) already inserted.\n'.format(staging_directory, n_inserted, len(manifest['chunks'])))
+    else:
+        manifest = None
+    if manifest is None:
+        for name in drop_collections:
+            db[name].drop()
+        for filename in os.listdir(staging_directory):
+            if filename.startswith('chunk-'):
+                os.remove(os.path.join(staging_directory, filename))
+        chunks = get_file_contig_chunks(files, threads)
+        manifest = {
+            'database': database, 'collection': collection, 'files': _get_file_signatures(files), 'histograms': histograms, 'created': int(time.time()),
+            'chunks': [{'id': i, 'file': file, 'chrom': chrom, 'start': start, 'stop': stop, 'size': size, 'parsed': None, 'inserted': False} for i, (file, chrom, start, stop, size) in enumerate(chunks)]
+        }
+        _write_staging_manifest(staging_directory, manifest)
+        sys.stdout.write('Staging {} chunk(s) from {} file(s) in {}.\n'.format(len(chunks), len(files), staging_directory))
+
+    manifest_lock = threading.Lock()
+    slots = threading.BoundedSemaphore(threads + STAGED_QUEUE_SIZE)
+    parsed = queue.Queue() # chunk ids ready for insertion; None when no more will come
+    failures = []
+    workers = {}
+
+    def update_chunk(chunk_id, **values):
+        with manifest_lock:
+            manifest['chunks'][chunk_id].update(values)
+            _write_staging_manifest(staging_directory, manifest)
+
+    def insert():
+        while True:
+            chunk_id = parsed.get()
+            if chunk_id is None: break
+            try:
+                if not failures:
+                    start_time = time.time()
+                    path = _get_staged_chunk_path(staging_directory, chunk_id)
+                    n_inserted = _insert_staged_chunk(db, collection, path)
+                    update_chunk(chunk_id, inserted = True)
+                    os.remove(path)
+                    chunk = manifest['chunks'][chunk_id]
+                    sys.stdout.write('{} {}:{}-{}. Inserted {} document(s) in {:.1f} second(s).\n'.format(os.path.basename(chunk['file']), chunk['chrom'], chunk['start'] or 1, chunk['stop'] - 1 if chunk['stop'] else 'end', n_inserted, time.time() - start_time))
+            except Exception as e:
+                failures.append(e)
+            slots.release()
+
+    def on_parsed(result):
+        # runs in the pool's result thread, which must not die: its chunk's slot would never be released
+        try:
+            pid, chunk_id, n_documents, seconds = result
+            worker = workers.setdefault(pid, [0, 0, 0.0])
+            worker[0] += 1
+            worker[1] += n_documents
+            worker[2] += seconds
+            update_chunk(chunk_id, parsed = n_documents)
+        except Exception as e:
+            failures.append(e)
+            slots.release()
+        else:
+            parsed.put(chunk_id)
+
+    def on_error(e):
+        failures.append(e)
+        slots.release()
+
+    with contextlib.closing(multiprocessing.Pool(threads)) as threads_pool:
+        inserter = threading.Thread(target = insert) # started after the pool forked its workers
+        inserter.start()
+        try:
+            stage_chunk = functools.partial(_stage_chunk, reader = reader, histograms = histograms)
+            for chunk in manifest['chunks']: # largest first
+                if chunk['inserted']: continue
+                slots.acquire()
+                if failures:
+                    slots.release()
+                    break
+                if chunk['parsed'] is not None and os.path.exists(_get_staged_chunk_path(staging_directory, chunk['id'])):
+                    parsed.put(chunk['id'])
+                    continue
+                args = (chunk['id'], chunk['file'], chunk['chrom'], chunk['start'], chunk['stop'], manifest['created'], _get_staged_chunk_path(staging_directory, chunk['id']))
+                threads_pool.apply_async(stage_chunk, (args,), callback = on_parsed, error_callback = on_error)
+            for _ in range(threads + STAGED_QUEUE_SIZE): # wait until every chunk was parsed and inserted
+                slots.acquire()
+        finally:
+            parsed.put(None)
+            inserter.join()
+    if failures:
+        raise failures[0]
+    os.remove(os.path.join(staging_directory, STAGING_MANIFEST))
+    _report_workers(workers)
+
+
+def load_dbsnp(dbsnp_files, threads, staging_directory = None):
     """Creates and populates MongoDB collection for dbSNP variants.
 
     Arguments:
     dbsnp_files -- list of one or more files with variants compressed using bgzip and indexed using tabix. File(s) must have 3 tab-delimited columns without header: integer part of rsId, chromosome, position (0-based).
     threads -- number of threads to use.
+    staging_directory -- if given, parsed chunks are staged there as BSON files, and a rerun with the same directory resumes an interrupted load.
     """
+    _write_chunks_to_collection(dbsnp_files, threads, 'dbsnp', parsing.get_snp_from_dbsnp_file, drop_collections = ['dbsnp'], staging_directory = staging_directory)
     db = get_db_connection()
-    db.dbsnp.drop()
-    with contextlib.closing(multiprocessing.Pool(threads)) as threads_pool:
-        threads_pool.map(functools.partial(_write_to_collection, collection = 'dbsnp', reader = parsing.get_snp_from_dbsnp_file), get_file_contig_pairs(dbsnp_files))
     db.dbsnp.create_indexes([pymongo.operations.IndexModel(key) for key in ['xpos', 'rsid']])
     sys.stdout.write('Inserted {} variant(s).\n'.format(db.dbsnp.count_documents({})))
+    lookups.bump_dataset_generation(db, 'dbsnp', ['dbsnp'])
 
 
 def load_metrics(metrics_file):
@@ -198,21 +471,185 @@ def load_metrics(metrics_file):
             db.metrics.insert(metric)
     db.metrics.create_index('metric')
     sys.stdout.write('Inserted {} metric(s).\n'.format(db.metrics.count_documents({})))
+    lookups.bump_dataset_generation(db, 'metrics', ['metrics'])
 
 
-def load_variants(variants_files, threads):
+def load_variants(variants_files, threads, staging_directory = None):
     """Creates and populates MongoDB collection for variants.
 
     Arguments:
     variants_files -- list of one or more VCF/BCF files with variants (no genotypes) compressed using bgzip and indexed using tabix.
     threads -- number of threads to use.
+    staging_directory -- if given, parsed chunks are staged there as BSON files, and a rerun with the same directory resumes an interrupted load.
     """
+    # summaries are computed over the old variants, and search terms point to them
+    _write_chunks_to_collection(variants_files, threads, 'variants', parsing.get_variants_from_sites_vcf, drop_collections = ['variants', 'summaries', 'search_terms'], staging_directory = staging_directory)
     db = get_db_connection()
-    db.variants.drop()
-    with contextlib.closing(multiprocessing.Pool(threads)) as threads_pool:
-        threads_pool.map(functools.partial(_write_to_collection, collection = 'variants', reader = parsing.get_variants_from_sites_vcf), get_file_contig_pairs(variants_files))
-    db.variants.create_indexes([pymongo.operations.IndexModel(key) for key in ['xpos', 'xstop', 'rsids', 'filter']])
+    db.variants.create_indexes([pymongo.operations.IndexModel(key) for key in ['xpos', 'xstop', 'rsids', 'filter', 'het_count']])
     sys.stdout.write('Inserted {} variant(s).\n'.format(db.variants.count_documents({})))
+    lookups.bump_dataset_generation(db, 'variants', ['variants', 'summaries', 'search_terms'])
+
+
+def _write_summaries(ids, key):
+    db = get_db_connection()
+    documents = []
+    for id in ids:
+        try:
+            intervalset = lookups.IntervalSet.from_gene(db, id) if key == 'gene_id' else lookups.IntervalSet.from_transcript(db, id)
+        except AssertionError: # no exons
+            continue
+        summary = lookups.get_summary_counts_for_intervalset(db, intervalset)
+        summary[key] = id
+        documents.append(summary)
+    if documents:
+        db.summaries.insert_many(documents)
+
+
+def load_summaries(threads):
+    """Creates and populates MongoDB collection with PASS variant counts for every gene and transcript.
+    The web server reads gene and transcript summaries from this collection and counts live when a summary is missing.
+
+    Arguments:
+    threads -- number of threads to use.
+    """
+    db = get_db_connection()
+    db.summaries.drop()
+    lookups.GeneModelIndex.get(db) # built once here, forked workers inherit it
+    with contextlib.closing(multiprocessing.Pool(threads)) as threads_pool:
+        for key, collection in [('gene_id', db.genes), ('transcript_id', db.transcripts)]:
+            ids = [id for id in collection.distinct(key) if id is not None]
+            threads_pool.map(functools.partial(_write_summaries, key = key), [ids[i:i + 1000] for i in range(0, len(ids), 1000)])
+    db.summaries.create_indexes([pymongo.operations.IndexModel(key) for key in ['gene_id', 'transcript_id']])
+    sys.stdout.write('Inserted {} gene summaries and {} transcript summaries.\n'.format(db.summaries.count_documents({'gene_id': {'$exists': True}}), db.summaries.count_documents({'transcript_id': {'$exists': True}})))
+    lookups.bump_dataset_generation(db, 'summaries', ['summaries'])
+
+
+def load_search_terms():
+    """Creates and populates MongoDB collection that resolves awesomebar searches with one indexed lookup.
+    Every document maps a normalized (uppercase) term to the page it redirects to. When a term has more than one document,
+    the one with the lowest priority wins: rsIDs, then gene symbols, aliases, Ensembl gene IDs and Ensembl transcript IDs.
+    """
+    db = get_db_connection()
+    db.search_terms.drop()
+    # rsIDs of loaded variants; $out creates the collection, so this goes first
+    db.variants.aggregate([
+        {'$match': {'rsids': {'$exists': True, '$ne': []}}},
+        {'$unwind': '$rsids'},
+        {'$group': {'_id': '$rsids', 'n': {'$sum': 1}, 'variant_id': {'$first': '$variant_id'}}},
+        {'$project': {
+            '_id': False,
+            'term': {'$toUpper': '$_id'},
+            'priority': {'$literal': lookups.SEARCH_TERM_PRIORITIES['rsid']},
+            'type': {'$cond': [{'$eq': ['$n', 1]}, 'variant', 'multi_variant_rsid']},
+            'args': {'$cond': [{'$eq': ['$n', 1]}, {'variant_id': '$variant_id'}, {'rsid': '$_id'}]}}},
+        {'$out': 'search_terms'}
+    ], allowDiskUse = True)
+    documents = []
+    for gene in db.genes.find({}, projection = {'_id': False, 'gene_id': True, 'gene_name': True, 'other_names': True}):
+        target = {'type': 'gene', 'args': {'gene_id': gene['gene_id']}}
+        documents.append(dict(target, term = gene['gene_name'].upper(), priority = lookups.SEARCH_TERM_PRIORITIES['gene_name']))
+        documents.extend(dict(target, term = name.upper(), priority = lookups.SEARCH_TERM_PRIORITIES['other_names']) for name in gene.get('other_names') or [] if name)
+        documents.append(dict(target, term = gene['gene_id'].upper(), priority = lookups.SEARCH_TERM_PRIORITIES['gene_id']))
+    for transcript in db.transcripts.find({'transcript_id': {'$ne': None}}, projection = {'_id': False, 'transcript_id': True}):
+        documents.append({'term': transcript['transcript_id'].upper(), 'priority': lookups.SEARCH_TERM_PRIORITIES['transcript_id'], 'type': 'transcript', 'args': {'transcript_id': transcript['transcript_id']}})
+    if documents:
+        db.search_terms.insert_many(documents)
+    db.search_terms.create_index([('term', pymongo.ASCENDING), ('priority', pymongo.ASCENDING)])
+    sys.stdout.write('Inserted {} search term(s).\n'.format(db.search_terms.count_documents({})))
+    lookups.bump_dataset_generation(db, 'search_terms', ['search_terms'])
+
+
+# Compound indexes for the hot query shapes. Single-field indexes are created by the loaders.
+# - xpos + _id: API region paging (sort by xpos, tie-break by _id) and keyset paging.
+# - xpos + filter + allele_freq + worst_csqidx: browser variant table counts/pages and summaries; filters are applied on index keys.
+# - vep_annotations.Gene/Feature + xpos + _id: API gene/transcript queries ($elemMatch on the annotation, sorted by xpos).
+# - het_count + _id: browser variant table sorted by het, in either direction (tie-break by _id).
+VARIANTS_INDEXES = [
+    [('xpos', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)],
+    [('xpos', pymongo.ASCENDING), ('filter', pymongo.ASCENDING), ('allele_freq', pymongo.ASCENDING), ('worst_csqidx', pymongo.ASCENDING)],
+    [('vep_annotations.Gene', pymongo.ASCENDING), ('xpos', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)],
+    [('vep_annotations.Feature', pymongo.ASCENDING), ('xpos', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)],
+    [('het_count', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)],
+    [('het_count', pymongo.DESCENDING), ('_id', pymongo.ASCENDING)],
+]
+
+
+def _summarize_plan(plan):
+    """Returns winning plan as e.g. 'LIMIT > FETCH > IXSCAN(xpos_1__id_1)'."""
+    stage = plan.get('stage', '?')
+    if 'indexName' in plan:
+        stage = '{}({})'.format(stage, plan['indexName'])
+    children = plan.get('inputStages', [plan['inputStage']] if 'inputStage' in plan else [])
+    if len(children) == 1:
+        return '{} > {}'.format(stage, _summarize_plan(children[0]))
+    if children:
+        return '{} > [{}]'.format(stage, ', '.join(_summarize_plan(child) for child in children))
+    return stage
+
+
+def _explain(db, command):
+    explanation = db.command({'explain': command, 'verbosity': 'executionStats'})
+    if 'stages' in explanation: # aggregate: the query part of the pipeline is explained in the first ($cursor) stage
+        explanation = explanation['stages'][0]['$cursor']
+    stats = explanation.get('executionStats', {})
+    plan = explanation['queryPlanner']['winningPlan']
+    return _summarize_plan(plan.get('queryPlan', plan)), stats.get('nReturned'), stats.get('totalKeysExamined'), stats.get('totalDocsExamined'), stats.get('executionTimeMillis')
+
+
+def explain_hot_queries(collection_name, gene_name):
+    """Prints query plan summaries for representative browser and API queries.
+
+    Arguments:
+    collection_name -- name of MongoDB collection that stores variants.
+    gene_name -- gene used to build the queries.
+    """
+    db = get_db_connection()
+    gene = lookups.get_gene_by_name(db, gene_name) or lookups.get_gene(db, gene_name)
+    if gene is None:
+        raise Exception('Gene {} was not found.'.format(gene_name))
+    intervalset = lookups.IntervalSet.from_gene(db, gene['gene_id'])
+    variant = db[collection_name].find_one({'xpos': {'$gte': gene['xstart'], '$lte': gene['xstop']}}, projection = {'_id': False, 'xpos': True, 'ref': True, 'alt': True})
+    if variant is None:
+        raise Exception('No variants in gene {}.'.format(gene_name))
+    transcript_id = gene.get('canonical_transcript') or db.transcripts.find_one({'gene_id': gene['gene_id']})['transcript_id']
+    xpos_range = [{'xpos': {'$gte': gene['xstart']}}, {'xpos': {'$lte': gene['xstop']}}]
+
+    columns = [{'name': name} for name in ['allele', 'pos', 'csq', 'cadd_phred', 'filter', 'allele_num', 'het', 'hom_count', 'allele_freq']]
+    default_order = [{'column': 2, 'dir': 'asc'}, {'column': 3, 'dir': 'desc'}]
+    mongo_match, mongo_sort, _ = lookups.build_variants_subset_query(intervalset, columns, default_order, {'filter_value': 'PASS', 'maf_ge': 0.01, 'category': 'LoF+Missense'})
+    mongo_sort['_id'] = pymongo.ASCENDING
+    het_order = [{'column': 6, 'dir': 'desc'}]
+    het_mongo_match, het_mongo_sort, _ = lookups.build_variants_subset_query(intervalset, columns, het_order, {'filter_value': 'PASS'})
+    het_mongo_sort['_id'] = pymongo.ASCENDING
+
+    queries = [
+        ('browser: table count, PASS+MAF+LoF/Missense', {'count': collection_name, 'query': {'$and': mongo_match}}),
+        ('browser: table page, default order', {'aggregate': collection_name, 'pipeline': [{'$match': {'$and': mongo_match}}, {'$sort': mongo_sort}, {'$skip': 100}, {'$limit': 100}], 'cursor': {}}),
+        ('browser: table page, sorted by het', {'aggregate': collection_name, 'pipeline': [{'$match': {'$and': het_mongo_match}}, {'$sort': het_mongo_sort}, {'$limit': 100}], 'cursor': {}}),
+        ('browser: summary, first interval', {'aggregate': collection_name, 'pipeline': [{'$match': dict(intervalset.to_list_of_mongos()[0], filter = 'PASS')}, {'$group': {'_id': None, 'total': {'$sum': 1}}}], 'cursor': {}}),
+        ('browser: variant page', {'find': collection_name, 'filter': {'xpos': variant['xpos'], 'ref': variant['ref'], 'alt': variant['alt']}, 'limit': 1}),
+        ('api: /region', {'find': collection_name, 'filter': {'$and': xpos_range}, 'sort': {'xpos': 1, '_id': 1}, 'limit': 1000}),
+        ('api: /region with filters', {'find': collection_name, 'filter': {'$and': xpos_range + [{'filter': {'$eq': 'PASS'}}, {'allele_freq': {'$gt': 0.01}}]}, 'sort': {'xpos': 1, '_id': 1}, 'limit': 1000}),
+        ('api: /gene', {'find': collection_name, 'filter': {'$and': xpos_range + [{'vep_annotations': {'$elemMatch': {'$and': [{'Gene': gene['gene_id']}]}}}]}, 'sort': {'xpos': 1, '_id': 1}, 'limit': 1000}),
+        ('api: /transcript', {'find': collection_name, 'filter': {'$and': xpos_range + [{'vep_annotations': {'$elemMatch': {'$and': [{'Feature': transcript_id}]}}}]}, 'sort': {'xpos': 1, '_id': 1}, 'limit': 1000}),
+    ]
+    sys.stdout.write('Query plans for gene {} ({}), {} interval(s):\n'.format(gene['gene_name'], gene['gene_id'], len(intervalset.to_list_of_mongos())))
+    n_collscans = 0
+    for name, command in queries:
+        plan, n_returned, n_keys, n_docs, millis = _explain(db, command)
+        n_collscans += 'COLLSCAN' in plan
+        sys.stdout.write('{}{}\n    {}\n    returned={} keys_examined={} docs_examined={} time={}ms\n'.format('[COLLSCAN] ' if 'COLLSCAN' in plan else '', name, plan, n_returned, n_keys, n_docs, millis))
+    sys.stdout.write('{} of {} queries use a collection scan.\n'.format(n_collscans, len(queries)))
+
+
+def create_indexes(collection_name):
+    """Creates compound indexes for the browser and API query shapes.
+
+    Arguments:
+    collection_name -- name of MongoDB collection that stores variants.
+    """
+    db = get_db_connection()
+    sys.stdout.write('Created {} index(es).\n'.format(', '.join(db[collection_name].create_indexes([pymongo.operations.IndexModel(keys) for keys in VARIANTS_INDEXES]))))
 
 
 def create_sequence_cache(collection_name):
@@ -226,21 +663,20 @@ def create_sequence_cache(collection_name):
     sequences.SequencesClient.create_cache_collection_and_index(db, collection_name)
 
 
-def load_custom_variants(variants_files, collection_name, threads):
+def load_custom_variants(variants_files, collection_name, threads, staging_directory = None):
     """Creates and populates MongoDB collection with given name for additional variants.
 
     Arguments:
     variants_files -- list of one or more VCF/BCF files with variants (no genotypes) compressed using bgzip and indexed using tabix.
     collection_name -- name of MongoDB collection that will store variants.
     threads -- number of threads to use.
+    staging_directory -- if given, parsed chunks are staged there as BSON files, and a rerun with the same directory resumes an interrupted load.
     """
+    _write_chunks_to_collection(variants_files, threads, collection_name, parsing.get_variants_from_sites_vcf, histograms = False, drop_collections = [collection_name], staging_directory = staging_directory)
     db = get_db_connection()
-    if collection_name in db.collection_names():
-        db[collection_name].drop()
-    with contextlib.closing(multiprocessing.Pool(threads)) as threads_pool:
-        threads_pool.map(functools.partial(_write_to_collection, collection = collection_name, reader = parsing.get_variants_from_sites_vcf, histograms = False), get_file_contig_pairs(variants_files))
-    db[collection_name].create_indexes([pymongo.operations.IndexModel(key) for key in ['xpos', 'xstop', 'filter']])
+    db[collection_name].create_indexes([pymongo.operations.IndexModel(key) for key in ['xpos', 'xstop', 'filter', 'het_count']])
     sys.stdout.write('Inserted {} variant(s).\n'.format(db[collection_name].count_documents({})))
+    lookups.bump_dataset_generation(db, 'custom_variants', [collection_name])
 
 
 def _load_percentiles_from_vcf(vcf):
@@ -279,6 +715,7 @@ def load_percentiles(variant_files, threads):
     """
     with contextlib.closing(multiprocessing.Pool(threads)) as threads_pool:
         threads_pool.map_async(_load_percentiles_from_vcf, variant_files).get(9999999)
+    lookups.bump_dataset_generation(get_db_connection(), 'percentiles', ['variants'])
 
 
 def _update_collection(args, collection, reader):
@@ -354,7 +791,7 @@ if __name__ == '__main__':
     elif args.command == 'dbsnp':
         sys.stdout.write('Creating dbSNP collection in {} database.\n'.format(mongo_db_name))
         sys.stdout.write('Using {} thread(s).\n'.format(args.threads))
-        load_dbsnp(args.dbsnp_files, args.threads)
+        load_dbsnp(args.dbsnp_files, args.threads, args.staging_directory)
         sys.stdout.write('Done creating dbSNP collection in {} database.\n'.format(mongo_db_name))
     elif args.command == 'metrics':
         sys.stdout.write('Creating metrics collection in {} database.\n'.format(mongo_db_name))
@@ -362,15 +799,30 @@ if __name__ == '__main__':
         sys.stdout.write('Done creating metrics collection in {} databases.\n'.format(mongo_db_name))
     elif args.command == 'variants':
         sys.stdout.write('Creating variants collection in {} database.\n'.format(mongo_db_name))
-        load_variants(args.variants_files, args.threads)
+        load_variants(args.variants_files, args.threads, args.staging_directory)
         sys.stdout.write('Done creating variants collection in {} database.\n'.format(mongo_db_name))
+    elif args.command == 'summaries':
+        sys.stdout.write('Creating summaries collection in {} database.\n'.format(mongo_db_name))
+        sys.stdout.write('Using {} thread(s).\n'.format(args.threads))
+        load_summaries(args.threads)
+        sys.stdout.write('Done creating summaries collection in {} database.\n'.format(mongo_db_name))
+    elif args.command == 'search_terms':
+        sys.stdout.write('Creating search_terms collection in {} database.\n'.format(mongo_db_name))
+        load_search_terms()
+        sys.stdout.write('Done creating search_terms collection in {} database.\n'.format(mongo_db_name))
+    elif args.command == 'indexes':
+        if not args.explain_only:
+            sys.stdout.write('Creating indexes in {} database.\n'.format(mongo_db_name))
+            create_indexes(args.collection_name)
+            sys.stdout.write('Done creating indexes in {} database.\n'.format(mongo_db_name))
+        explain_hot_queries(args.collection_name, args.gene_name)
     elif args.command == 'bam_cache':
         sys.stdout.write('Creating {} collection in {} database.\n'.format(igv_cache_collection_name, mongo_db_name))
         create_sequence_cache(igv_cache_collection_name)
         sys.stdout.write('Done creating {} collection in {} database.\n'.format(igv_cache_collection_name, mongo_db_name))
     elif args.command == 'custom_variants':
         sys.stdout.write('Creating {} collection in {} database.\n'.format(args.collection_name, mongo_db_name))
-        load_custom_variants(args.variants_files, args.collection_name, args.threads)
+        load_custom_variants(args.variants_files, args.collection_name, args.threads, args.staging_directory)
         sys.stdout.write('Done creating {} collection in {} database.\n'.format(args.collection_name, mongo_db_name))
     elif args.command == 'percentiles':
         sys.stdout.write('Loading percentiles into {} database.\n'.format(mongo_db_name))
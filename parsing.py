@@ -1,8 +1,11 @@
 """
 Utils for reading flat files that are loaded into database
 """
+import gzip
 import itertools
+import os
 import re
+import struct
 import traceback
 from contextlib import closing
 
@@ -98,6 +101,7 @@ def get_variants_from_sites_vcf(vcf, chrom, start_bp, end_bp, histograms = True)
                     variant['allele_freq'] = record.info['AF'][i]
                     assert variant['allele_freq'] != 0, variant
                     variant['hom_count'] = record.info['Hom'][i]
+                    variant['het_count'] = variant['allele_count'] - 2 * variant['hom_count']
                     variant['quality_metrics'] = {x: record.info[x] for x in METRICS if x in record.info}
                     variant['genes'] = list(set(annotation['Gene'] for annotation in allele_annotations if annotation['Gene']))
                     variant['transcripts'] = list(set(annotation['Feature'] for annotation in allele_annotations if annotation['Feature']))
@@ -123,6 +127,77 @@ def get_variants_from_sites_vcf(vcf, chrom, start_bp, end_bp, histograms = True)
                 raise
 
 
+def _read_index_names(data, offset):
+    # tabix meta: format, col_seq, col_beg, col_end, meta, skip, l_nm, then `l_nm` bytes of NUL-terminated names
+    l_nm, = struct.unpack_from('<i', data, offset + 24)
+    names = data[offset + 28:offset + 28 + l_nm].split(b'\0')
+    return [name.decode() for name in names if name]
+
+
+def get_index_offsets(path):
+    """Reads the tabix (.tbi) or CSI (.csi) index of a bgzip'ed VCF/BCF/TSV file and returns {contig: (points, end_offset)}.
+
+    `points` are (position, offset) pairs, one per smallest bin (16kb for tabix) with data, sorted by position: position is the 0-based start of the bin,
+    offset is where its first record starts in the compressed file. `end_offset` is where the last record of the contig ends.
+    Records longer than a smallest bin (e.g. structural variants) are kept in larger bins, which are ignored, so this is a map of where the data is, not an exact one.
+    Returns None when there is no index.
+
+    Arguments:
+    path -- bgzip'ed file. Its index must be `path`.tbi or `path`.csi.
+    """
+    if os.path.exists(path + '.tbi'):
+        with gzip.open(path + '.tbi', 'rb') as ifile:
+            data = ifile.read()
+        assert data[:4] == b'TBI\1', path + '.tbi'
+        n_ref, = struct.unpack_from('<i', data, 4)
+        names = _read_index_names(data, 8)
+        min_shift, depth = 14, 5
+        offset = 8 + 28 + struct.unpack_from('<i', data, 8 + 24)[0]
+        has_loffset = False
+    elif os.path.exists(path + '.csi'):
+        with gzip.open(path + '.csi', 'rb') as ifile:
+            data = ifile.read()
+        assert data[:4] == b'CSI\1', path + '.csi'
+        min_shift, depth, l_aux = struct.unpack_from('<iii', data, 4)
+        if l_aux >= 28:
+            names = _read_index_names(data, 16)
+        else:
+            with closing(pysam.VariantFile(path)) as ifile: # BCF: contigs are numbered in the order of the header
+                names = list(ifile.header.contigs)
+        n_ref, = struct.unpack_from('<i', data, 16 + l_aux)
+        offset = 16 + l_aux + 4
+        has_loffset = True
+    else:
+        return None
+    first_leaf_bin = ((1 << 3 * depth) - 1) // 7
+    last_leaf_bin = first_leaf_bin + (1 << 3 * depth) - 1
+    offsets = {}
+    for ref in range(n_ref):
+        n_bin, = struct.unpack_from('<i', data, offset)
+        offset += 4
+        points = []
+        end_offset = 0
+        for _ in range(n_bin):
+            if has_loffset:
+                bin_number, _, n_chunk = struct.unpack_from('<IQi', data, offset)
+                offset += 16
+            else:
+                bin_number, n_chunk = struct.unpack_from('<Ii', data, offset)
+                offset += 8
+            chunks = struct.unpack_from('<{}Q'.format(2 * n_chunk), data, offset)
+            offset += 16 * n_chunk
+            if bin_number > last_leaf_bin: continue # pseudo-bin with statistics
+            end_offset = max([end_offset] + [chunk_end >> 16 for chunk_end in chunks[1::2]])
+            if bin_number >= first_leaf_bin:
+                points.append(((bin_number - first_leaf_bin) << min_shift, min(chunks[0::2]) >> 16))
+        if not has_loffset:
+            n_intv, = struct.unpack_from('<i', data, offset)
+            offset += 4 + 8 * n_intv # linear index, not needed
+        points.sort()
+        offsets[names[ref]] = (points, end_offset)
+    return offsets
+
+
 def get_minimal_representation(pos, ref, alt):
     """
     Get the minimal representation of a variant, based on the ref + alt alleles in a VCF
@@ -149,7 +224,7 @@ def clean_annotation_consequences_for_variant(variant):
     '''
     add variant.vep_annotions[*].{HGVS,worst_csqidx}
     sort variant.vep_annotations by severity.
-    add variant.worst_csq*.
+    add variant.worst_csq* (including worst_csq_lof_lc, so that queries don't have to look into vep_annotations).
     '''
     if len(variant['vep_annotations']) == 0:
         raise Exception('why no annos for {!r}?'.format(variant))
@@ -165,6 +240,7 @@ def clean_annotation_consequences_for_variant(variant):
     variant['worst_csq_CANONICAL'] = worst_anno['CANONICAL']
     variant['worst_csqidx'] = worst_anno['worst_csqidx']
     variant['worst_csq_HGVS'] = worst_anno['HGVS']
+    variant['worst_csq_lof_lc'] = (worst_anno.get('LoF') == 'LC')
 
 def _get_worst_csqidx_for_annotation(annotation):
     try:
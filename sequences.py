@@ -4,7 +4,8 @@ import string
 
 import pymongo
 import pysam
-from utils import Xpos
+import timing
+from utils import HandlePool, Xpos
 
 
 class SequencesClient(object):
@@ -14,6 +15,8 @@ class SequencesClient(object):
         self._reference_path = reference_path
         self._window_bp = window_bp
         self._crams = dict()
+        # open CRAMs (with parsed header and index) are reused across requests instead of being reopened every time
+        self._cram_pool = HandlePool(lambda cram_path: pysam.AlignmentFile(cram_path, 'rc', reference_filename = self._reference_path), max_idle = 8)
         if not os.path.exists(cache_dir):
             raise Exception('Provided cache path does not exist.')
         if not os.path.isdir(cache_dir):
@@ -80,13 +83,14 @@ class SequencesClient(object):
         bam_path = os.path.join(self._cache_dir, '{}.{}.{}.bam'.format(variant_id, sample_id, SequencesClient.get_random_filename(5)))
         bai_path= '{}.bai'.format(bam_path)
         qname = '{}:{}:{}:{}{}:'.format(pos, ref, alt, 0 if sample_type == 'hom' else '', sample_no)
-        with pysam.AlignmentFile(cram['path'], 'rc', reference_filename = self._reference_path) as icram, pysam.AlignmentFile(bam_path, 'wb', header = cram['header']) as obam:
-            for read in icram.fetch(chrom, start, stop):
-                if read.query_name.startswith(qname):
-                    for tag, value in read.get_tags():
-                        read.set_tag(tag, None)
-                    obam.write(read)
-        pysam.index(bam_path)
+        with timing.span('cram'):
+            with self._cram_pool.borrow(cram['path']) as icram, pysam.AlignmentFile(bam_path, 'wb', header = cram['header']) as obam:
+                for read in icram.fetch(chrom, start, stop):
+                    if read.query_name.startswith(qname):
+                        for tag, value in read.get_tags():
+                            read.set_tag(tag, None)
+                        obam.write(read)
+            pysam.index(bam_path)
         # save to cache if does not exist yet
         try:
             result = db[self._cache_collection].update_one({ 'name': cache_name}, { '$inc': { 'accessed': 1 }, '$setOnInsert': { 'bam': bam_path, 'bai': bai_path } }, upsert = True)
@@ -116,7 +120,7 @@ class SequencesClient(object):
         stop = pos + self._window_bp
         qname = '{}:{}:{}:'.format(pos, ref, alt)
         samples = set()
-        with pysam.AlignmentFile(cram['path'], 'rc', reference_filename = self._reference_path) as icram:
+        with timing.span('cram'), self._cram_pool.borrow(cram['path']) as icram:
             for read in icram.fetch(chrom, start, stop):
                 if read.query_name.startswith(qname):
                     sample = read.query_name.split(':')[3]
@@ -1,5 +1,6 @@
 import argparse
 import functools
+import itertools
 import os
 import re
 import string
@@ -7,11 +8,14 @@ from datetime import datetime
 
 import bson
 import jwt
+import lookups
+import timing
 from bson.json_util import dumps
-from flask import Blueprint, Flask, abort, jsonify, request
+from compressed_cache import CompressedResponseCache
+from flask import Blueprint, Flask, Response, abort, jsonify, make_response, request, stream_with_context
 from flask_limiter import Limiter
 from pymongo import ASCENDING, DESCENDING, MongoClient
-from utils import Xpos
+from utils import Xpos, make_etag
 from webargs import ValidationError, fields
 from webargs.flaskparser import parser
 
@@ -30,6 +34,7 @@ app.config.from_pyfile('config.py', silent = True)
 # Load configuration file specified in BRAVO_CONFIG_FILE environment variable if exists
 app.config.from_envvar('BRAVO_CONFIG_FILE', silent = True)
 
+timing.init_app(app) # before any MongoClient is created
 
 proxy = app.config['PROXY']
 
@@ -47,9 +52,13 @@ api_version = app.config['API_VERSION']
 
 pageSize = app.config['API_PAGE_SIZE']
 maxRegion = app.config['API_MAX_REGION']
+maxBatchVariants = app.config['API_MAX_BATCH_VARIANTS']
+maxAnnotateSites = app.config['API_MAX_ANNOTATE_SITES']
+annotateBatchSize = 1000 # response lines per chunk of the streamed /annotate response
+annotateMaxSkip = 10000 # variants the /annotate merge-join reads past before it reopens its cursor further ahead
 
 projection = {'_id': True, 'xpos': True, 'variant_id': True, 'chrom': True, 'pos': True,  'ref': True, 'alt': True, 'site_quality': True, 'filter': True, 'allele_num': True, 'allele_count': True, 'allele_freq': True, 'rsids': True, 'avgdp': True, 'avgdp_alt': True, 'avggq': True, 'avggq_alt': True, 'vep_annotations': True }
-allowed_sort_keys = {'pos': long, 'allele_count': int, 'allele_freq': float, 'allele_num': int, 'site_quality': float, 'filter': str, 'variant_id': str}
+allowed_sort_keys = {'pos': int, 'allele_count': int, 'allele_freq': float, 'allele_num': int, 'site_quality': float, 'filter': str, 'variant_id': str}
 allowed_filter_keys = {'allele_count', 'allele_freq', 'allele_num', 'site_quality', 'filter'}
 
 
@@ -76,6 +85,16 @@ vcf_meta = [
 
 mongo = MongoClient(mongo_host, mongo_port, connect = True)
 
+response_cache = CompressedResponseCache(app.config['RESPONSE_CACHE_DIRECTORY'], app.config['RESPONSE_CACHE_MAX_BYTES'])
+
+
+def format_vcf_line(r, annotations):
+   return '{}\t{}\t{}\t{}\t{}\t{}\t{}\tAN={};AC={};AF={};AVGDP={};AVGDP_ALT={};AVGGQ={};AVGGQ_ALT={};CSQ={}'.format(
+      r['chrom'], r['pos'], ';'.join(r['rsids']) if r['rsids'] else '.', r['ref'], r['alt'], r['site_quality'], r['filter'],
+      r['allele_num'], r['allele_count'], r['allele_freq'], r['avgdp'], r['avgdp_alt'], r['avggq'], r['avggq_alt'],
+      ','.join('|'.join(a[k] for k in annotations_ordered) for a in annotations)
+   )
+
 
 class UserError(Exception):
     status_code = 400
@@ -147,6 +166,27 @@ def require_authorization(func):
    return authorization_wrapper
 
 
+def conditional_get(func):
+   # GET responses only change when `manage.py` loads data, which bumps the dataset generation.
+   # Bodies are compressed once and kept in response_cache, keyed by the ETag.
+   # Must be placed after @require_authorization.
+   @functools.wraps(func)
+   def conditional_get_wrapper(*args, **kwargs):
+      etag = make_etag(lookups.dataset_cache.get_generation(get_db()), api_version, request.path, sorted(request.args.items(multi = True)))
+      if request.if_none_match.contains_weak(etag):
+         response = Response(status = 304)
+      else:
+         response = response_cache.respond(etag, request.accept_encodings, lambda: make_response(func(*args, **kwargs)))
+         if response.status_code != 200:
+            return response
+      # the body is br, gzip or identity depending on Accept-Encoding, so the ETag is weak and shared caches must key on the encoding
+      response.set_etag(etag, weak = True)
+      response.vary.add('Accept-Encoding')
+      response.headers['Cache-Control'] = app.config['CACHE_CONTROL']
+      return response
+   return conditional_get_wrapper
+
+
 @parser.error_handler
 def handle_parsing_error(error, request):
    response = jsonify({ 'error': 'invalid query parameters' })
@@ -170,6 +210,7 @@ def handle_user_error(error):
 
 @bp.route('/', methods = ['GET'])
 @require_authorization
+@conditional_get
 def get_name():
    response = jsonify({
       'dataset': api_dataset_name,
@@ -179,8 +220,14 @@ def get_name():
    return response
 
 
+@bp.route('/metrics', methods = ['GET'])
+def get_metrics():
+   return timing.metrics_response(app.config['METRICS_ALLOWED_IP'], get_user_ip())
+
+
 @bp.route('/variant', methods = ['GET'])
 @require_authorization
+@conditional_get
 def get_variant():
    args = parser.parse({
       'variant_id': fields.Str(required = False, validate = lambda x: len(x) > 0),
@@ -237,11 +284,7 @@ def get_variant():
       for r in cursor:
          last_object_id = r.pop('_id')
          r.pop('xpos', None)
-         data.append('{}\t{}\t{}\t{}\t{}\t{}\t{}\tAN={};AC={};AF={};AVGDP={};AVGDP_ALT={};AVGGQ={};AVGGQ_ALT={};CSQ={}'.format(
-            r['chrom'], r['pos'], ';'.join(r['rsids']) if r['rsids'] else '.', r['ref'], r['alt'], r['site_quality'], r['filter'],
-            r['allele_num'], r['allele_count'], r['allele_freq'], r['avgdp'], r['avgdp_alt'], r['avggq'], r['avggq_alt'],
-            ','.join('|'.join(a[k] for k in annotations_ordered) for a in r['annotations'])
-         ))
+         data.append(format_vcf_line(r, r['annotations']))
          last_variant = r
    response['data'] = data
 
@@ -250,6 +293,68 @@ def get_variant():
    return response
 
 
+@bp.route('/variants/batch', methods = ['POST'])
+@require_authorization
+def get_variants_batch():
+   args = parser.parse({
+      'variants': fields.List(fields.Str(validate = lambda x: len(x) > 0), required = True, validate = lambda x: 0 < len(x) <= maxBatchVariants),
+      'vcf': fields.Bool(required = False, missing = False)
+      }, request)
+
+   # one key per input: rsID string, or (xpos, ref, alt) tuple
+   keys = []
+   rsids = set()
+   xpos_by_chrom = dict()
+   for variant_id in args['variants']:
+      if variant_id.startswith('rs'):
+         keys.append(variant_id)
+         rsids.add(variant_id)
+      else:
+         try:
+            chrom, pos, ref, alt = variant_id.split('-')
+            pos = int(pos)
+         except ValueError as e:
+            raise UserError('Invalid variant name format: {}.'.format(variant_id))
+         if not Xpos.check_chrom(chrom):
+            raise UserError('Invalid chromosome name: {}.'.format(variant_id))
+         xpos = Xpos.from_chrom_pos(chrom, pos)
+         keys.append((xpos, ref, alt))
+         xpos_by_chrom.setdefault(Xpos.to_chrom_pos(xpos)[0], set()).add(xpos)
+
+   found = dict()
+   collection = get_db()[api_collection_name]
+   if rsids:
+      for r in collection.find({ 'rsids': { '$in': list(rsids) } }, projection).sort([('xpos', ASCENDING), ('_id', ASCENDING)]):
+         for rsid in r['rsids']:
+            if rsid in rsids:
+               found.setdefault(rsid, []).append(r)
+   for chrom, xpos in xpos_by_chrom.items():
+      for r in collection.find({ 'xpos': { '$in': sorted(xpos) } }, projection):
+         found.setdefault((r['xpos'], r['ref'], r['alt']), []).append(r)
+
+   data = []
+   response = { 'not_found': [variant_id for variant_id, key in zip(args['variants'], keys) if key not in found] }
+   if not args['vcf']:
+      response['format'] = 'json'
+      for key in keys:
+         for r in found.get(key, []):
+            variant = { k: v for k, v in r.items() if k not in { '_id', 'xpos', 'vep_annotations' } }
+            variant['annotations'] = [{k: a[k] for k in annotations_ordered} for a in r['vep_annotations']]
+            data.append(variant)
+   else:
+      response['format'] = 'vcf'
+      response['header'] = vcf_header
+      response['meta'] = vcf_meta
+      for key in keys:
+         for r in found.get(key, []):
+            data.append(format_vcf_line(r, r['vep_annotations']))
+   response['data'] = data
+
+   response = jsonify(response)
+   response.status_code = 200
+   return response
+
+
 def deserialize_query_sort(value):
    query_sort = list()
    for key_direction in (x.strip().split(':') for x in value.strip().split(',')):
@@ -333,6 +438,18 @@ def validate_query(value):
     return True
 
 
+def build_user_filter(args):
+    mongo_user_filter = []
+    for key in allowed_filter_keys:
+        values = args.get(key, None)
+        if values is not None:
+            if len(values) == 1:
+                mongo_user_filter.append({key: values[0]})
+            else:
+                mongo_user_filter.append({'$or': [{key: v} for v in values]})
+    return mongo_user_filter
+
+
 def build_region_query(args, xstart, xend):
     # prepare sort conditions in mongo format
     if 'sort' not in args or len(args['sort']) == 0:
@@ -341,14 +458,7 @@ def build_region_query(args, xstart, xend):
         mongo_sort = [(u'xpos', x[1]) if x[0] == 'pos' else x for x in args['sort']] # if user was sorting by 'pos', then replace 'pos' to 'xpos'
     mongo_filter = []
     # prepare user-specified filter conditions in mongo format
-    mongo_user_filter = [ {'xpos': {'$gte': xstart}}, {'xpos': {'$lte': xend}} ]
-    for key in allowed_filter_keys:
-        values = args.get(key, None)
-        if values is not None:
-            if len(values) == 1:
-                mongo_user_filter.append({key: values[0]})
-            else:
-                mongo_user_filter.append({'$or': [{key: v} for v in values]})
+    mongo_user_filter = [ {'xpos': {'$gte': xstart}}, {'xpos': {'$lte': xend}} ] + build_user_filter(args)
     # adjust filter conditions if auto-generated 'next' field is present
     mongo_last_filter = []
     if 'last' in args:
@@ -380,6 +490,7 @@ def build_link_next(args, last_object_id, last_variant, mongo_sort):
 
 @bp.route('/region', methods = ['GET'])
 @require_authorization
+@conditional_get
 def get_region():
    arguments = {
        'chrom': fields.Str(required = True, validate = lambda x: len(x) > 0),
@@ -457,11 +568,7 @@ def get_region():
       for r in cursor:
          last_object_id = r.pop('_id')
          r.pop('xpos', None)
-         data.append('{}\t{}\t{}\t{}\t{}\t{}\t{}\tAN={};AC={};AF={};AVGDP={};AVGDP_ALT={};AVGGQ={};AVGGQ_ALT={};CSQ={}'.format(
-            r['chrom'], r['pos'], ';'.join(r['rsids']) if r['rsids'] else '.', r['ref'], r['alt'], r['site_quality'], r['filter'],
-            r['allele_num'], r['allele_count'], r['allele_freq'], r['avgdp'], r['avgdp_alt'], r['avggq'], r['avggq_alt'],
-            ','.join('|'.join(a[k] for k in annotations_ordered) for a in r['vep_annotations'])
-         ))
+         data.append(format_vcf_line(r, r['vep_annotations']))
          last_variant = r
 
    response['data'] = data
@@ -473,6 +580,7 @@ def get_region():
 
 @bp.route('/gene', methods = ['GET'])
 @require_authorization
+@conditional_get
 def get_gene():
    arguments = {
        'name': fields.Str(required = True, validate = lambda x: len(x) > 0),
@@ -549,11 +657,7 @@ def get_gene():
       for r in cursor:
          last_object_id = r.pop('_id')
          r.pop('xpos', None)
-         data.append('{}\t{}\t{}\t{}\t{}\t{}\t{}\tAN={};AC={};AF={};AVGDP={};AVGDP_ALT={};AVGGQ={};AVGGQ_ALT={};CSQ={}'.format(
-            r['chrom'], r['pos'], ';'.join(r['rsids']) if r['rsids'] else '.', r['ref'], r['alt'], r['site_quality'], r['filter'],
-            r['allele_num'], r['allele_count'], r['allele_freq'], r['avgdp'], r['avgdp_alt'], r['avggq'], r['avggq_alt'],
-            ','.join('|'.join(a[k] for k in annotations_ordered) for a in r['vep_annotations'] if a['Gene'] == gene['gene_id'])
-         ))
+         data.append(format_vcf_line(r, (a for a in r['vep_annotations'] if a['Gene'] == gene['gene_id'])))
          last_variant = r
 
    response['data'] = data
@@ -565,6 +669,7 @@ def get_gene():
 
 @bp.route('/transcript', methods = ['GET'])
 @require_authorization
+@conditional_get
 def get_transcript():
    arguments = {
        'transcript_id': fields.Str(required = True, validate = lambda x: len(x) > 0),
@@ -636,11 +741,7 @@ def get_transcript():
       for r in cursor:
          last_object_id = r.pop('_id')
          r.pop('xpos', None)
-         data.append('{}\t{}\t{}\t{}\t{}\t{}\t{}\tAN={};AC={};AF={};AVGDP={};AVGDP_ALT={};AVGGQ={};AVGGQ_ALT={};CSQ={}'.format(
-            r['chrom'], r['pos'], ';'.join(r['rsids']) if r['rsids'] else '.', r['ref'], r['alt'], r['site_quality'], r['filter'],
-            r['allele_num'], r['allele_count'], r['allele_freq'], r['avgdp'], r['avgdp_alt'], r['avggq'], r['avggq_alt'],
-            ','.join(['|'.join(a[k] for k in annotations_ordered) for a in r['vep_annotations'] if a['Feature'] == transcript['transcript_id']])
-         ))
+         data.append(format_vcf_line(r, (a for a in r['vep_annotations'] if a['Feature'] == transcript['transcript_id'])))
          last_variant = r
    response['data'] = data
    response['next'] = build_link_next(args, last_object_id, last_variant, mongo_sort) if len(data) == args['limit'] else None
@@ -650,6 +751,102 @@ def get_transcript():
 
 
 
+def read_annotate_sites(lines):
+   # yields (xpos, chrom, pos, ref, alt) for every CHROM<tab>POS<tab>REF<tab>ALT line, as they are read; blank and '#' lines are skipped
+   n_sites = 0
+   for line in lines:
+      if isinstance(line, bytes):
+         line = line.decode('utf-8')
+      line = line.rstrip('\r\n')
+      if not line or line.startswith('#'):
+         continue
+      site = line.split('\t')
+      if len(site) < 4:
+         raise UserError('Each line must have CHROM, POS, REF and ALT separated by tabs.')
+      chrom, pos, ref, alt = site[:4]
+      if not Xpos.check_chrom(chrom):
+         raise UserError('Invalid chromosome name.')
+      try:
+         pos = int(pos)
+      except ValueError:
+         raise UserError('Invalid position.')
+      n_sites += 1
+      if n_sites > maxAnnotateSites:
+         raise UserError('No more than {} sites are allowed per request.'.format(maxAnnotateSites))
+      yield Xpos.from_chrom_pos(chrom, pos), chrom, pos, ref, alt
+
+
+def merge_join(sites, seek, max_skip = annotateMaxSkip):
+   # `sites` are tuples that start with xpos; `seek(xpos)` returns an iterator over the records of that chromosome from xpos on, sorted by xpos.
+   # Yields (site, record or None) for every site, in input order. While sites are sorted, one cursor is walked per chromosome;
+   # it is reopened only for a site before it (unsorted input) or more than `max_skip` records after it (sparse input).
+   records, record = None, None
+   current_xpos, current_records = None, {}
+   for site in sites:
+      xpos = site[0]
+      if xpos != current_xpos:
+         if records is None or xpos < current_xpos or xpos // int(1e9) != current_xpos // int(1e9):
+            records = seek(xpos)
+            record = next(records, None)
+         skipped = 0
+         while record is not None and record['xpos'] < xpos:
+            skipped += 1
+            if skipped > max_skip:
+               records = seek(xpos)
+            record = next(records, None)
+         current_xpos, current_records = xpos, {}
+         while record is not None and record['xpos'] == xpos:
+            current_records[(record['ref'], record['alt'])] = record
+            record = next(records, None)
+      yield site, current_records.get((site[3], site[4]), None)
+
+
+@bp.route('/annotate', methods = ['POST'])
+@require_authorization
+def annotate():
+   arguments = {
+       'allele_count': fields.List(fields.Function(deserialize = lambda x: deserialize_query_filter(x, int))),
+       'allele_freq': fields.List(fields.Function(deserialize = lambda x: deserialize_query_filter(x, float))),
+       'allele_num': fields.List(fields.Function(deserialize = lambda x: deserialize_query_filter(x, float))),
+       'site_quality': fields.List(fields.Function(deserialize = lambda x: deserialize_query_filter(x, float))),
+       'filter': fields.List(fields.Function(deserialize = lambda x: deserialize_query_filter(x, str)))
+   }
+   args = parser.parse(arguments, request)
+
+   # request body: one CHROM<tab>POS<tab>REF<tab>ALT line per site, read and answered as it streams in; sorted by position within each chromosome is fastest
+   sites = read_annotate_sites(request.stream)
+   first_site = next(sites, None) # so that a body in the wrong format gets a 400 instead of a broken stream
+   if first_site is None:
+      return Response('', status = 200, mimetype = 'text/plain')
+
+   collection = get_db()[api_collection_name]
+   mongo_user_filter = build_user_filter(args)
+   annotate_projection = { '_id': False, 'xpos': True, 'ref': True, 'alt': True, 'allele_num': True, 'allele_count': True, 'allele_freq': True, 'filter': True }
+
+   def seek(xpos):
+      chrom_xstop = xpos - xpos % int(1e9) + int(1e9) - 1
+      mongo_filter = { '$and': [ { 'xpos': { '$gte': xpos, '$lte': chrom_xstop } } ] + mongo_user_filter }
+      return collection.find(mongo_filter, annotate_projection).sort('xpos', ASCENDING).batch_size(annotateBatchSize)
+
+   def generate():
+      lines = []
+      try:
+         for site, r in merge_join(itertools.chain([first_site], sites), seek):
+            if r is None:
+               lines.append('{}\t{}\t{}\t{}\t.\t.\t.\t.\n'.format(*site[1:]))
+            else:
+               lines.append('{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format(site[1], site[2], site[3], site[4], r['allele_num'], r['allele_count'], r['allele_freq'], r['filter']))
+            if len(lines) >= annotateBatchSize:
+               yield ''.join(lines)
+               lines = []
+      except UserError as e:
+         # the response has already started, so a bad line further down ends it with an error line instead
+         lines.append('#ERROR\t{}\n'.format(e.message))
+      yield ''.join(lines)
+
+   return Response(stream_with_context(generate()), status = 200, mimetype = 'text/plain')
+
+
 limiter = Limiter(app, default_limits = app.config['API_REQUESTS_RATE_LIMIT'], key_func = get_user_ip)
 
 
@@ -36,7 +36,9 @@ var coverage_plot = {
     margin: {top: 8, bottom: 10},
     color: '#ffa37c',
     create: function() {
-        var XHR = $.getJSON(window.model.url_prefix + 'api/coverage' + window.model.url_suffix);
+        // ask for about one coverage bin per pixel (the container may not be laid out yet, so fall back to the window width)
+        var width = ($('#'+this.container_id).width() || $(window).width()) - genome_coords_margin.left - genome_coords_margin.right;
+        var XHR = $.getJSON(window.model.url_prefix + 'api/coverage' + window.model.url_suffix, {width: Math.max(Math.round(width), 100)});
         $(function() {
             bootstrap_plot();
 
@@ -542,6 +544,8 @@ var variant_table = {
         },
     ],
 
+    cursors: {query: null, by_start: {}},
+
     update_filter_info: function() {
         window.model.filter_info.maf_ge = parseFloat($('input#maf_ge').val()) / 100; // %
         window.model.filter_info.maf_le = parseFloat($('input#maf_le').val()) / 100; // %
@@ -570,20 +574,29 @@ var variant_table = {
 
             scrollX: true,
 
-            ajax: {
-                url: window.model.url_prefix + 'api/variants' + window.model.url_suffix,
-                type: 'POST',
-                data: function(args) { /* modify request form parameters */
-                    return {
+            ajax: function(args, callback) {
+                /* the API returns a continuation token for the page after the one it sent; it's only valid for the same order, filters and page length */
+                var cursor_query = JSON.stringify([args.order, window.model.filter_info, args.length]);
+                if (variant_table.cursors.query !== cursor_query) { variant_table.cursors = {query: cursor_query, by_start: {}}; }
+                /* requests overlap when the user pages quickly, so each response files its token under the page it asked for */
+                var cursors = variant_table.cursors, start = args.start;
+                $.ajax({
+                    url: window.model.url_prefix + 'api/variants' + window.model.url_suffix,
+                    type: 'POST',
+                    dataType: 'json',
+                    data: {
                         args: JSON.stringify(args), // jsonify all params rather than using `columns[0][search][value]` php form syntax
                         filter_info: JSON.stringify(window.model.filter_info),
-                    };
-                },
-                dataSrc: function(resp) { /* modify API's response (for debugging) */
-                    window._debug = window._debug || {}; window._debug.resp = resp;
-                    variant_plot.change(resp.data);
-                    return resp.data;
-                },
+                        cursor: cursors.by_start[start] || '',
+                    },
+                })
+                    .done(function(resp) {
+                        window._debug = window._debug || {}; window._debug.resp = resp;
+                        if (resp.next_cursor) { cursors.by_start[start + resp.data.length] = resp.next_cursor; }
+                        variant_plot.change(resp.data);
+                        callback(resp);
+                    })
+                    .fail(function() { console.error('variants XHR failed'); });
             },
 
             order: [
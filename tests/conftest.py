@@ -0,0 +1,14 @@
+import os
+import sys
+
+import pytest
+
+# the servers and loaders are top-level modules of the repository, not a package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+@pytest.fixture(scope='session')
+def dataset(tmp_path_factory):
+    '''a small synthetic dataset (chromosome 22), as used by the load test; see `benchmarks/loadtest/fixtures.py`'''
+    from benchmarks.loadtest import fixtures
+    return fixtures.write_fixtures(str(tmp_path_factory.mktemp('dataset')), n_genes=4, variants_per_gene=200)
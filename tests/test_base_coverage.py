@@ -0,0 +1,57 @@
+import json
+import os
+import shutil
+import time
+
+import base_coverage
+from base_coverage import ColumnarCoverageFile, CoverageCache, CoverageFile, CoverageHandler
+from lookups import IntervalSet
+
+
+def test_coverage_file_returns_its_handle_before_the_rows_are_used(dataset):
+    path = os.path.join(dataset['coverage_directory'], 'full', '22.json.gz')
+    coverage_file = CoverageFile(path, False)
+    rows = coverage_file.get_coverage('22', 100000, 100100)
+    assert isinstance(rows, list) and len(rows) == 101
+    assert [key for _, key, _ in base_coverage._tabix_pool._idle].count((path, os.path.getmtime(path))) == 1
+
+
+def test_coverage_cache_evicts_least_recently_used_entries():
+    cache = CoverageCache(max_bytes=10)
+    cache.put('a', b'1234')
+    cache.put('b', b'1234')
+    assert cache.get('a') == b'1234' # now 'b' is the least recently used
+    cache.put('c', b'1234')
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (b'1234', None, b'1234')
+    cache.put('d', b'12345678901') # larger than the whole cache
+    assert cache.get('d') is None
+    assert cache.get_stats() == {'hits': 3, 'misses': 2, 'evictions': 1, 'entries': 2, 'bytes': 8, 'max_bytes': 10}
+
+
+def test_coverage_handler_clears_its_cache_when_a_file_changes(dataset, tmp_path):
+    path = str(tmp_path / '22.json.gz')
+    for suffix in ['', '.tbi']:
+        shutil.copy(os.path.join(dataset['coverage_directory'], 'full', '22.json.gz' + suffix), path + suffix)
+    handler = CoverageHandler([{'path': path, 'bp-min-length': 0}], cache_max_bytes=1000000, mtime_check_interval=0)
+    intervalset = IntervalSet.from_chrom_start_stop('22', 100000, 100100)
+    coverage_json = handler.get_coverage_json_for_intervalset(intervalset)
+    assert json.loads(coverage_json.decode('utf8')) == handler.get_coverage_for_intervalset(intervalset)
+    assert handler.get_coverage_json_for_intervalset(intervalset) == coverage_json
+    assert (handler.get_cache_stats()['misses'], handler.get_cache_stats()['hits']) == (1, 1)
+    os.utime(path, (time.time() + 10, time.time() + 10))
+    assert handler.get_coverage_json_for_intervalset(intervalset) == coverage_json
+    assert (handler.get_cache_stats()['misses'], handler.get_cache_stats()['entries']) == (2, 1)
+
+
+def test_columnar_coverage_file_matches_tabix_coverage_file(dataset):
+    directory = os.path.join(dataset['coverage_directory'], 'full')
+    tabix_file = CoverageFile(os.path.join(directory, '22.json.gz'), False)
+    columnar_file = ColumnarCoverageFile(os.path.join(directory, '22.columnar'))
+    assert columnar_file.get_chroms() == tabix_file.get_chroms()
+    for start, stop in [(100000, 100000), (100000, 100100), (98990, 99010), (111000, 119000), (200000, 300000)]:
+        tabix_rows = tabix_file.get_coverage('22', start, stop)
+        columnar_rows = columnar_file.get_coverage('22', start, stop)
+        assert [(row['chrom'], row['start'], row['end']) for row in columnar_rows] == [(row['chrom'], row['start'], row['end']) for row in tabix_rows]
+        for tabix_row, columnar_row in zip(tabix_rows, columnar_rows):
+            assert sorted(columnar_row) == sorted(tabix_row)
+            assert all(abs(columnar_row[key] - tabix_row[key]) < 1e-4 for key in tabix_row if key != 'chrom')
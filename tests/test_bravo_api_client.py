@@ -110,6 +110,9 @@ if currently_logged_in:
             assert line.split('\t')[0] == 'X', line
             assert len(line.split('\t')) == 8
 
+        proc = run(f'{exe} {bravo_fpath} query-region -c chrX -s 4000 -e 90000 -o vcf --parallel-chunks 4', head=50)
+        assert proc.stdout.decode().split('\n')[:50] == lines[:50], proc
+
     print()
     print('to log out, run:')
     print(f'"{random.choice(python_exes)}" "{bravo_fpath}" revoke')
@@ -0,0 +1,55 @@
+import importlib.machinery
+import importlib.util
+import os
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture(scope='module')
+def bravo():
+    '''the `bravo` command-line client, which is a script without a .py extension'''
+    loader = importlib.machinery.SourceFileLoader('bravo', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'static', 'tools', 'bravo'))
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader('bravo', loader))
+    loader.exec_module(module)
+    return module
+
+
+@pytest.mark.parametrize('start,end,n_chunks', [(1, 100, 1), (1, 100, 3), (10, 11, 5), (10, 10, 4), (5, 1000003, 7), (100, 120, 50)])
+def test_split_region_covers_the_region_once(bravo, start, end, n_chunks):
+    chunks = bravo._split_region(start, end, n_chunks)
+    assert 1 <= len(chunks) <= n_chunks
+    assert chunks[0][0] == start and chunks[-1][1] == end
+    for (start1, end1), (start2, end2) in zip(chunks, chunks[1:]):
+        assert start2 == end1 + 1
+    if end > start:
+        assert all(chunk_end - chunk_start + 1 >= 2 for chunk_start, chunk_end in chunks)
+    assert max(e - s for s, e in chunks) - min(e - s for s, e in chunks) <= 1 # evenly sized
+
+
+def test_prefetch_reads_ahead_up_to_depth(bravo):
+    consumed = []
+    reached = threading.Event()
+    def pages():
+        for i in range(10):
+            consumed.append(i)
+            if i == 2: reached.set()
+            yield i
+    items = bravo._prefetch(pages(), depth=2)
+    assert reached.wait(10) # started before the first item is asked for
+    time.sleep(0.1)
+    assert consumed == [0, 1, 2] # two items in the queue, and a third one waiting to be put
+    assert list(items) == list(range(10))
+
+
+def test_prefetch_raises_errors_after_the_items_before_them(bravo):
+    def pages():
+        yield 1
+        yield 2
+        raise bravo.BravoException('server failed')
+    items = bravo._prefetch(pages())
+    assert next(items) == 1
+    assert next(items) == 2
+    with pytest.raises(bravo.BravoException, match='server failed'):
+        next(items)
@@ -0,0 +1,113 @@
+import gzip
+import json
+import os
+import tempfile
+import time
+
+import pytest
+from compressed_cache import CompressedResponseCache
+from flask import Response
+from werkzeug.datastructures import Accept
+
+GZIP = Accept([('gzip', 1)])
+IDENTITY = Accept([('identity', 1)])
+
+
+class View(object):
+    '''a view that returns `body` and counts its calls'''
+
+    def __init__(self, body, status=200, mimetype='application/json'):
+        self.body, self.status, self.mimetype = body, status, mimetype
+        self.n_calls = 0
+
+    def __call__(self):
+        self.n_calls += 1
+        return Response(self.body, status=self.status, mimetype=self.mimetype)
+
+
+def make_body(n):
+    return json.dumps({'data': list(range(n))}).encode('utf-8')
+
+
+def get_cached_files(directory):
+    return sorted(filename for _, _, filenames in os.walk(str(directory)) for filename in filenames)
+
+
+def test_respond_compresses_once_and_serves_from_disk(tmp_path):
+    cache = CompressedResponseCache(str(tmp_path), 1000000)
+    view = View(make_body(1000))
+    for _ in range(3):
+        response = cache.respond('ab12', GZIP, view)
+        assert response.headers['Content-Encoding'] == 'gzip' and response.headers['Vary'] == 'Accept-Encoding'
+        assert gzip.decompress(response.get_data()) == make_body(1000)
+    assert view.n_calls == 1
+    assert get_cached_files(tmp_path) == ['ab12.gzip']
+    stats = cache.get_stats()
+    assert (stats['hits'], stats['misses']) == (2, 1)
+    # another process on the host shares the directory
+    other_view = View(b'')
+    assert gzip.decompress(CompressedResponseCache(str(tmp_path), 1000000).respond('ab12', GZIP, other_view).get_data()) == make_body(1000)
+    assert other_view.n_calls == 0
+
+
+@pytest.mark.parametrize('view', [View(make_body(10)), View(make_body(1000), status=404), View(make_body(1000), mimetype='text/plain')])
+def test_respond_does_not_cache_small_failed_or_non_json_responses(tmp_path, view):
+    cache = CompressedResponseCache(str(tmp_path), 1000000)
+    for _ in range(2):
+        response = cache.respond('ab12', GZIP, view)
+        assert response.get_data() == view.body and 'Content-Encoding' not in response.headers
+    assert view.n_calls == 2
+    assert get_cached_files(tmp_path) == []
+
+
+@pytest.mark.parametrize('directory,max_bytes,accept_encodings', [('', 1000000, GZIP), (None, 0, GZIP), (None, 1000000, IDENTITY)])
+def test_respond_calls_the_view_when_disabled_or_not_accepted(tmp_path, directory, max_bytes, accept_encodings):
+    cache = CompressedResponseCache(str(tmp_path) if directory is None else directory, max_bytes)
+    view = View(make_body(1000))
+    assert cache.respond('ab12', accept_encodings, view).get_data() == make_body(1000)
+    assert view.n_calls == 1
+    assert get_cached_files(tmp_path) == []
+
+
+def test_sweep_removes_least_recently_used_bodies(tmp_path):
+    cache = CompressedResponseCache(str(tmp_path), 1000000)
+    body_size = len(cache.compress(make_body(2000), 'gzip'))
+    cache = CompressedResponseCache(str(tmp_path), 3 * body_size)
+    now = time.time()
+    for i, key in enumerate(['aa01', 'bb02', 'cc03']):
+        cache.put(key, 'gzip', make_body(2000))
+        os.utime(cache._get_path(key, 'gzip'), (now - 100 + i, now - 100 + i))
+    assert cache.get('aa01', 'gzip') is not None # a hit makes aa01 the most recently used
+    cache.put('dd04', 'gzip', make_body(2000)) # more than a tenth of max_bytes since the last sweep
+    assert get_cached_files(tmp_path) == ['aa01.gzip', 'cc03.gzip', 'dd04.gzip']
+    assert cache.get_stats()['evictions'] == 1
+
+
+@pytest.mark.parametrize('failing', ['mkstemp', 'rename'])
+def test_respond_serves_uncached_bodies_when_the_disk_is_full(tmp_path, monkeypatch, failing):
+    def fail(*args, **kwargs):
+        raise OSError(28, 'No space left on device')
+    if failing == 'mkstemp': monkeypatch.setattr(tempfile, 'mkstemp', fail)
+    else: monkeypatch.setattr(os, 'rename', fail)
+    cache = CompressedResponseCache(str(tmp_path), 1000000)
+    view = View(make_body(1000))
+    response = cache.respond('ab12', GZIP, view)
+    assert response.status_code == 200 and response.get_data() == make_body(1000) and 'Content-Encoding' not in response.headers
+    assert get_cached_files(tmp_path) == [] # no temporary file is left behind
+
+
+def test_sweep_leaves_files_being_written_alone(tmp_path):
+    cache = CompressedResponseCache(str(tmp_path), 1000000)
+    body_size = len(cache.compress(make_body(2000), 'gzip'))
+    cache = CompressedResponseCache(str(tmp_path), 2 * body_size)
+    os.makedirs(str(tmp_path / 'ee'))
+    for name, age in [('.tmpwriting', 0), ('.tmpstale', 2 * cache.STALE_TMP_SECONDS)]:
+        path = str(tmp_path / 'ee' / name)
+        with open(path, 'wb') as ofile:
+            ofile.write(b'x' * 10 * body_size)
+        os.utime(path, (time.time() - age, time.time() - age))
+    cache.put('aa01', 'gzip', make_body(2000))
+    cache.put('bb02', 'gzip', make_body(2000))
+    # the file being written neither counts towards max_bytes nor is removed; the stale one is removed
+    assert get_cached_files(tmp_path) == ['.tmpwriting', 'aa01.gzip', 'bb02.gzip']
+    assert cache.get_stats()['evictions'] == 0
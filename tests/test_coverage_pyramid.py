@@ -0,0 +1,48 @@
+import math
+import os
+import sys
+
+import numpy
+from base_coverage import ColumnarCoverageFile, CoverageHandler
+from lookups import IntervalSet
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'base_coverage'))
+
+import coverage_pyramid
+
+
+def test_bin_means_count_uncovered_bases_as_zero():
+    starts = numpy.array([0, 1, 2, 3, 6, 7], dtype=numpy.int32) # bases 4 and 5 have no coverage
+    values = numpy.array([[10, 10]] * 6, dtype=numpy.float32)
+    bin_starts, bin_ends, bin_values = coverage_pyramid.aggregate(starts, starts, values, 3, ['mean', 'median'])
+    assert (bin_starts.tolist(), bin_ends.tolist()) == ([0], [7])
+    assert bin_values.tolist() == [[7.5, 7.5, 0, 10, 0, 10]] # means, then min/max of mean and median
+    bin_starts, bin_ends, bin_values = coverage_pyramid.aggregate(starts, starts, values, 1, ['mean', 'median'])
+    assert (bin_starts.tolist(), bin_ends.tolist()) == ([0, 2, 6], [1, 3, 7])
+    assert bin_values[:, 0].tolist() == [10, 10, 10] and bin_values[:, 2].tolist() == [10, 10, 10]
+
+
+def test_zoom_levels_match_full_coverage(dataset):
+    coverage_file = ColumnarCoverageFile(os.path.join(dataset['coverage_directory'], 'full', '22.columnar'))
+    start, stop = 90000, 150000 # over genes and the gaps between them
+    full = {row['start']: row['mean'] for row in coverage_file.get_coverage('22', start, stop)}
+    for level in [4, 9, coverage_file.get_levels()[-1]]:
+        for row in coverage_file.get_coverage('22', start, stop, level=level):
+            assert row['end'] - row['start'] < 2 ** level
+            if row['start'] > start and row['end'] < stop: # not clipped to the query
+                mean = sum(full.get(pos, 0) for pos in range(row['start'], row['end'] + 1)) / (row['end'] - row['start'] + 1.0)
+                assert abs(row['mean'] - mean) < 1e-3
+
+
+def test_coverage_handler_picks_the_coarsest_level_with_at_most_one_bin_per_pixel(dataset):
+    directory = os.path.join(dataset['coverage_directory'], 'full')
+    handler = CoverageHandler([{'path': os.path.join(directory, '22.columnar'), 'columnar': True, 'bp-min-length': 0}])
+    gene_start = 100000
+    intervalset = IntervalSet.from_chrom_start_stop('22', gene_start, gene_start + 9999) # covered everywhere
+    assert len(handler.get_coverage_for_intervalset(intervalset)) == 10000 # full resolution without a width
+    assert len(handler.get_coverage_for_intervalset(intervalset, width=10000)) == 10000 # 1 bp per pixel
+    for width in [1000, 300, 100, 10]:
+        level = int(math.floor(math.log(9999 / float(width), 2)))
+        coverage = handler.get_coverage_for_intervalset(intervalset, width=width)
+        assert max(row['end'] - row['start'] + 1 for row in coverage) == 2 ** level
+        assert width <= len(coverage) <= 2 * width + 1
@@ -0,0 +1,207 @@
+import collections
+import random
+import threading
+
+import lookups
+import pymongo
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+
+
+@pytest.fixture
+def db(monkeypatch):
+    '''an empty mongomock database, with a dataset cache of its own'''
+    monkeypatch.setattr(lookups, 'dataset_cache', lookups.DatasetCache(check_interval=0))
+    return mongomock.MongoClient().bravo
+
+
+def test_awesomebar_rsid_in_dbsnp_wins_over_gene_with_same_name(db):
+    db.search_terms.insert_many([
+        {'term': 'RS1', 'priority': lookups.SEARCH_TERM_PRIORITIES['gene_name'], 'type': 'gene', 'args': {'gene_id': 'ENSG00000102104'}},
+        {'term': 'RS2', 'priority': lookups.SEARCH_TERM_PRIORITIES['gene_name'], 'type': 'gene', 'args': {'gene_id': 'ENSG00000000002'}},
+        {'term': 'RS3', 'priority': lookups.SEARCH_TERM_PRIORITIES['rsid'], 'type': 'variant', 'args': {'variant_id': '1-300-A-G'}},
+        {'term': 'RS3', 'priority': lookups.SEARCH_TERM_PRIORITIES['gene_name'], 'type': 'gene', 'args': {'gene_id': 'ENSG00000000003'}},
+    ])
+    db.dbsnp.insert_one({'rsid': 1, 'xpos': 1000000100})
+    db.variants.insert_one({'xpos': 1000000100, 'variant_id': '1-100-A-T', 'rsids': []})
+    assert lookups.get_awesomebar_result(db, 'rs1') == ('variant', {'variant_id': '1-100-A-T'})
+    assert lookups.get_awesomebar_result(db, 'RS1') == ('variant', {'variant_id': '1-100-A-T'})
+    # no dbSNP entry, so the gene is found
+    assert lookups.get_awesomebar_result(db, 'rs2') == ('gene', {'gene_id': 'ENSG00000000002'})
+    # rsIDs of loaded variants are search terms themselves
+    assert lookups.get_awesomebar_result(db, 'rs3') == ('variant', {'variant_id': '1-300-A-G'})
+
+
+def test_awesomebar_without_search_terms_resolves_rsid_first(db):
+    db.genes.insert_one({'gene_id': 'ENSG00000102104', 'gene_name': 'RS1'})
+    db.variants.insert_many([
+        {'xpos': 1000000100, 'variant_id': '1-100-A-T', 'rsids': ['rs1']},
+        {'xpos': 1000000100, 'variant_id': '1-100-A-C', 'rsids': ['rs1']},
+    ])
+    assert lookups.get_awesomebar_result(db, 'rs1') == ('multi_variant_rsid', {'rsid': 'rs1'})
+    assert lookups.get_awesomebar_result(db, 'RS1') == ('multi_variant_rsid', {'rsid': 'rs1'})
+
+
+def test_dataset_cache_rebuilds_only_values_built_from_reloaded_collections():
+    db = mongomock.MongoClient().bravo
+    cache = lookups.DatasetCache(check_interval=0)
+    builds = []
+    def get(name, collections):
+        return cache.get(db, name, lambda: builds.append(name) or len(builds), collections)
+    assert (get('gene_models', ['genes', 'exons']), get('metrics', ['metrics']), get('coverage_handler', [])) == (1, 2, 3)
+    generation = cache.get_generation(db)
+    lookups.bump_dataset_generation(db, 'metrics', ['metrics'])
+    assert cache.get_generation(db) != generation # ETags change with any load
+    assert (get('gene_models', ['genes', 'exons']), get('metrics', ['metrics']), get('coverage_handler', [])) == (1, 4, 3)
+    lookups.bump_dataset_generation(db, 'genes', ['genes', 'transcripts', 'exons'])
+    assert (get('gene_models', ['genes', 'exons']), get('metrics', ['metrics']), get('coverage_handler', [])) == (5, 4, 3)
+    assert builds == ['gene_models', 'metrics', 'coverage_handler', 'metrics', 'gene_models']
+
+
+def test_dataset_cache_reads_generations_at_most_every_check_interval():
+    db = mongomock.MongoClient().bravo
+    cache = lookups.DatasetCache(check_interval=3600)
+    assert cache.get(db, 'metrics', lambda: 'old', ['metrics']) == 'old'
+    lookups.bump_dataset_generation(db, 'metrics', ['metrics'])
+    assert cache.get(db, 'metrics', lambda: 'new', ['metrics']) == 'old'
+
+
+def test_dataset_cache_builds_do_not_block_other_values():
+    db = mongomock.MongoClient().bravo
+    cache = lookups.DatasetCache(check_interval=0)
+    building, release = threading.Event(), threading.Event()
+    def slow_build():
+        building.set()
+        release.wait(10)
+        return 'gene models'
+    results = []
+    builder = threading.Thread(target=lambda: results.append(cache.get(db, 'gene_models', slow_build, ['genes'])))
+    waiter = threading.Thread(target=lambda: results.append(cache.get(db, 'gene_models', lambda: 'built twice', ['genes'])))
+    builder.start()
+    assert building.wait(10)
+    waiter.start()
+    assert cache.get(db, 'metrics', lambda: 'metrics', ['metrics']) == 'metrics' # while gene models are still being built
+    release.set()
+    builder.join(10); waiter.join(10)
+    assert results == ['gene models', 'gene models']
+
+
+def test_mongo_match_after_follows_sort_order_with_nulls_and_ties():
+    db = mongomock.MongoClient().bravo
+    values = [None, 1, 2]
+    documents = []
+    for a in values + ['missing']:
+        for b in values + ['missing']:
+            for _ in range(2): # the same (a, b) twice, so that only `_id` tells them apart
+                document = {'_id': len(documents)}
+                if a != 'missing': document['a'] = a
+                if b != 'missing': document['b'] = b
+                documents.append(document)
+    db.variants.insert_many(documents)
+    mongo_sort = collections.OrderedDict([('a', pymongo.ASCENDING), ('b', pymongo.DESCENDING), ('_id', pymongo.ASCENDING)])
+    # mongo order: null/missing first when ascending and last when descending
+    def sort_key(d):
+        a, b = d.get('a'), d.get('b')
+        return (a is not None, a or 0, b is None, -(b or 0), d['_id'])
+    ordered = sorted(documents, key=sort_key)
+    for i, last in enumerate(ordered):
+        mongo_match = lookups._get_mongo_match_after(mongo_sort, [last.get(key) for key in mongo_sort])
+        assert sorted(d['_id'] for d in db.variants.find(mongo_match)) == sorted(d['_id'] for d in ordered[i + 1:])
+
+
+def test_variants_subset_counts_each_variant_once(db):
+    # the second exon starts where the padding of the first one ends, so the two regions touch at 1-1120
+    intervalset = lookups.IntervalSet._from_exons([{'chrom': '1', 'start': 1000, 'stop': 1100}, {'chrom': '1', 'start': 1140, 'stop': 1200}, {'chrom': '1', 'start': 2000, 'stop': 2100}])
+    db.variants.insert_many([{'xpos': 1000000000 + pos, 'pos': pos, 'filter': 'PASS' if pos % 2 else 'SVM'} for pos in range(900, 2300, 5)])
+    columns = [{'name': name} for name in ['allele', 'pos']]
+    order = [{'column': 1, 'dir': 'asc'}]
+    for filter_info in [{}, {'filter_value': 'PASS'}]:
+        mongo_match = lookups.build_variants_subset_query(intervalset, columns, order, filter_info)[0]
+        result = lookups.get_variants_subset_for_intervalset(db, intervalset, columns, order, filter_info, 0, 10)
+        assert result['recordsFiltered'] == db.variants.count_documents({'$and': mongo_match}) > 10
+
+
+@pytest.fixture
+def gene_models_db(dataset, db, monkeypatch):
+    import manage
+    monkeypatch.setattr(manage, 'get_db_connection', lambda: db)
+    manage.load_gene_models(dataset['canonical_transcripts'], dataset['omim'], dataset['genenames'], dataset['gencode'])
+    # one more transcript per gene, which is missing from `transcripts`, overlaps the others and has an exon as long as the gene
+    for gene in list(db.genes.find()):
+        exons = [dict(exon, transcript_id='ENST99999999999' + exon['gene_id'][-1], start=exon['start'] + 7, xstart=exon['xstart'] + 7) for exon in list(db.exons.find({'gene_id': gene['gene_id']}, {'_id': False}))[::2]]
+        exons[0].update(feature_type='exon', stop=gene['stop'], xstop=gene['xstop'])
+        db.exons.insert_many(exons)
+    return db
+
+
+EXON_KEYS = ['gene_id', 'transcript_id', 'chrom', 'start', 'stop', 'feature_type', 'strand']
+
+def sorted_exons(exons):
+    return sorted(tuple(exon[key] for key in EXON_KEYS) for exon in exons)
+
+
+def test_gene_model_index_answers_like_the_collections(gene_models_db):
+    db = gene_models_db
+    index = lookups.GeneModelIndex.get(db)
+    features = {'feature_type': {'$in': lookups.GeneModelIndex.FEATURE_TYPES}}
+    genes = list(db.genes.find())
+    assert len(genes) == 4
+    for gene in genes:
+        assert sorted_exons(index.get_exons_for_gene(gene['gene_id'])) == sorted_exons(db.exons.find(dict(features, gene_id=gene['gene_id'])))
+        assert index.get_gene_name_and_canonical_transcript(gene['gene_id']) == (gene['gene_name'], gene.get('canonical_transcript'))
+        assert str(lookups.IntervalSet.from_gene(db, gene['gene_id'])) == str(lookups.IntervalSet._from_exons(db.exons.find(dict(features, gene_id=gene['gene_id']))))
+        for start in range(gene['start'] - 100, gene['stop'] + 100, 997):
+            xstart, xstop = lookups.Xpos.from_chrom_pos(gene['chrom'], start), lookups.Xpos.from_chrom_pos(gene['chrom'], start + 300)
+            assert sorted_exons(index.get_exons_overlapping('chr' + gene['chrom'], start, start + 300)) == sorted_exons(db.exons.find(dict(features, xstop={'$gte': xstart}, xstart={'$lte': xstop})))
+    transcript_ids = db.exons.distinct('transcript_id')
+    assert len(transcript_ids) == 12
+    for transcript_id in transcript_ids:
+        assert sorted_exons(index.get_exons_for_transcript(transcript_id)) == sorted_exons(db.exons.find(dict(features, transcript_id=transcript_id)))
+        transcript = db.transcripts.find_one({'transcript_id': transcript_id})
+        if transcript is not None:
+            assert index.get_transcript_start_stop(transcript_id) == (transcript['start'], transcript['stop'])
+        else:
+            exons = list(db.exons.find(dict(features, transcript_id=transcript_id)))
+            assert index.get_transcript_start_stop(transcript_id) == (min(e['start'] for e in exons), max(e['stop'] for e in exons))
+    assert index.get_exons_for_gene('ENSG99999999999') == [] and index.get_exons_overlapping('21', 1, 1000000000) == []
+
+
+def test_prefix_index_ranks_exact_then_shorter_then_alphabetical_matches():
+    index = lookups.PrefixIndex(['PCSK9', 'pcsk', 'PCSK1N', 'PCSK1', 'PCS', 'APCS', 'PCSK9', 'Pcsk2', 'PC'])
+    assert index.search('pcs', 10) == ['PCS', 'pcsk', 'PCSK1', 'Pcsk2', 'PCSK9', 'PCSK1N']
+    assert index.search('PCSK', 3) == ['pcsk', 'PCSK1', 'Pcsk2']
+    assert index.search('pcsk1n', 10) == ['PCSK1N']
+    assert index.search('pcsk1nx', 10) == [] and index.search('b', 10) == []
+
+
+def test_prefix_index_matches_a_scan_of_all_strings():
+    rng = random.Random(1)
+    strings = [''.join(rng.choice('abAB1-') for _ in range(rng.randint(1, 6))) for _ in range(2000)]
+    index = lookups.PrefixIndex(strings)
+    for query in ['', 'a', 'A', 'ab', 'aB1', 'b-', '1', 'abab', 'zz']:
+        matches = sorted(set(s for s in strings if s.casefold().startswith(query.casefold())), key=lambda s: (len(s), s.casefold(), s))
+        assert index.search(query, 10) == matches[:10]
+
+
+def test_awesomebar_suggestions_rank_genes_before_rsids_in_numeric_order(db):
+    db.dbsnp.insert_many([{'rsid': rsid} for rsid in [2, 1, 12, 100, 10, 1999, 11, 21]])
+    index = lookups.PrefixIndex(['RS1', 'RS1B', 'RSPO1'])
+    assert lookups.get_awesomebar_suggestions(index, 'rs1', db) == ['RS1', 'RS1B', 'rs1', 'rs10', 'rs11', 'rs12', 'rs100', 'rs1999']
+    assert lookups.get_awesomebar_suggestions(index, 'rs', db) == ['RS1', 'RS1B', 'RSPO1', 'rs1', 'rs2', 'rs10', 'rs11', 'rs12', 'rs21', 'rs100']
+
+
+def test_variants_csv_yields_the_header_first_then_chunks_of_rows(db):
+    db.variants.insert_many([{'xpos': 1000000000 + pos, 'chrom': '1', 'pos': pos, 'ref': 'A', 'alt': 'C', 'rsids': ['rs{}'.format(pos), 'rs1'], 'genes': ['G1'],
+                              'filter': 'PASS', 'allele_num': 100, 'quality_metrics': {'DP': pos}} for pos in range(1000, 1025)])
+    intervalset = lookups.IntervalSet.from_chrom_start_stop('1', 1000, 1020)
+    chunks = lookups.get_variants_csv_for_intervalset(db, intervalset, rows_per_chunk=10)
+    header = next(chunks) # before any row was read
+    assert header == ','.join(lookups.CSV_FIELDS) + '\r\n'
+    chunks = list(chunks)
+    assert all(isinstance(chunk, str) for chunk in chunks)
+    assert [chunk.count('\n') for chunk in chunks] == [10, 10, 1]
+    rows = [row.split(',') for chunk in chunks for row in chunk.splitlines()]
+    assert rows[0] == ['1', '1000', 'A', 'C', 'rs1000|rs1', 'PASS', 'G1', '100', '', '', '', '', '1000', '']
+    assert [row[1] for row in rows] == [str(pos) for pos in range(1000, 1021)]
+    assert list(lookups.get_variants_csv_for_intervalset(db, intervalset, rows_per_chunk=21))[1:] == [''.join(chunks)]
@@ -0,0 +1,192 @@
+import collections
+import json
+import multiprocessing.dummy
+import os
+import random
+import threading
+
+import bson
+import lookups
+import manage
+import parsing
+import pysam
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = mongomock.MongoClient().bravo
+    monkeypatch.setattr(manage, 'get_db_connection', lambda: db)
+    monkeypatch.setattr(manage, 'mongo_host', 'localhost', raising=False)
+    monkeypatch.setattr(manage, 'mongo_port', 27017, raising=False)
+    monkeypatch.setattr(manage, 'mongo_db_name', 'bravo', raising=False)
+    monkeypatch.setattr(manage, 'MIN_CHUNK_BYTES', 1) # many small chunks even for small files
+    monkeypatch.setattr(lookups, 'dataset_cache', lookups.DatasetCache(check_interval=0)) # nothing cached for another test's database
+    # mongomock can't insert RawBSONDocument, which the staged loader inserts without decoding
+    insert_many = mongomock.collection.Collection.insert_many
+    monkeypatch.setattr(mongomock.collection.Collection, 'insert_many', lambda self, documents, *args, **kwargs: insert_many(self, [bson.decode(d.raw) if hasattr(d, 'raw') else d for d in documents], *args, **kwargs))
+    return db
+
+
+def get_keys(documents):
+    return collections.Counter((d['xpos'], d['ref'], d['alt']) for d in documents)
+
+
+def read_whole_file(path):
+    return get_keys(parsing.get_variants_from_sites_vcf(path, 'chr22', None, None, True))
+
+
+def load_staged(dataset, staging_directory, threads=4):
+    manage._write_chunks_to_collection([dataset['variants']], threads, 'variants', parsing.get_variants_from_sites_vcf, drop_collections=['variants'], staging_directory=str(staging_directory))
+
+
+def test_chunks_load_every_variant_exactly_once(db, dataset):
+    chunks = manage.get_file_contig_chunks([dataset['variants']], 8)
+    assert len(chunks) > 4
+    assert [chunk[4] for chunk in chunks] == sorted((chunk[4] for chunk in chunks), reverse=True) # largest first
+    for chunk in chunks:
+        manage._write_to_collection(chunk, 'variants', parsing.get_variants_from_sites_vcf)
+    loaded = get_keys(db.variants.find())
+    assert loaded == read_whole_file(dataset['variants'])
+    assert max(loaded.values()) == 1
+
+
+def test_dbsnp_chunks_load_every_rsid_exactly_once(db, tmp_path):
+    # dbSNP positions are 0-based, so chunk boundaries are where off-by-one errors would show
+    path = str(tmp_path / 'dbsnp.tsv')
+    rng = random.Random(1)
+    with open(path, 'w') as ofile:
+        for rsid, pos0 in enumerate(sorted(rng.randint(0, 1000000) for _ in range(20000))):
+            ofile.write('{}\tchr22\t{}\n'.format(rsid, pos0))
+    path = pysam.tabix_index(path, seq_col=1, start_col=2, end_col=2, zerobased=True)
+    chunks = manage.get_file_contig_chunks([path], 8)
+    assert len(chunks) > 4
+    for chunk in chunks:
+        manage._write_to_collection(chunk, 'dbsnp', parsing.get_snp_from_dbsnp_file)
+    loaded = collections.Counter((d['xpos'], d['rsid']) for d in db.dbsnp.find())
+    assert loaded == collections.Counter((d['xpos'], d['rsid']) for d in parsing.get_snp_from_dbsnp_file(path, 'chr22', None, None, True))
+    assert sum(loaded.values()) == 20000
+
+
+def interrupt_staged_load(dataset, staging_directory, monkeypatch, n_chunks):
+    """inserts `n_chunks` chunks and half of the next one, then fails"""
+    insert_staged_chunk = manage._insert_staged_chunk
+    calls = []
+    def interrupted_insert_staged_chunk(db, collection, path):
+        calls.append(path)
+        if len(calls) <= n_chunks:
+            return insert_staged_chunk(db, collection, path)
+        with open(path, 'rb') as ifile:
+            documents = bson.decode_all(ifile.read())
+        db[collection].insert_many(documents[:len(documents) // 2])
+        raise RuntimeError('interrupted')
+    with monkeypatch.context() as m:
+        m.setattr(manage, '_insert_staged_chunk', interrupted_insert_staged_chunk)
+        with pytest.raises(RuntimeError):
+            load_staged(dataset, staging_directory)
+
+
+def test_staged_load_resumes_after_crash_in_the_middle_of_a_chunk(db, dataset, tmp_path, monkeypatch):
+    interrupt_staged_load(dataset, tmp_path, monkeypatch, 2)
+    manifest = json.loads((tmp_path / manage.STAGING_MANIFEST).read_text())
+    assert sum(chunk['inserted'] for chunk in manifest['chunks']) == 2
+    assert 0 < db.variants.count_documents({}) < sum(read_whole_file(dataset['variants']).values())
+    load_staged(dataset, tmp_path, threads=2) # resumed, although the number of threads changed
+    assert get_keys(db.variants.find()) == read_whole_file(dataset['variants'])
+    assert os.listdir(str(tmp_path)) == [] # chunk files and the manifest are removed
+
+
+def test_staged_load_starts_from_scratch_after_a_complete_load(db, dataset, tmp_path):
+    load_staged(dataset, tmp_path)
+    load_staged(dataset, tmp_path)
+    assert get_keys(db.variants.find()) == read_whole_file(dataset['variants'])
+    db.variants.drop()
+    load_staged(dataset, tmp_path)
+    assert get_keys(db.variants.find()) == read_whole_file(dataset['variants'])
+
+
+def test_staged_load_does_not_resume_into_a_dropped_collection(db, dataset, tmp_path, monkeypatch):
+    interrupt_staged_load(dataset, tmp_path, monkeypatch, 2)
+    db.variants.drop()
+    load_staged(dataset, tmp_path)
+    assert get_keys(db.variants.find()) == read_whole_file(dataset['variants'])
+
+
+def test_staged_load_does_not_resume_into_another_database(db, dataset, tmp_path, monkeypatch):
+    interrupt_staged_load(dataset, tmp_path, monkeypatch, 2)
+    other_db = mongomock.MongoClient().other
+    monkeypatch.setattr(manage, 'get_db_connection', lambda: other_db)
+    monkeypatch.setattr(manage, 'mongo_db_name', 'other')
+    load_staged(dataset, tmp_path)
+    assert get_keys(other_db.variants.find()) == read_whole_file(dataset['variants'])
+
+
+def test_staged_load_fails_instead_of_hanging_when_the_manifest_cannot_be_written(db, dataset, tmp_path, monkeypatch):
+    write_staging_manifest = manage._write_staging_manifest
+    def failing_write_staging_manifest(staging_directory, manifest):
+        if any(chunk['parsed'] is not None for chunk in manifest['chunks']):
+            raise OSError(28, 'No space left on device')
+        write_staging_manifest(staging_directory, manifest)
+    monkeypatch.setattr(manage, '_write_staging_manifest', failing_write_staging_manifest)
+    errors = []
+    def load():
+        try: load_staged(dataset, tmp_path)
+        except OSError as e: errors.append(e)
+    loader = threading.Thread(target=load, daemon=True)
+    loader.start()
+    loader.join(60)
+    assert not loader.is_alive()
+    assert len(errors) == 1 and errors[0].errno == 28
+
+
+@pytest.fixture
+def variants_db(db, dataset, monkeypatch):
+    # mongomock lacks $strLenBytes, which the summaries use to tell indels from SNPs
+    handle_string_operator = mongomock.aggregate._Parser._handle_string_operator
+    def _handle_string_operator(self, operator, values):
+        if operator == '$strLenBytes': return len(self.parse(values).encode('utf-8'))
+        return handle_string_operator(self, operator, values)
+    monkeypatch.setattr(mongomock.aggregate._Parser, '_handle_string_operator', _handle_string_operator)
+    manage.load_gene_models(dataset['canonical_transcripts'], dataset['omim'], dataset['genenames'], dataset['gencode'])
+    for chunk in manage.get_file_contig_chunks([dataset['variants']], 4):
+        manage._write_to_collection(chunk, 'variants', parsing.get_variants_from_sites_vcf)
+    return db
+
+
+def test_summaries_equal_live_counts(variants_db, monkeypatch):
+    db = variants_db
+    monkeypatch.setattr(manage.multiprocessing, 'Pool', multiprocessing.dummy.Pool) # worker processes wouldn't share the mongomock database
+    manage.load_summaries(2)
+
+    for key, collection, get_summary, from_id in [('gene_id', db.genes, lookups.get_summary_for_gene, lookups.IntervalSet.from_gene),
+                                                  ('transcript_id', db.transcripts, lookups.get_summary_for_transcript, lookups.IntervalSet.from_transcript)]:
+        ids = collection.distinct(key)
+        assert len(ids) >= 4 and db.summaries.count_documents({key: {'$in': ids}}) == len(ids)
+        totals = collections.Counter()
+        for id in ids:
+            live = lookups.get_summary_counts_for_intervalset(db, from_id(db, id))
+            totals.update(live)
+            summary = db.summaries.find_one({key: id}, projection={'_id': False, key: False})
+            assert summary == live
+            assert get_summary(db, id) == lookups._summary_counts_to_table(live)
+        assert all(totals[name] > 0 for name in lookups.SUMMARY_KEYS if name != 'lof_lc') # the fixture has no low-confidence LoF
+
+
+def test_summaries_fall_back_to_live_counts(variants_db):
+    db = variants_db
+    gene_id = db.genes.find_one()['gene_id']
+    transcript_id = db.transcripts.find_one({'gene_id': gene_id})['transcript_id']
+    live_gene = lookups.get_summary_for_intervalset(db, lookups.IntervalSet.from_gene(db, gene_id))
+    live_transcript = lookups.get_summary_for_intervalset(db, lookups.IntervalSet.from_transcript(db, transcript_id))
+    # stored summaries are served as they are
+    db.summaries.insert_many([dict(lookups.get_summary_counts_for_intervalset(db, lookups.IntervalSet.from_gene(db, gene_id)), gene_id=gene_id),
+                              dict(lookups.get_summary_counts_for_intervalset(db, lookups.IntervalSet.from_transcript(db, transcript_id)), transcript_id=transcript_id)])
+    db.summaries.update_many({}, {'$inc': {'total': 1000}})
+    assert lookups.get_summary_for_gene(db, gene_id)[0][1] == live_gene[0][1] + 1000
+    assert lookups.get_summary_for_transcript(db, transcript_id)[0][1] == live_transcript[0][1] + 1000
+    db.summaries.delete_many({'gene_id': gene_id})
+    assert lookups.get_summary_for_gene(db, gene_id) == live_gene
+    db.summaries.drop()
+    assert lookups.get_summary_for_transcript(db, transcript_id) == live_transcript
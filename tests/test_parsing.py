@@ -0,0 +1,36 @@
+import pysam
+
+import parsing
+
+VEP_FIELDS = ['Allele', 'Consequence', 'Gene', 'Feature', 'HGVSc', 'HGVSp', 'Existing_variation', 'ALLELE_NUM', 'CANONICAL', 'AFR_AF', 'AMR_AF', 'EAS_AF', 'EUR_AF', 'SAS_AF', 'LoF']
+HEADER = '''##fileformat=VCFv4.2
+##FILTER=<ID=PASS,Description="All filters passed">
+##contig=<ID=chr22,length=50818468>
+##INFO=<ID=AN,Number=1,Type=Integer,Description="Number of Alleles in Samples with Coverage">
+##INFO=<ID=AC,Number=A,Type=Integer,Description="Alternate Allele Counts in Samples with Coverage">
+##INFO=<ID=AF,Number=A,Type=Float,Description="Alternate Allele Frequencies">
+##INFO=<ID=Hom,Number=A,Type=Integer,Description="Homozygous Counts">
+##INFO=<ID=AVGDP,Number=1,Type=Float,Description="Average per sample">
+##INFO=<ID=AVGDP_R,Number=R,Type=Float,Description="Average per sample carrying allele">
+##INFO=<ID=AVGGQ,Number=1,Type=Float,Description="Average per sample">
+##INFO=<ID=AVGGQ_R,Number=R,Type=Float,Description="Average per sample carrying allele">
+##INFO=<ID=CSQ,Number=.,Type=String,Description="Consequence annotations from Ensembl VEP. Format: {}">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO
+'''.format('|'.join(VEP_FIELDS))
+
+
+def make_annotation(allele_num, consequence, canonical, lof):
+    return '|'.join([['T', 'G'][allele_num - 1], consequence, 'ENSG01', 'ENST0{}'.format(canonical), '', '', '', str(allele_num), 'YES' if canonical else '', '', '', '', '', '', lof])
+
+
+def test_variants_from_sites_vcf_carry_het_count_and_worst_csq_lof_lc(tmp_path):
+    # the first allele's most severe annotation (stop_gained on the canonical transcript) is low-confidence LoF; the second allele's is high-confidence LoF (stop_gained, even though it is not canonical)
+    csq = ','.join([make_annotation(1, 'synonymous_variant', 0, ''), make_annotation(1, 'stop_gained', 1, 'LC'), make_annotation(2, 'missense_variant', 1, ''), make_annotation(2, 'stop_gained', 0, 'HC')])
+    path = str(tmp_path / 'variants.vcf')
+    with open(path, 'w') as ofile:
+        ofile.write(HEADER)
+        ofile.write('chr22\t1000\t.\tC\tT,G\t100\tPASS\tAN=2000;AC=7,3;AF=0.0035,0.0015;Hom=2,0;AVGDP=30;AVGDP_R=30,31,32;AVGGQ=90;AVGGQ_R=90,91,92;CSQ={}\n'.format(csq))
+    pysam.tabix_index(path, preset='vcf', force=True)
+    variants = list(parsing.get_variants_from_sites_vcf(path + '.gz', 'chr22', 0, 2000, histograms=False))
+    assert [(v['variant_id'], v['het_count'], v['worst_csq_lof_lc']) for v in variants] == [('22-1000-C-T', 3, True), ('22-1000-C-G', 3, False)]
+    assert [v['worst_csqidx'] for v in variants] == [parsing.Consequence.csqidxs['stop_gained'], parsing.Consequence.csqidxs['stop_gained']]
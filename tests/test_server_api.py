@@ -0,0 +1,194 @@
+import importlib.util
+import os
+
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+
+
+@pytest.fixture(scope='module')
+def server_api(tmp_path_factory):
+    '''server-api.py, configured to keep its response cache in a temporary directory'''
+    tmp = tmp_path_factory.mktemp('server_api')
+    config = tmp / 'config.py'
+    config.write_text("RESPONSE_CACHE_DIRECTORY = '{}'\n".format(tmp / 'response_cache'))
+    os.environ['BRAVO_CONFIG_FILE'] = str(config)
+    try:
+        spec = importlib.util.spec_from_file_location('server_api', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server-api.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        del os.environ['BRAVO_CONFIG_FILE']
+    return module
+
+
+@pytest.fixture
+def db(server_api, monkeypatch):
+    db = mongomock.MongoClient().bravo
+    monkeypatch.setattr(server_api, 'get_db', lambda: db)
+    monkeypatch.setattr(server_api, 'request_is_valid', lambda: True)
+    return db
+
+
+@pytest.fixture
+def client(server_api, db):
+    return server_api.app.test_client()
+
+
+def make_record(chrom, pos, ref, alt, allele_count):
+    return {'xpos': (1000000000 * (23 if chrom == 'X' else int(chrom))) + pos, 'chrom': chrom, 'pos': pos, 'ref': ref, 'alt': alt,
+            'allele_num': 1000, 'allele_count': allele_count, 'allele_freq': allele_count / 1000.0, 'filter': 'PASS'}
+
+
+RECORDS = [make_record('1', 100, 'A', 'C', 1), make_record('1', 100, 'A', 'G', 2), make_record('1', 200, 'T', 'C', 3),
+           make_record('2', 50, 'G', 'A', 4), make_record('2', 300, 'C', 'T', 5), make_record('X', 10, 'A', 'T', 6)]
+
+
+class Seeker(object):
+    '''the `seek` argument of merge_join over a list of records; counts how often a cursor is opened'''
+
+    def __init__(self, records):
+        self.records = sorted(records, key=lambda r: r['xpos'])
+        self.n_seeks = 0
+
+    def __call__(self, xpos):
+        self.n_seeks += 1
+        chrom_xstop = xpos - xpos % 1000000000 + 999999999
+        return iter([r for r in self.records if xpos <= r['xpos'] <= chrom_xstop])
+
+
+def site(record):
+    return (record['xpos'], record['chrom'], record['pos'], record['ref'], record['alt'])
+
+
+def join(server_api, sites, seek, **kwargs):
+    return [(s, r['allele_count'] if r is not None else None) for s, r in server_api.merge_join(iter(sites), seek, **kwargs)]
+
+
+def test_merge_join_walks_one_cursor_per_chromosome(server_api):
+    missing = (1000000000 + 150, '1', 150, 'A', 'C')
+    sites = [site(RECORDS[1]), site(RECORDS[0]), missing, site(RECORDS[2]), site(RECORDS[4]), site(RECORDS[5])]
+    seek = Seeker(RECORDS)
+    assert join(server_api, sites, seek) == list(zip(sites, [2, 1, None, 3, 5, 6]))
+    assert seek.n_seeks == 3
+
+
+def test_merge_join_answers_unsorted_sites_in_input_order(server_api):
+    sites = [site(r) for r in reversed(RECORDS)] + [site(RECORDS[0]), site(RECORDS[0])]
+    assert join(server_api, sites, Seeker(RECORDS)) == [(s, r['allele_count']) for s, r in zip(sites, list(reversed(RECORDS)) + [RECORDS[0], RECORDS[0]])]
+
+
+def test_merge_join_reopens_its_cursor_after_skipping_too_many_records(server_api):
+    records = [make_record('1', pos, 'A', 'C', pos) for pos in range(1, 101)]
+    seek = Seeker(records)
+    assert join(server_api, [site(records[0]), site(records[99])], seek, max_skip=10) == [(site(records[0]), 1), (site(records[99]), 100)]
+    assert seek.n_seeks == 2
+    seek = Seeker(records)
+    assert join(server_api, [site(records[0]), site(records[5])], seek, max_skip=10) == [(site(records[0]), 1), (site(records[5]), 6)]
+    assert seek.n_seeks == 1
+
+
+def test_annotate(client, db):
+    db.variants.insert_many([dict(r) for r in RECORDS])
+    body = '#CHROM\tPOS\tREF\tALT\n2\t300\tC\tT\n\n1\t100\tA\tG\n1\t150\tA\tC\nX\t10\tA\tT\n1\t100\tA\tC\n'
+    response = client.post('/api/annotate', data=body, content_type='text/plain')
+    assert response.status_code == 200
+    assert response.get_data(as_text=True).splitlines() == [
+        '2\t300\tC\tT\t1000\t5\t0.005\tPASS',
+        '1\t100\tA\tG\t1000\t2\t0.002\tPASS',
+        '1\t150\tA\tC\t.\t.\t.\t.',
+        'X\t10\tA\tT\t1000\t6\t0.006\tPASS',
+        '1\t100\tA\tC\t1000\t1\t0.001\tPASS']
+    response = client.post('/api/annotate?allele_count=gt:1', data=body, content_type='text/plain')
+    assert [line.split('\t')[5] for line in response.get_data(as_text=True).splitlines()] == ['5', '2', '.', '6', '.']
+
+
+def test_annotate_reports_malformed_lines(client, db):
+    response = client.post('/api/annotate', data='1\t100\tA\n', content_type='text/plain')
+    assert response.status_code == 400
+    assert 'CHROM, POS, REF and ALT' in response.get_json()['error']
+    # the response has started by the time a later line is read, so it ends with an error line
+    response = client.post('/api/annotate', data='1\t100\tA\tC\n1\tabc\tA\tC\n', content_type='text/plain')
+    assert response.status_code == 200
+    assert response.get_data(as_text=True).splitlines() == ['1\t100\tA\tC\t.\t.\t.\t.', '#ERROR\tInvalid position.']
+
+
+def make_variant(server_api, n_annotations=1):
+    record = make_record('1', 100, 'A', 'C', 1)
+    record.update(variant_id='1-100-A-C', site_quality=100.0, rsids=['rs100'], avgdp=30.0, avgdp_alt=31.0, avggq=90.0, avggq_alt=91.0,
+                  vep_annotations=[{key: '{}{}'.format(key, i) for key in server_api.annotations_ordered} for i in range(n_annotations)])
+    return record
+
+
+def test_conditional_get_answers_304_until_the_dataset_changes(server_api, client, db, monkeypatch):
+    import lookups
+    monkeypatch.setattr(lookups, 'dataset_cache', lookups.DatasetCache(check_interval=0))
+    db.variants.insert_one(make_variant(server_api))
+    response = client.get('/api/variant?variant_id=1-100-A-C')
+    assert response.status_code == 200 and response.get_json()['data'][0]['allele_count'] == 1
+    etag = response.headers['ETag']
+    assert etag.startswith('W/') and response.headers['Vary'] == 'Accept-Encoding'
+    assert client.get('/api/variant?variant_id=1-100-A-C').headers['ETag'] == etag
+    assert client.get('/api/variant?variant_id=1-100-A-C&vcf=1').headers['ETag'] != etag
+    response = client.get('/api/variant?variant_id=1-100-A-C', headers={'If-None-Match': etag})
+    assert response.status_code == 304 and response.get_data() == b''
+    assert response.headers['ETag'] == etag and 'Cache-Control' in response.headers and response.headers['Vary'] == 'Accept-Encoding'
+    # loading data bumps the dataset generation, which changes every ETag
+    db.variants.update_one({}, {'$set': {'allele_count': 2}})
+    lookups.bump_dataset_generation(db, 'variants', ['variants'])
+    response = client.get('/api/variant?variant_id=1-100-A-C', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.get_json()['data'][0]['allele_count'] == 2
+    assert response.headers['ETag'] != etag
+    # errors are neither cached nor given an ETag
+    response = client.get('/api/variant?variant_id=1-100-A')
+    assert response.status_code == 400 and 'ETag' not in response.headers
+
+
+def test_variants_batch_answers_in_input_order(server_api, client, db):
+    variants = []
+    for record in RECORDS:
+        variant = make_variant(server_api)
+        variant.update(record, variant_id='{}-{}-{}-{}'.format(record['chrom'], record['pos'], record['ref'], record['alt']), rsids=['rs{}'.format(record['allele_count'])])
+        variants.append(variant)
+    variants[1]['rsids'] = ['rs1'] # rs1 names both alleles at 1-100
+    db.variants.insert_many(variants)
+    variant_ids = ['X-10-A-T', 'rs1', '2-50-G-A', '1-100-A-G', 'rs99', '2-300-C-G', 'X-10-A-T', 'rs5']
+    response = client.post('/api/variants/batch', json={'variants': variant_ids})
+    assert response.status_code == 200
+    result = response.get_json()
+    assert result['format'] == 'json'
+    assert [v['variant_id'] for v in result['data']] == ['X-10-A-T', '1-100-A-C', '1-100-A-G', '2-50-G-A', '1-100-A-G', 'X-10-A-T', '2-300-C-T']
+    assert result['not_found'] == ['rs99', '2-300-C-G']
+    assert result['data'][0]['annotations'] == [{key: '{}0'.format(key) for key in server_api.annotations_ordered}]
+    assert all('xpos' not in v and '_id' not in v and 'vep_annotations' not in v for v in result['data'])
+
+    response = client.post('/api/variants/batch', json={'variants': variant_ids, 'vcf': True})
+    result = response.get_json()
+    assert result['format'] == 'vcf' and result['header'] == server_api.vcf_header and result['meta'] == server_api.vcf_meta
+    assert [line.split('\t')[:5] for line in result['data']] == [
+        ['X', '10', 'rs6', 'A', 'T'], ['1', '100', 'rs1', 'A', 'C'], ['1', '100', 'rs1', 'A', 'G'], ['2', '50', 'rs4', 'G', 'A'],
+        ['1', '100', 'rs1', 'A', 'G'], ['X', '10', 'rs6', 'A', 'T'], ['2', '300', 'rs5', 'C', 'T']]
+    assert result['not_found'] == ['rs99', '2-300-C-G']
+
+
+def test_variants_batch_rejects_malformed_requests(server_api, client, db, monkeypatch):
+    response = client.post('/api/variants/batch', json={'variants': ['1-100-A']})
+    assert response.status_code == 400 and response.get_json()['error'] == 'Invalid variant name format: 1-100-A.'
+    response = client.post('/api/variants/batch', json={'variants': ['chrQ-100-A-C']})
+    assert response.status_code == 400 and response.get_json()['error'] == 'Invalid chromosome name: chrQ-100-A-C.'
+    assert client.post('/api/variants/batch', json={'variants': []}).status_code == 400
+    assert client.post('/api/variants/batch', json={'variants': ['rs1'] * (server_api.maxBatchVariants + 1)}).status_code == 400
+
+
+def test_conditional_get_shares_one_weak_etag_across_encodings(server_api, client, db, monkeypatch):
+    import gzip
+    import lookups
+    monkeypatch.setattr(lookups, 'dataset_cache', lookups.DatasetCache(check_interval=0))
+    db.variants.insert_one(make_variant(server_api, n_annotations=50)) # large enough for the response cache
+    plain = client.get('/api/variant?variant_id=1-100-A-C', headers={'Accept-Encoding': 'identity'})
+    compressed = client.get('/api/variant?variant_id=1-100-A-C', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in plain.headers and compressed.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(compressed.get_data()) == plain.get_data()
+    assert plain.headers['ETag'] == compressed.headers['ETag'] and plain.headers['ETag'].startswith('W/')
+    for response in [plain, compressed]:
+        assert response.headers['Vary'] == 'Accept-Encoding'
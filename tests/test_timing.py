@@ -0,0 +1,164 @@
+import json
+import os
+import subprocess
+import sys
+
+import bson.json_util
+import flask
+import pymongo.monitoring
+import pytest
+import timing
+
+
+def get_exited_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def write_state(directory, pid, n):
+    with open(os.path.join(directory, '{}.json'.format(pid)), 'w') as ofile:
+        json.dump([['bravo_mongo_commands_total', [['route', '/a']], [n]]], ofile)
+
+
+def get_total(metrics):
+    line = next(line for line in metrics.render().splitlines() if line.startswith('bravo_mongo_commands_total{'))
+    return int(line.split()[-1])
+
+
+def test_metrics_of_exited_processes_are_kept_once(tmp_path):
+    directory = str(tmp_path)
+    write_state(directory, get_exited_pid(), 1)
+    write_state(directory, get_exited_pid(), 10)
+    write_state(directory, os.getpid(), 100) # left by an exited process that had the same pid
+    metrics = timing.Metrics(directory)
+    metrics.increment('bravo_mongo_commands_total', (('route', '/a'),), 1000)
+    assert get_total(metrics) == 1111
+    assert sorted(filename for filename in os.listdir(directory) if not filename.startswith('.')) == sorted([timing.EXITED_FILENAME, '{}.json'.format(os.getpid())])
+    write_state(directory, get_exited_pid(), 10000)
+    assert get_total(metrics) == 11111
+
+
+class Event(object):
+    '''the parts of a pymongo command event that MongoListener reads'''
+    _request_ids = iter(range(1, 1000000))
+
+    def __init__(self, command_name, command, duration_micros=1000):
+        self.command_name, self.command, self.duration_micros = command_name, command, duration_micros
+        self.database_name, self.connection_id, self.request_id = 'bravo', ('localhost', 27017), next(self._request_ids)
+
+
+def find(xpos, positions=(), **kwargs):
+    command = {'find': 'variants', 'filter': {'xpos': {'$gte': xpos, '$lte': xpos + 100}}, '$db': 'bravo', 'lsid': {'id': xpos}}
+    if positions: command['filter'] = {'xpos': {'$in': list(positions)}}
+    command.update(kwargs)
+    return Event('find', command)
+
+
+def test_command_shape_drops_literals():
+    shape = timing.get_command_shape(find(1000, sort={'xpos': 1}, limit=10))
+    assert shape == 'find variants {"filter": {"xpos": {"$gte": 1, "$lte": 1}}, "limit": 1, "sort": {"xpos": 1}}'
+    assert timing.get_command_shape(find(5000, sort={'xpos': 1}, limit=1000)) == shape
+    assert timing.get_command_shape(find(0, positions=[1, 2, 3])) == timing.get_command_shape(find(0, positions=[4])) == 'find variants {"filter": {"xpos": {"$in": [1]}}}'
+    assert timing.get_command_shape(find(1000, sort={'_id': 1})) != shape
+    assert timing.get_command_shape(Event('aggregate', {'aggregate': 'variants', 'pipeline': [{'$match': {'xpos': 1}}, {'$match': {'xpos': 2}}, {'$limit': 10}], 'cursor': {}})) == \
+        'aggregate variants {"cursor": {}, "pipeline": [{"$match": {"xpos": 1}}, {"$limit": 1}]}'
+    assert timing.get_command_shape(Event('getMore', {'getMore': 123, 'collection': 'variants', 'batchSize': 100})) == 'getMore variants {"batchSize": 1}'
+
+
+def test_query_stats_groups_by_route_and_shape():
+    stats = timing.QueryStats(max_shapes=3)
+    for route, xpos, seconds in [('/a', 1, 0.1), ('/a', 2, 0.3), ('/a', 3, 0.2), ('/b', 4, 0.05)]:
+        event = find(xpos)
+        stats.add(route, timing.get_command_shape(event), 'bravo', event.command, seconds)
+    stats.add('/a', 'count variants {}', 'bravo', {'count': 'variants'}, 1.0)
+    stats.add('/c', 'count variants {}', 'bravo', {'count': 'variants'}, 2.0) # a fourth shape is not tracked
+    entries = stats.get_slowest(10)
+    assert [(e['route'], e['shape'].split()[0], e['count']) for e in entries] == [('/a', 'count', 1), ('/a', 'find', 3), ('/b', 'find', 1)]
+    assert abs(entries[1]['seconds'] - 0.6) < 1e-9 and entries[1]['max_seconds'] == 0.3
+    assert entries[1]['command']['filter'] == {'xpos': {'$gte': 2, '$lte': 102}} # the slowest command of the shape
+    assert [e['count'] for e in stats.get_slowest(1, 'count')] == [3]
+    assert [e['route'] for e in stats.get_slowest(3, 'max_seconds')] == ['/a', '/a', '/b']
+    stats.clear()
+    assert stats.get_slowest(10) == []
+
+
+@pytest.fixture
+def app(monkeypatch):
+    '''an app timed with a budget of 3 mongo commands per request; `/commands/<n>` sends `n` finds and a count to the listener'''
+    for name in ['_enabled', '_mongo_query_budget', 'metrics', 'query_stats']:
+        monkeypatch.setattr(timing, name, getattr(timing, name))
+    monkeypatch.setattr(pymongo.monitoring, 'register', lambda listener: None) # the test sends the events itself
+    app = flask.Flask(__name__)
+    app.config.update(TIMING=True, MONGO_QUERY_BUDGET=3, METRICS_DIRECTORY='')
+    timing.init_app(app)
+    listener = timing.MongoListener()
+    @app.route('/commands/<int:n>')
+    def commands(n):
+        for event in [find(xpos) for xpos in range(n)] + [Event('count', {'count': 'variants', 'query': {}})]:
+            listener.started(event)
+            listener.succeeded(event)
+        return 'ok'
+    return app
+
+
+def test_mongo_commands_are_counted_per_request(app, capsys):
+    client = app.test_client()
+    response = client.get('/commands/2')
+    assert 'mongo;dur=3.0;desc="3x"' in response.headers['Server-Timing']
+    assert capsys.readouterr().out == '' # within the budget
+    assert 'mongo;dur=6.0;desc="6x"' in client.get('/commands/5').headers['Server-Timing']
+    assert 'bravo_mongo_commands_total{route="/commands/<int:n>"} 9' in timing.metrics.render().splitlines()
+    entries = timing.query_stats.get_slowest(10, 'count')
+    assert [(e['route'], e['shape'].split()[0], e['count']) for e in entries] == [('/commands/<int:n>', 'find', 7), ('/commands/<int:n>', 'count', 2)]
+    assert '$db' not in entries[0]['command'] and 'lsid' not in entries[0]['command']
+
+
+def test_requests_over_the_mongo_query_budget_are_logged(app, capsys):
+    app.test_client().get('/commands/5?gene=PCSK9')
+    assert capsys.readouterr().out == ('## MONGO: GET /commands/5?gene=PCSK9 sent 6 commands in 0.006 seconds, more than the budget of 3; most frequent: '
+                                       '5x find variants {"filter": {"xpos": {"$gte": 1, "$lte": 1}}}; 1x count variants {"query": {}}\n')
+
+
+@pytest.fixture(scope='module')
+def exac(tmp_path_factory):
+    '''exac.py, configured to keep its caches in a temporary directory, and without Google sign-in'''
+    pytest.importorskip('flask_login')
+    tmp = tmp_path_factory.mktemp('exac')
+    config = tmp / 'config.py'
+    config.write_text("IGV_CRAM_DIRECTORY = IGV_CACHE_DIRECTORY = '{}'\nRESPONSE_CACHE_DIRECTORY = '{}'\n".format(tmp, tmp / 'response_cache'))
+    import auth
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv('BRAVO_CONFIG_FILE', str(config))
+        monkeypatch.setattr(auth.GoogleSignIn, '_get_google_info', lambda self: {}) # instead of fetching Google's OpenID configuration
+        import exac
+    return exac
+
+
+def test_administration_mongo_lists_the_slowest_shapes(exac, monkeypatch):
+    mongomock = pytest.importorskip('mongomock')
+    stats = timing.QueryStats()
+    for xpos, seconds in [(1, 0.1), (2, 0.3)]:
+        event = find(xpos)
+        stats.add('/region/<region_id>', timing.get_command_shape(event), 'bravo', event.command, seconds)
+    stats.add('/gene/<gene_id>', 'count variants {"query": {}}', 'bravo', {'count': 'variants', 'query': {}}, 0.5)
+    monkeypatch.setattr(timing, 'query_stats', stats)
+    monkeypatch.setattr(exac, 'current_user', exac.User(admin=True))
+    monkeypatch.setattr(exac, 'get_db', lambda: mongomock.MongoClient().bravo)
+    explained = []
+    monkeypatch.setattr(timing, 'explain', lambda client, database, command: explained.append(command) or {'queryPlanner': {'winningPlan': {'stage': 'IXSCAN'}}})
+    client = exac.app.test_client()
+
+    entries = bson.json_util.loads(client.get('/administration/mongo?n=1&order=count').get_data(as_text=True))
+    assert [(e['route'], e['count'], e['max_seconds']) for e in entries] == [('/region/<region_id>', 2, 0.3)]
+    assert entries[0]['explain'] == {'queryPlanner': {'winningPlan': {'stage': 'IXSCAN'}}}
+    assert explained == [entries[0]['command']] and entries[0]['command']['filter'] == {'xpos': {'$gte': 2, '$lte': 102}}
+    entries = bson.json_util.loads(client.get('/administration/mongo?explain=false').get_data(as_text=True))
+    assert [e['route'] for e in entries] == ['/gene/<gene_id>', '/region/<region_id>'] and all('explain' not in e for e in entries)
+    assert len(explained) == 1
+    assert client.get('/administration/mongo?order=shape').status_code == 400
+
+    monkeypatch.setattr(timing, 'query_stats', None) # TIMING is off
+    assert 'TIMING' in client.get('/administration/mongo').get_json()['error']
+    monkeypatch.setattr(exac, 'current_user', exac.User())
+    assert client.get('/administration/mongo').status_code == 404
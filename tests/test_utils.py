@@ -0,0 +1,57 @@
+import time
+
+import pytest
+from utils import HandlePool
+
+
+class Handle(object):
+    def __init__(self, key):
+        self.key = key
+        self.closed = False
+    def close(self):
+        self.closed = True
+
+
+def test_handle_pool_reuses_idle_handles_but_never_shares_them():
+    opened = []
+    pool = HandlePool(lambda key: opened.append(Handle(key)) or opened[-1])
+    with pool.borrow('a') as first:
+        with pool.borrow('a') as second:
+            assert first is not second
+    with pool.borrow('a') as third:
+        assert third in (first, second)
+    with pool.borrow('b') as fourth:
+        assert fourth.key == 'b'
+    assert len(opened) == 3 and not any(handle.closed for handle in opened)
+
+
+def test_handle_pool_keeps_at_most_max_idle_handles():
+    opened = []
+    pool = HandlePool(lambda key: opened.append(Handle(key)) or opened[-1], max_idle=2)
+    for key in 'abc':
+        with pool.borrow(key):
+            pass
+    assert [handle.closed for handle in opened] == [True, False, False] # least recently returned first
+
+
+def test_handle_pool_closes_idle_handles_when_any_handle_is_borrowed():
+    opened = []
+    pool = HandlePool(lambda key: opened.append(Handle(key)) or opened[-1], idle_timeout=0.05)
+    with pool.borrow('a'):
+        pass
+    time.sleep(0.1)
+    with pool.borrow('b'):
+        assert opened[0].closed # expired before any handle was returned
+    with pool.borrow('a') as handle:
+        assert handle is not opened[0]
+
+
+def test_handle_pool_closes_handles_that_raised():
+    opened = []
+    pool = HandlePool(lambda key: opened.append(Handle(key)) or opened[-1])
+    with pytest.raises(ValueError):
+        with pool.borrow('a'):
+            raise ValueError()
+    assert opened[0].closed
+    with pool.borrow('a') as handle:
+        assert handle is not opened[0]
@@ -0,0 +1,354 @@
+'''
+Per-request timing spans (mongo, coverage, cram, serialization, template, compress).
+Every request sends its spans to the client in a `Server-Timing` header, and they are aggregated into histograms by route, which `metrics_response()` serves in the Prometheus text format.
+Mongo commands are also counted by route and query shape (see `query_stats`), and requests that send more than `MONGO_QUERY_BUDGET` commands are logged with their most frequent shapes.
+Disabled unless `init_app()` is called for an app with `TIMING = True`; then `span()` returns a shared no-op and nothing else is hooked.
+A request is timed until its view returns: the body of a streamed response (e.g. `generate()` of `/annotate`, or the CSV download) is produced after that, so neither its time nor its mongo commands are counted.
+'''
+
+import bisect
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+
+import pymongo.monitoring
+from bson.son import SON
+from flask import Response, before_render_template, g, has_request_context, request, template_rendered
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf')) # seconds
+DUMP_INTERVAL = 10 # seconds between writes of this process's histograms to the metrics directory
+EXITED_FILENAME = 'exited.json' # totals of the processes that have exited, in the metrics directory
+METRICS = [ # (name, type, description), in the order of `/metrics`
+    ('bravo_request_duration_seconds', 'histogram', 'Time from the start of a request until its response was ready.'),
+    ('bravo_span_duration_seconds', 'histogram', 'Time spent in a span (mongo, coverage, cram, serialization, template, compress) per request.'),
+    ('bravo_mongo_commands_total', 'counter', 'Mongo commands (including getMores of cursors) sent while serving a route.'),
+]
+# keys of a monitored command that are not part of its shape, and are dropped from the copy kept for `explain`
+COMMAND_IGNORED_KEYS = {'$db', 'lsid', 'txnNumber', '$clusterTime', '$readPreference', 'readConcern', 'writeConcern', 'documents', 'comment'}
+EXPLAINABLE_COMMANDS = {'find', 'aggregate', 'count', 'distinct', 'update', 'delete', 'findAndModify'}
+
+_enabled = False
+_mongo_query_budget = 0
+metrics = None
+query_stats = None
+
+
+class _NoSpan(object):
+    def __enter__(self): return self
+    def __exit__(self, *exc_info): return False
+
+_NO_SPAN = _NoSpan()
+
+class _Span(object):
+    __slots__ = ('_spans', '_name', '_st')
+    def __init__(self, spans, name):
+        self._spans = spans
+        self._name = name
+    def __enter__(self):
+        self._st = time.time()
+        return self
+    def __exit__(self, *exc_info):
+        _add(self._spans, self._name, time.time() - self._st)
+        return False
+
+def _add(spans, name, seconds):
+    entry = spans.get(name)
+    if entry is None: spans[name] = [seconds, 1]
+    else: entry[0] += seconds; entry[1] += 1
+
+def _get_spans():
+    if not _enabled or not has_request_context(): return None
+    return g.get('_timing_spans')
+
+def span(name):
+    '''`with timing.span('cram'): ...` adds the time spent in the block to the span `name` of the current request'''
+    spans = _get_spans()
+    return _NO_SPAN if spans is None else _Span(spans, name)
+
+def record(name, seconds):
+    '''adds `seconds` to the span `name` of the current request, if there is one'''
+    spans = _get_spans()
+    if spans is not None: _add(spans, name, seconds)
+
+
+def get_query_shape(value):
+    '''`value` with every literal replaced by 1 and repeated elements of lists collapsed, so that e.g. `{'xpos': {'$in': [...]}}` has one shape for any list of positions'''
+    if isinstance(value, dict):
+        return {k: get_query_shape(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        shapes = []
+        for v in value:
+            shape = get_query_shape(v)
+            if shape not in shapes: shapes.append(shape)
+        return shapes
+    return 1
+
+def get_command_shape(event):
+    '''e.g. `find variants {"filter": {"xpos": {"$gte": 1, "$lte": 1}}, "sort": {"xpos": 1}}`'''
+    name = event.command_name
+    collection = event.command.get(name) if isinstance(event.command.get(name), str) else event.command.get('collection', '')
+    rest = {k: v for k, v in event.command.items() if k != name and k != 'collection' and k not in COMMAND_IGNORED_KEYS}
+    return '{} {} {}'.format(name, collection, json.dumps(get_query_shape(rest), sort_keys=True))
+
+
+class MongoListener(pymongo.monitoring.CommandListener):
+    '''
+    Adds the round trip of every command sent while serving a request (including `getMore`s of cursors) to the `mongo` span, and counts it by route and shape.
+    Events fire in the thread that sent the command, so the request context is available.
+    '''
+    def started(self, event):
+        pending = g.get('_timing_mongo_pending') if _get_spans() is not None else None
+        if pending is not None:
+            command = SON((k, v) for k, v in event.command.items() if k not in COMMAND_IGNORED_KEYS)
+            pending[(event.connection_id, event.request_id)] = (get_command_shape(event), event.database_name, command)
+    def succeeded(self, event):
+        self._finished(event)
+    def failed(self, event):
+        self._finished(event)
+    def _finished(self, event):
+        spans = _get_spans()
+        if spans is None: return
+        seconds = event.duration_micros / 1e6
+        _add(spans, 'mongo', seconds)
+        started = g._timing_mongo_pending.pop((event.connection_id, event.request_id), None)
+        if started is None: return
+        shape, database, command = started
+        _add(g._timing_mongo_shapes, shape, seconds)
+        query_stats.add(_get_route(), shape, database, command, seconds)
+
+
+class QueryStats(object):
+    '''
+    Per-process totals of mongo commands by (route, shape), each with its slowest command, so that `explain()` can show how mongo runs it.
+    At most `max_shapes` shapes are tracked; commands of new shapes are ignored after that.
+    '''
+    def __init__(self, max_shapes=1000):
+        self._max_shapes = max_shapes
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def add(self, route, shape, database, command, seconds):
+        with self._lock:
+            entry = self._entries.get((route, shape))
+            if entry is None:
+                if len(self._entries) >= self._max_shapes: return
+                entry = self._entries[(route, shape)] = {'route': route, 'shape': shape, 'count': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            if seconds >= entry['max_seconds']:
+                entry.update(max_seconds=seconds, database=database, command=command)
+
+    def get_slowest(self, n, order='seconds'):
+        '''the `n` (route, shape) entries with the highest `order`: "seconds" (in total), "max_seconds" or "count"'''
+        with self._lock:
+            entries = [dict(entry) for entry in self._entries.values()]
+        return sorted(entries, key=lambda entry: entry[order], reverse=True)[:n]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def explain(client, database, command):
+    '''the query plan that mongo chose for `command` (a command kept by `QueryStats`), or None for commands that can't be explained'''
+    if next(iter(command)) not in EXPLAINABLE_COMMANDS: return None
+    try:
+        result = client[database].command(SON([('explain', command), ('verbosity', 'queryPlanner')]))
+    except pymongo.errors.PyMongoError as e:
+        return {'error': str(e)}
+    return {k: v for k, v in result.items() if k not in ('serverInfo', 'ok', '$clusterTime', 'operationTime')}
+
+
+class Metrics(object):
+    '''
+    Histograms and counters (see METRICS), keyed by (metric name, labels). A histogram is a list of counts per bucket followed by the sum, a counter is a list of one value.
+    gunicorn workers are separate processes, so with a `directory` every process writes its metrics to `<directory>/<pid>.json` at most every DUMP_INTERVAL seconds, and `render()` sums the files of all processes.
+    The files of exited processes are added to `<directory>/exited.json` and removed, so that totals don't drop when a worker is replaced and the directory doesn't grow with every worker.
+    Totals still drop by whatever a worker did since its last dump when it is killed, and they start over when the directory is emptied.
+    '''
+    def __init__(self, directory=''):
+        self._directory = directory
+        self._lock = threading.Lock()
+        self._values = {} # (metric, labels) -> list
+        self._dumped = 0
+        self._pid = None # the process that last dumped; a `<pid>.json` it didn't write is left by an exited process with the same pid
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def observe(self, metric, labels, seconds):
+        key = (metric, labels)
+        i = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None: histogram = self._values[key] = [0] * (len(BUCKETS) + 1)
+            histogram[i] += 1
+            histogram[-1] += seconds
+
+    def increment(self, metric, labels, n=1):
+        key = (metric, labels)
+        with self._lock:
+            counter = self._values.get(key)
+            if counter is None: counter = self._values[key] = [0]
+            counter[0] += n
+
+    def _get_state(self):
+        with self._lock:
+            return [[metric, list(labels), list(values)] for (metric, labels), values in self._values.items()]
+
+    def dump(self, force=False):
+        if not self._directory or (not force and time.time() - self._dumped < DUMP_INTERVAL): return
+        self._dumped = time.time()
+        try:
+            if self._pid != os.getpid():
+                self._fold_exited(reused_pid=os.getpid())
+                self._pid = os.getpid()
+            fd, tmp_path = tempfile.mkstemp(dir=self._directory, prefix='.tmp')
+            with os.fdopen(fd, 'w') as ofile:
+                json.dump(self._get_state(), ofile)
+            os.rename(tmp_path, os.path.join(self._directory, '{}.json'.format(os.getpid())))
+        except (IOError, OSError) as e:
+            print('## TIMING: could not write metrics to {}: {}'.format(self._directory, e)) # never fail a request over metrics
+
+    def _read_state(self, filename):
+        try:
+            with open(os.path.join(self._directory, filename)) as ifile:
+                return json.load(ifile)
+        except (IOError, OSError, ValueError):
+            return None # removed or being replaced
+
+    def _fold_exited(self, reused_pid=None):
+        '''adds the files of exited processes (and the file of `reused_pid`) to EXITED_FILENAME and removes them; a lock file keeps processes from adding a file twice'''
+        with open(os.path.join(self._directory, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            exited = [filename for filename in os.listdir(self._directory)
+                      if filename.endswith('.json') and filename[:-5].isdigit() and (int(filename[:-5]) == reused_pid or not _is_running(int(filename[:-5])))]
+            if not exited: return
+            states = [self._read_state(filename) for filename in [EXITED_FILENAME] + exited]
+            fd, tmp_path = tempfile.mkstemp(dir=self._directory, prefix='.tmp')
+            with os.fdopen(fd, 'w') as ofile:
+                json.dump([[metric, labels, values] for (metric, labels), values in _merge_states(state for state in states if state is not None).items()], ofile)
+            os.rename(tmp_path, os.path.join(self._directory, EXITED_FILENAME))
+            for filename in exited:
+                os.remove(os.path.join(self._directory, filename))
+
+    def _load_states(self):
+        if not self._directory: return [self._get_state()]
+        self.dump(force=True)
+        try:
+            self._fold_exited()
+        except (IOError, OSError) as e:
+            print('## TIMING: could not remove metrics of exited processes from {}: {}'.format(self._directory, e))
+        states = [self._read_state(filename) for filename in os.listdir(self._directory) if filename.endswith('.json')]
+        return [state for state in states if state is not None]
+
+    def render(self):
+        '''all metrics in the Prometheus text exposition format'''
+        merged = _merge_states(self._load_states())
+        lines = []
+        for metric, metric_type, description in METRICS:
+            lines.append('# HELP {} {}'.format(metric, description))
+            lines.append('# TYPE {} {}'.format(metric, metric_type))
+            for (name, labels), values in sorted(merged.items()):
+                if name != metric: continue
+                label_text = ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+                if metric_type == 'counter':
+                    lines.append('{}{{{}}} {}'.format(metric, label_text, values[0]))
+                    continue
+                histogram = values
+                count = 0
+                for le, n in zip(BUCKETS, histogram):
+                    count += n
+                    lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(metric, label_text, ',' if label_text else '', '+Inf' if le == float('inf') else repr(le), count))
+                lines.append('{}_sum{{{}}} {!r}'.format(metric, label_text, histogram[-1]))
+                lines.append('{}_count{{{}}} {}'.format(metric, label_text, count))
+        return '\n'.join(lines) + '\n'
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass # e.g. EPERM: the process exists, but belongs to another user
+    return True
+
+def _merge_states(states):
+    '''sums states (as written by `Metrics.dump`) into {(metric, labels): values}'''
+    merged = {}
+    for state in states:
+        for metric, labels, values in state:
+            key = (metric, tuple(tuple(label) for label in labels))
+            if key not in merged: merged[key] = list(values)
+            else: merged[key] = [a + b for a, b in zip(merged[key], values)]
+    return merged
+
+
+def _get_route():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched' # rules, not paths, keep the number of series bounded
+
+def _before_request():
+    g._timing_spans = {}
+    g._timing_mongo_pending = {} # (connection id, request id) -> (shape, database, command) of commands in flight
+    g._timing_mongo_shapes = {} # shape -> [seconds, count]
+    g._timing_st = time.time()
+
+def _after_request(response):
+    spans = g.pop('_timing_spans', None)
+    if spans is None: return response
+    total = time.time() - g._timing_st
+    timings = ['{};dur={:.1f}{}'.format(name, seconds * 1000, ';desc="{}x"'.format(n) if n > 1 else '') for name, (seconds, n) in sorted(spans.items())]
+    timings.append('total;dur={:.1f}'.format(total * 1000))
+    response.headers['Server-Timing'] = ', '.join(timings)
+    route = _get_route()
+    metrics.observe('bravo_request_duration_seconds', (('route', route), ('method', request.method), ('status', '{}xx'.format(response.status_code // 100))), total)
+    for name, (seconds, n) in spans.items():
+        metrics.observe('bravo_span_duration_seconds', (('route', route), ('span', name)), seconds)
+    if 'mongo' in spans:
+        mongo_seconds, n_commands = spans['mongo']
+        metrics.increment('bravo_mongo_commands_total', (('route', route),), n_commands)
+        if _mongo_query_budget and n_commands > _mongo_query_budget:
+            shapes = sorted(g._timing_mongo_shapes.items(), key=lambda item: item[1][1], reverse=True)[:3]
+            print('## MONGO: {} {} sent {} commands in {:.3f} seconds, more than the budget of {}; most frequent: {}'.format(
+                request.method, request.full_path.rstrip('?'), n_commands, mongo_seconds, _mongo_query_budget, '; '.join('{}x {}'.format(n, shape) for shape, (seconds, n) in shapes)))
+    metrics.dump()
+    return response
+
+def _before_render_template(sender, template, context, **extra):
+    if _get_spans() is not None: g._timing_template_st = time.time()
+
+def _template_rendered(sender, template, context, **extra):
+    st = g.pop('_timing_template_st', None) if _get_spans() is not None else None
+    if st is not None: record('template', time.time() - st)
+
+
+def init_app(app):
+    '''
+    Hooks timing into `app` if `TIMING` is set in its config.
+    Call it before creating MongoClients: the mongo span comes from a command listener, which pymongo only adds to clients created after it was registered.
+    '''
+    global _enabled, _mongo_query_budget, metrics, query_stats
+    if not app.config['TIMING']: return
+    _enabled = True
+    _mongo_query_budget = app.config['MONGO_QUERY_BUDGET']
+    metrics = Metrics(app.config['METRICS_DIRECTORY'])
+    query_stats = QueryStats()
+    pymongo.monitoring.register(MongoListener())
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    before_render_template.connect(_before_render_template, app)
+    template_rendered.connect(_template_rendered, app)
+    class TimedJSONEncoder(app.json_encoder):
+        def encode(self, o):
+            with span('serialization'):
+                return super(TimedJSONEncoder, self).encode(o)
+    app.json_encoder = TimedJSONEncoder
+
+def metrics_response(allowed_ips, ip):
+    '''the response for `/metrics`: 404 while timing is disabled, 403 unless `ip` is in `allowed_ips`'''
+    if not _enabled: return Response('timing is disabled\n', status=404, mimetype='text/plain')
+    if ip not in allowed_ips: return Response('forbidden\n', status=403, mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
@@ -1,3 +1,9 @@
+import contextlib
+import hashlib
+import json
+import os
+import threading
+import time
 import traceback
 from collections import OrderedDict
 from operator import itemgetter
@@ -189,6 +195,59 @@ class defaultdict_that_passes_key_to_default_factory(dict):
         value = self[key] = self._default_factory(key)
         return value
 
+class HandlePool(object):
+    '''Keeps idle open file handles (e.g. pysam.TabixFile, pysam.AlignmentFile) for reuse.
+    A borrowed handle is never shared, so concurrent threads or greenlets can fetch safely.
+    At most `max_idle` handles are kept, and handles idle for longer than `idle_timeout` seconds are closed by the next borrow or return of any handle.'''
+    def __init__(self, opener, max_idle=16, idle_timeout=300):
+        self._opener = opener
+        self._max_idle = max_idle
+        self._idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._idle = [] # (returned at, key, handle), least recently returned first
+        self._pid = os.getpid()
+    @contextlib.contextmanager
+    def borrow(self, key):
+        '''`key` is passed to `opener` when there is no idle handle for it'''
+        handle = self._take(key)
+        try:
+            yield handle
+        except:
+            handle.close() # its state is unknown, so don't reuse it
+            raise
+        self._give_back(key, handle)
+    def _take(self, key):
+        handle = None
+        with self._lock:
+            if self._pid != os.getpid():
+                # after a fork, handles opened by the parent share file offsets with it
+                self._idle, self._pid = [], os.getpid()
+            expired = self._pop_expired()
+            for i in range(len(self._idle) - 1, -1, -1):
+                if self._idle[i][1] == key:
+                    handle = self._idle.pop(i)[2]
+                    break
+        for expired_handle in expired:
+            expired_handle.close()
+        return handle if handle is not None else self._opener(key)
+    def _give_back(self, key, handle):
+        with self._lock:
+            self._idle.append((time.time(), key, handle))
+            expired = self._pop_expired()
+        for handle in expired:
+            handle.close()
+    def _pop_expired(self):
+        # called with the lock held, by every borrow and every return; the caller closes the handles after releasing the lock
+        now = time.time()
+        expired = []
+        while self._idle and (len(self._idle) > self._max_idle or now - self._idle[0][0] > self._idle_timeout):
+            expired.append(self._idle.pop(0)[2])
+        return expired
+
+def make_etag(*parts):
+    '''ETag for a response that is fully determined by `parts` (e.g. the dataset generation and the canonical request); it is sent weak, since the same value covers every Content-Encoding'''
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
 def indent_pprint(obj):
     import pprint
     print('\n'.join('####'+line for line in pprint.pformat(obj).split('\n')))